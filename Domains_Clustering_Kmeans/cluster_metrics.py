@@ -0,0 +1,131 @@
+"""
+CLUSTER QUALITY METRICS
+=======================
+
+Author: Teddy Crepineau
+
+Purpose: measure the quality of a k-means result to compare several values of k. Every metric reuses the
+distance between each point and its centroid returned by the k-means functions of
+domains_performance_clustering.py (kmeansMatrix(), kmeansHamerly()) instead of computing it again.
+
+   - average_distance -> average over the clusters of the mean distance between points and their centroid
+                         (the figure used by runTestKmeans() to pick k), lower is better
+   - max_distance -> biggest distance between a point and its centroid
+   - inertia -> sum of the squared distances between points and their centroid, lower is better
+   - silhouette -> mean of (b - a) / max(a, b) where a is the mean distance of a point to the other points of
+                   its cluster and b the mean distance to the points of the closest other cluster. Between -1
+                   and 1, higher is better. Computed on a random sample of points for large datasets.
+   - davies_bouldin -> mean over the clusters of the worst (s_i + s_j) / d(c_i, c_j), where s_i is the mean
+                       distance of the points of cluster i to its centroid. Lower is better.
+
+Reference: https://en.wikipedia.org/wiki/Silhouette_(clustering)
+           https://en.wikipedia.org/wiki/Davies%E2%80%93Bouldin_index
+"""
+
+import random
+
+import numpy as np
+
+METRICS = ['average_distance', 'max_distance', 'inertia', 'silhouette', 'davies_bouldin']
+
+
+def clusterSizes(labels, k):
+    return np.bincount(labels, minlength=k)
+
+def averageDistance(labels, distances, k):
+    """
+    Same figure as averageDistance() in domains_performance_clustering.py (empty clusters count as 0)
+    """
+    counts = clusterSizes(labels, k)
+    totals = np.bincount(labels, weights=distances, minlength=k)
+    return float((totals[counts > 0] / counts[counts > 0]).sum() / k)
+
+def inertia(distances):
+    return float(np.dot(distances, distances))
+
+def daviesBouldin(labels, centroids, distances):
+    """
+    Davies-Bouldin index of the non empty clusters (None if there is less than 2 of them)
+    """
+    k = len(centroids)
+    counts = clusterSizes(labels, k)
+    not_empty = counts > 0
+    if not_empty.sum() < 2:
+        return None
+
+    scatter = np.bincount(labels, weights=distances, minlength=k)[not_empty] / counts[not_empty]
+    centers = centroids[not_empty]
+    diff = centers[:, None, :] - centers[None, :, :]
+    separation = np.sqrt((diff**2).sum(axis=2))
+    np.fill_diagonal(separation, np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = (scatter[:, None] + scatter[None, :]) / separation ## 2 identical centroids give inf
+    return float(ratios.max(axis=1).mean())
+
+def silhouetteScore(data, labels, k, sample_size=5000, seed=None, block_size=4000000):
+    """
+    Mean silhouette of sample_size random points (every point if there are fewer). The distances between the
+    sampled points and every point are computed by blocks of about block_size distances, so memory does not
+    grow with sample_size. Points alone in their cluster have a silhouette of 0. Returns None if there
+    is less than 2 non empty clusters.
+    """
+    counts = clusterSizes(labels, k).astype(np.float64)
+    if (counts > 0).sum() < 2:
+        return None
+
+    if sample_size is None or sample_size >= len(data):
+        sample = np.arange(len(data))
+    else:
+        sample = np.array(sorted(random.Random(seed).sample(range(len(data)), sample_size)))
+
+    data = np.asarray(data, dtype=np.float64)
+    one_hot = np.zeros((len(data), k))
+    one_hot[np.arange(len(data)), labels] = 1.0
+    squared_norms = np.einsum('ij,ij->i', data, data)
+
+    chunk_size = max(block_size // len(data), 1)
+    scores = []
+    for start in range(0, len(sample), chunk_size):
+        rows = sample[start:start + chunk_size]
+        squared = squared_norms[rows][:, None] + squared_norms[None, :] - 2 * data[rows].dot(data.T)
+        distances = np.sqrt(np.maximum(squared, 0.0))
+        distances[np.arange(len(rows)), rows] = 0.0 ## distance of a point to itself
+        cluster_totals = distances.dot(one_hot) ## sum of the distances to the points of every cluster
+
+        own = labels[rows]
+        own_size = counts[own]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = cluster_totals[np.arange(len(rows)), own] / (own_size - 1)
+            mean_distances = cluster_totals / counts
+        mean_distances[np.arange(len(rows)), own] = np.inf
+        mean_distances[:, counts == 0] = np.inf
+        b = mean_distances.min(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = (b - a) / np.maximum(a, b)
+        score[own_size <= 1] = 0.0
+        scores.append(np.nan_to_num(score))
+
+    return float(np.concatenate(scores).mean())
+
+def clusterMetrics(data, labels, centroids, distances, names=None, silhouette_sample=5000, seed=None):
+    """
+    Return a dictionnary metric name -> value for the metrics in names (default to every metric in METRICS).
+    distances is the distance of every point to its centroid, as returned by kmeansMatrix().
+    """
+    k = len(centroids)
+    results = {}
+    for name in (METRICS if names is None else names):
+        if name == 'average_distance':
+            results[name] = averageDistance(labels, distances, k)
+        elif name == 'max_distance':
+            results[name] = float(distances.max())
+        elif name == 'inertia':
+            results[name] = inertia(distances)
+        elif name == 'silhouette':
+            results[name] = silhouetteScore(data, labels, k, silhouette_sample, seed)
+        elif name == 'davies_bouldin':
+            results[name] = daviesBouldin(labels, centroids, distances)
+        else:
+            raise ValueError('Unknown metric ' + str(name) + ', expected one of ' + ', '.join(METRICS))
+
+    return results
@@ -26,9 +26,17 @@ mitigate the impact of 1 attribut over another
 
 import matplotlib.pyplot as plt
 from collections import OrderedDict
+import hashlib
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+import os
 import pylab
+import shutil
 import random
+import numpy as np
 import pandas as pd
+import cluster_metrics
 
 
 class Points(object):
@@ -72,64 +80,114 @@ class Points(object):
         return self.name
 
 
+class PointSet(object):
+    """
+    Columnar storage of all the points: one names array, one float matrix (one row per point) and the int32
+    cluster label of every point (-1 until the points are clustered). Points objects are only built on demand
+    (see getPoint()).
+    """
+    
+    def __init__(self, names, attributs, dtype = np.float64):
+        self.names = np.asarray(names, dtype=object)
+        self.data = np.ascontiguousarray(attributs, dtype=dtype)
+        self.labels = np.full(len(self.names), -1, dtype=np.int32)
+    
+    @classmethod
+    def fromPoints(cls, points, dtype = np.float64):
+        return cls([p.getName() for p in points], [p.getAttributs() for p in points], dtype)
+    
+    def dimensionality(self):
+        return self.data.shape[1]
+    
+    def getPoint(self, i):
+        return Points(self.names[i], self.data[i])
+    
+    def __len__(self):
+        return len(self.names)
+
+
 class Cluster(object):
     """
     Abstraction of a cluster for our k-means algorithm
     """
-    ## This class should have objects composed of just points names (corresponding to 
-    ## domain names). Points are in unique clusters at a time. 
+    ## A cluster is a view over a PointSet: the row numbers of its points (indices) and its centroid. Points 
+    ## are in unique clusters at a time. 
     
-    def __init__(self, points):
-        self.points = points
-        self.centroid = self.computeCentroid()
+    def __init__(self, point_set, indices, centroid = None):
+        self.point_set = point_set
+        self.indices = np.asarray(indices, dtype=np.intp)
+        if centroid is None:
+            self.centroid = self.computeCentroid()
+        else:
+            self.centroid = Points('mean', centroid) ## centroid already computed by kmeansMatrix()
         
     def computeCentroid(self):
-        dim = self.points[0].dimensionality()
-        total_value = pylab.array([0.0]*dim)
-        for p in self.points:
-            total_value += p.getAttributs()
-        
-        centroid = Points('mean', total_value/len(self.points))
-
-        return centroid
+        total_value = self.point_set.data[self.indices].sum(axis=0, dtype=np.float64)
+        return Points('mean', total_value/len(self.indices))
     
     def getCentroid(self):
         return self.centroid
     
-    def update(self, points):
+    def update(self, indices):
         old_centroid = self.getCentroid() 
-        self.points = points
+        self.indices = np.asarray(indices, dtype=np.intp)
         
-        if len(self.points) > 0:
+        if len(self.indices) > 0:
             self.centroid = self.computeCentroid()
             return old_centroid.euclidianDistance(self.centroid) 
         else:
             return 0.0
+    
+    def getNames(self):
+        return self.point_set.names[self.indices]
+    
+    def getAttributs(self):
+        return self.point_set.data[self.indices]
         
     def members(self):
-        for p in self.points:
-            yield p
+        for i in self.indices:
+            yield self.point_set.getPoint(i)
+    
+    def __len__(self):
+        return len(self.indices)
         
     def __str__(self):
-        names = []
-        for p in self.points:
-            names.append(p.getName())
-        names.sort()
-        result = ''
-        for p in names:
-            result = result + p + ','
-        return result[:-1]
+        return ','.join(sorted(self.getNames()))
             
     
     
 
-def openFile(filename):
+## Attributs used for the clustering: (name, numerator, denominator), added when the numerator is in the file
+RATIO_COLUMNS = [('BLOCK %', 'BLOCK', 'REQUEST'),
+                 ('IN-VIEW %', 'VIEWABLE', 'MEASURED'),
+                 ('CLICK %', 'CLICKS', 'IMPRESSION'),
+                 ('INCIDENT %', 'INCIDENTS', 'IMPRESSION'),
+                 ('100% COMPLETES %', 'COMPLETES', 'IMPRESSION')]
+
+def addRatioColumns(df):
+    """
+    Add the ratio columns (BLOCK %, IN-VIEW %, etc.) to df (DataFrame with one row per domain). Returns the
+    names of the columns added.
+    """
+    added = []
+    for name, numerator, denominator in RATIO_COLUMNS:
+        if numerator in df.columns.values:
+            df[name] = df[numerator]/df[denominator]
+            added.append(name)
+    
+    return added
+
+FEATURE_CACHE_DIR = '.feature_cache' ## created next to the input file
+FEATURE_CACHE_VERSION = 1 ## increase when the preprocessing of normalizeFile() changes
+
+def aggregateFile(filename):
     """
-    Load file and convert it to a panda dataframe. 
+    Load file and convert it to a panda dataframe with one row per domain and the ratio attributs. Returns the
+    dataframe and the number of columns before the ratio attributs.
     """
     
-    ## Data cleaning & normalization by using Pandas DataFrame
-    ## --------------------------------------------------------
+    ## Data cleaning by using Pandas DataFrame
+    ## ---------------------------------------
     
     input_file = pd.read_table(filename, sep=',') ## 1) Load file into a DataFrame
     input_file_no_na = input_file.dropna(axis=1, how='all') ## 3) Drops columns with only NaN
@@ -138,24 +196,20 @@ def openFile(filename):
 
     len_init = len(input_file_no_na.columns.values)
     
-    if 'BLOCK' in input_file_no_na.columns.values:
-        input_file_no_na['BLOCK %'] = input_file_no_na['BLOCK']/input_file_no_na['REQUEST']
-
-    if 'VIEWABLE' in input_file_no_na.columns.values:
-        input_file_no_na['IN-VIEW %'] = input_file_no_na['VIEWABLE']/input_file_no_na['MEASURED']
-
-    if 'CLICKS' in input_file_no_na.columns.values:
-        input_file_no_na['CLICK %'] = input_file_no_na['CLICKS']/input_file_no_na['IMPRESSION']
-
-    if 'INCIDENTS' in input_file_no_na.columns.values:
-        input_file_no_na['INCIDENT %'] = input_file_no_na['INCIDENTS']/input_file_no_na['IMPRESSION']
-        
-    if 'COMPLETES' in input_file_no_na.columns.values:
-        input_file_no_na['100% COMPLETES %'] = input_file_no_na['COMPLETES']/input_file_no_na['IMPRESSION']
+    addRatioColumns(input_file_no_na)
     
+    return input_file_no_na.dropna(), len_init
+
+def normalizeFile(filename):
+    """
+    Load file (see aggregateFile()) and normalize the ratio attributs. Returns the domain names, the normalized
+    attributs (one row per domain), the attribut names and their min / max values before normalization.
+    """
     
-    input_file_no_na = input_file_no_na.dropna()
+    ## Normalization by using Pandas DataFrame
+    ## ---------------------------------------
     
+    input_file_no_na, len_init = aggregateFile(filename)
    
     max_values = pd.Series(pd.DataFrame.max(input_file_no_na.iloc[:,len_init:])) ## 6) Store max values of of attributes to normalize data
     min_values = pd.Series(pd.DataFrame.min(input_file_no_na.iloc[:,len_init:])) ## 6') Store min values of of attributes to normalize data
@@ -163,19 +217,83 @@ def openFile(filename):
     normalized_data.insert(loc=0,column='DOMAINS', value=input_file_no_na.iloc[:,0]) ## 8) Add domain names at the beginning of the new Data Frame 
     column_names = normalized_data.columns.values[1:]
     
-    normalized_data = normalized_data.values ## convert object type from pd.df to np.array
+    names = normalized_data['DOMAINS'].astype(str).values
+    data = np.ascontiguousarray(normalized_data.iloc[:,1:].values, dtype=np.float64)
     
+    return names, data, column_names, min_values.values, max_values.values
+
+def fileHash(filename, block_size = 1 << 20):
+    """
+    sha1 of the content of filename, read block_size bytes at a time
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def saveFeatureCache(cache_path, names, data, column_names, min_values, max_values):
+    """
+    Write the output of normalizeFile() to the cache_path directory: names.npy (fixed width strings) and
+    data.npy can be memory mapped, the attribut names and min / max values go to meta.json. Files are written
+    to a temporary directory renamed at the end, so a cache is never read half written.
+    """
+    tmp_path = cache_path + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_path)
+    try:
+        np.save(os.path.join(tmp_path, 'names.npy'), np.asarray(names, dtype=str))
+        np.save(os.path.join(tmp_path, 'data.npy'), data)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': FEATURE_CACHE_VERSION, 'column_names': [str(c) for c in column_names],
+                       'min_values': [float(v) for v in min_values],
+                       'max_values': [float(v) for v in max_values]}, f)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(cache_path): ## another process may have written the same cache first
+            raise
+
+def loadFeatureCache(cache_path):
+    """
+    Memory map a cache written by saveFeatureCache(), returns the same values as normalizeFile()
+    """
+    with open(os.path.join(cache_path, 'meta.json')) as f:
+        meta = json.load(f)
+    names = np.load(os.path.join(cache_path, 'names.npy'), mmap_mode='r')
+    data = np.load(os.path.join(cache_path, 'data.npy'), mmap_mode='r')
+    
+    return (names, data, np.array(meta['column_names'], dtype=object), np.array(meta['min_values']),
+            np.array(meta['max_values']))
+
+def loadFeatureMatrix(filename, cache = True, cache_dir = None):
+    """
+    Same as normalizeFile() but the result is cached in cache_dir (default to .feature_cache next to filename),
+    keyed by the hash of the content of filename. Later calls on the same content memory map the cache
+    instead of parsing and normalizing the file again. The data matrix is read-only when it comes from the
+    cache.
+    """
+    if not cache:
+        return normalizeFile(filename)
     
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), FEATURE_CACHE_DIR)
+    cache_path = os.path.join(cache_dir, fileHash(filename) + '_v' + str(FEATURE_CACHE_VERSION))
     
-    ## Put data into list and pass each list to functions to run our k-mean algorithm
-    ## ------------------------------------------------------------------------------
-    name = []
-    attributs = []
-    for i in range(len(normalized_data)):
-        name.append(normalized_data[i][0])
-        attributs.append(list(normalized_data[i][1:]))
+    if not os.path.isdir(cache_path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        saveFeatureCache(cache_path, *normalizeFile(filename))
     
-    return name, attributs, column_names
+    return loadFeatureCache(cache_path)
+
+def openFile(filename, cache = True, cache_dir = None):
+    """
+    Load file and return the domain names, their normalized attributs (list of lists) and the attribut names
+    (see loadFeatureMatrix() for the cache).
+    """
+    names, data, column_names, min_values, max_values = loadFeatureMatrix(filename, cache, cache_dir)
+    
+    return [str(name) for name in names], data.tolist(), column_names
 
 def buildPoints(name, attributs):
     """
@@ -191,135 +309,590 @@ def buildPoints(name, attributs):
         
     return points
 
-def runKmeans(points, k, cut_off, iterations):
-    """"
-    Runs the k-means algorithm
+def buildMatrix(points):
     """
+    Stack the attributs of every point in one contiguous float array (one row per point, same order as points)
+    """
+    return np.ascontiguousarray([p.getAttributs() for p in points], dtype=np.float64)
+
+def buildClusters(point_set, labels, centroids):
+    """
+    Build Cluster views from the output of kmeansMatrix(). labels[i] is the cluster of row i of point_set
+    (a PointSet or a list of Points), labels are stored in point_set.labels.
+    """
+    if not isinstance(point_set, PointSet):
+        point_set = PointSet.fromPoints(point_set)
+    point_set.labels[:] = labels
     
-    ## Initialize the algorithm by randomly picking intial centroid in Points
-    initial_centroid = random.sample(points, k)
+    order = np.argsort(point_set.labels, kind='stable') ## rows of every cluster, in their original order
+    bounds = np.searchsorted(point_set.labels[order], np.arange(len(centroids) + 1))
     
-    ## Create an empty cluster and append k clusters composed of p initial point
-    clusters = []
+    return [Cluster(point_set, order[bounds[i]:bounds[i + 1]], centroids[i]) for i in range(len(centroids))]
+
+def distanceMatrix(data, centroids):
+    """
+    Euclidian distance between every row of data and every centroid (len(data) x len(centroids) array).
+    Distances are computed one centroid at a time on the whole matrix (no Python loop over points).
+    """
+    distances = np.empty((len(data), len(centroids)))
+    for i in range(len(centroids)):
+        diff = data - centroids[i]
+        distances[:, i] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
     
-    for p in initial_centroid:
-        clusters.append(Cluster([p]))
+    return distances
+
+def assignPoints(data, centroids):
+    """
+    Return the index of the closest centroid for every row of data and the distance to it.
+    """
+    distances = distanceMatrix(data, centroids)
+    labels = distances.argmin(axis=1) ## first closest centroid on ties, as the original loop
+    return labels, distances[np.arange(len(data)), labels]
+
+def computeCentroids(data, labels, centroids):
+    """
+    Mean of the points of every cluster. Empty clusters keep their previous centroid.
+    """
+    k = len(centroids)
+    counts = np.bincount(labels, minlength=k)
+    new_centroids = centroids.copy()
+    not_empty = counts > 0
+    for j in range(data.shape[1]):
+        sums = np.bincount(labels, weights=data[:, j], minlength=k)
+        new_centroids[not_empty, j] = sums[not_empty] / counts[not_empty]
     
+    return new_centroids
+
+def kmeansPlusPlus(data, k, rng=random, stats=None):
+    """
+    k-means++ seeding: the first centroid is a random point, every next centroid is a point drawn with a
+    probability proportional to its squared distance to the closest centroid already picked. rng is the random
+    module or a random.Random object. Returns the index of the k points picked.
+    
+    Reference: Arthur & Vassilvitskii, "k-means++: The Advantages of Careful Seeding" (2007)
+    """
+    initial_index = [rng.randrange(len(data))]
+    diff = data - data[initial_index[0]]
+    closest = np.einsum('ij,ij->i', diff, diff)
+    
+    for i in range(1, k):
+        total = closest.sum()
+        if total > 0:
+            index = int(np.searchsorted(np.cumsum(closest), rng.random() * total, side='right'))
+            index = min(index, len(data) - 1)
+        else: ## every point is already a centroid
+            index = rng.randrange(len(data))
+        initial_index.append(index)
+        diff = data - data[index]
+        closest = np.minimum(closest, np.einsum('ij,ij->i', diff, diff))
+    
+    if stats is not None:
+        stats['distance_evaluations'] = stats.get('distance_evaluations', 0) + len(data) * k
+    return initial_index
+
+def kmeansMatrix(data, initial_index, cut_off, iterations, stats=None):
+    """
+    K-means on a float matrix (one row per point). initial_index are the rows used as initial centroids.
+    Same stopping rule as the original algorithm: stops once the biggest change in cluster centroid is lower
+    than cut_off or after iterations + 1 passes. Returns labels, centroids, number of iterations and the
+    distance of every point to its final centroid (reused by the quality metrics, see cluster_metrics.py). If
+    stats (dictionnary) is given, the number of iterations and of point to centroid distances computed are
+    added to it.
+    """
+    centroids = data[list(initial_index)].copy()
     
-    ## Book keeping for while loop
     num_iterations = 0
     biggest_change = cut_off
+    while num_iterations <= iterations and biggest_change >= cut_off:
+        labels, distances = assignPoints(data, centroids)
+        new_centroids = computeCentroids(data, labels, centroids)
+        biggest_change = np.sqrt(((new_centroids - centroids)**2).sum(axis=1)).max()
+        centroids = new_centroids
+        num_iterations += 1
     
+    diff = data - centroids[labels]
+    distances = np.sqrt(np.einsum('ij,ij->i', diff, diff))
     
-    ## Iterate through Points,  assign each point to a cluster based on euclidian distance.
-    ## Keeps iterating until either maximum of iteration is reached or biggest change in cluster
-    ## centroid is lower than cut off
+    if stats is not None:
+        stats['iterations'] = stats.get('iterations', 0) + num_iterations
+        stats['distance_evaluations'] = (stats.get('distance_evaluations', 0) +
+                                         num_iterations * len(data) * len(centroids) + len(data))
+    return labels, centroids, num_iterations, distances
+
+def kmeansHamerly(data, initial_index, cut_off, iterations, stats=None):
+    """
+    Same as kmeansMatrix() (same clusters, iterations and stopping rule) but skips the distance computations
+    that can't change the assignment of a point. Every point keeps an upper bound of the distance to its
+    centroid and a lower bound of the distance to the second closest centroid. Bounds are moved by how much the
+    centroids moved, and the distances of a point are only recomputed when its upper bound is bigger than both
+    its lower bound and half the distance between its centroid and the closest other centroid.
+    
+    Reference: Hamerly, "Making k-means even faster" (2010)
+    """
+    centroids = data[list(initial_index)].copy()
+    k = len(centroids)
+    evaluations = 0
+    
+    num_iterations = 0
+    biggest_change = cut_off
+    labels = None
     while num_iterations <= iterations and biggest_change >= cut_off:
-        new_cluster = []
-        
-        for i in range(k):
-            new_cluster.append([])
+        if labels is None: ## first pass, every distance is needed
+            distances = distanceMatrix(data, centroids)
+            evaluations += len(data) * k
+            labels = distances.argmin(axis=1)
+            upper = distances[np.arange(len(data)), labels]
+            lower = np.partition(distances, 1, axis=1)[:, 1] if k > 1 else np.full(len(data), np.inf)
+        else:
+            centroid_distances = distanceMatrix(centroids, centroids)
+            np.fill_diagonal(centroid_distances, np.inf)
+            bound = np.maximum(centroid_distances.min(axis=1)[labels] / 2, lower)
             
-        for p in points:
-            smallest_distance = p.euclidianDistance(clusters[0].getCentroid())
-            index = 0
-            for i in range(k):
-                distance = p.euclidianDistance(clusters[i].getCentroid())
-                if distance < smallest_distance:
-                    smallest_distance = distance
-                    index = i
-                    
-            new_cluster[index].append(p)
-
-        biggest_change = 0.0
-        for i in range(len(clusters)):
-            change = clusters[i].update(new_cluster[i])
-            biggest_change = max(biggest_change, change)
+            ## tighten the upper bound of the points that may change cluster
+            candidates = np.nonzero(upper > bound)[0]
+            diff = data[candidates] - centroids[labels[candidates]]
+            upper[candidates] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+            evaluations += len(candidates)
+            
+            ## recompute every distance of the points that still may change cluster
+            candidates = candidates[upper[candidates] > bound[candidates]]
+            if len(candidates):
+                distances = distanceMatrix(data[candidates], centroids)
+                evaluations += len(candidates) * k
+                labels[candidates] = distances.argmin(axis=1)
+                upper[candidates] = distances[np.arange(len(candidates)), labels[candidates]]
+                lower[candidates] = np.partition(distances, 1, axis=1)[:, 1]
         
+        new_centroids = computeCentroids(data, labels, centroids)
+        shift = np.sqrt(((new_centroids - centroids)**2).sum(axis=1))
+        biggest_change = shift.max()
+        centroids = new_centroids
         num_iterations += 1
-     
-    max_distance = 0.0
-    
-    for c in clusters:
-        for p in c.members():
-            if p.euclidianDistance(c.getCentroid()) > max_distance:
-                max_distance = p.euclidianDistance(c.getCentroid())
-                
-    ## Calculate average distance between all points and their clusters
-    cluster_total_value = 0.0
-    for c in clusters:
-        num_points = len(c.points)
-        total_value = 0.0
-        for p in c.members():
-            total_value += p.euclidianDistance(c.getCentroid())
-        cluster_total_value += total_value/num_points
-            
-    average_dist = cluster_total_value / len(clusters)
+        
+        ## the lower bound moves by the biggest shift of the other centroids
+        upper += shift[labels]
+        if k > 1:
+            order = np.argsort(shift)
+            other_shift = np.where(labels == order[-1], shift[order[-2]], shift[order[-1]])
+            lower -= other_shift
+    
+    diff = data - centroids[labels]
+    distances = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    evaluations += len(data)
+    
+    if stats is not None:
+        stats['iterations'] = stats.get('iterations', 0) + num_iterations
+        stats['distance_evaluations'] = stats.get('distance_evaluations', 0) + evaluations
+    return labels, centroids, num_iterations, distances
+
+def averageDistance(data, labels, centroids, distances=None):
+    """
+    Average over the clusters of the mean distance between the points of a cluster and its centroid (empty
+    clusters count as 0). distances (distance of every point to its centroid) is computed if not given.
+    """
+    if distances is None:
+        diff = data - centroids[labels]
+        distances = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    
+    return cluster_metrics.averageDistance(labels, distances, len(centroids))
 
+def pickInitialCentroids(data, k, init='random', rng=random, stats=None):
+    """
+    Index of the initial centroids: random.sample (init="random", original behaviour) or k-means++
+    (init="k-means++")
+    """
+    if init == 'k-means++':
+        return kmeansPlusPlus(data, k, rng, stats)
+    elif init == 'random':
+        return rng.sample(range(len(data)), k)
+    raise ValueError('init should be "random" or "k-means++", got ' + str(init))
+
+def fitKmeans(data, k, cut_off, iterations, init='random', accelerated=False, stats=None, rng=random):
+    """
+    Pick the initial centroids with rng (see pickInitialCentroids()) and run kmeansMatrix() or kmeansHamerly().
+    Returns labels, centroids and the distance of every point to its centroid.
+    """
+    initial_index = pickInitialCentroids(data, k, init, rng, stats)
+    kmeans = kmeansHamerly if accelerated else kmeansMatrix
+    labels, centroids, num_iterations, distances = kmeans(data, initial_index, cut_off, iterations, stats)
+    
+    return labels, centroids, distances
+
+def runKmeansMatrix(data, k, cut_off, iterations, init='random', accelerated=False, stats=None):
+    """
+    Runs the k-means algorithm on a float matrix (see buildMatrix()). By default initial centroids are picked
+    with random.sample, exactly like runKmeans() so both give the same clusters for the same random state.
+    init="k-means++" uses k-means++ seeding and accelerated=True skips distance computations with
+    kmeansHamerly(). If stats (dictionnary) is given, the number of iterations and of distances computed are
+    added to it. Returns labels, centroids and the average distance between points and their cluster.
+    """
+    labels, centroids, distances = fitKmeans(data, k, cut_off, iterations, init, accelerated, stats)
+    
+    return labels, centroids, averageDistance(data, labels, centroids, distances)
+
+def runKmeans(points, k, cut_off, iterations, init='random', accelerated=False, stats=None):
+    """"
+    Runs the k-means algorithm. points is a PointSet or a list of Points (converted to a PointSet) and is
+    clustered with kmeansMatrix() (see runKmeansMatrix() for init, accelerated and stats).
+    """
+    point_set = points if isinstance(points, PointSet) else PointSet.fromPoints(points)
+    labels, centroids, average_dist = runKmeansMatrix(point_set.data, k, cut_off, iterations, init, accelerated,
+                                                      stats)
+    
+    return buildClusters(point_set, labels, centroids), average_dist
+
+
+## Matrix shared with the worker processes of elbowSearch() (see attachSharedMatrix())
+_shared_data = None
+_shared_memory = None
+
+def attachSharedMatrix(name, shape, dtype):
+    """
+    Pool initializer: map the matrix stored in shared memory block "name" without copying it
+    """
+    global _shared_data, _shared_memory
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _shared_data = np.ndarray(shape, dtype=dtype, buffer=_shared_memory.buf)
+
+def runKmeansTask(task):
+    """
+    Run one k-means of elbowSearch() on the shared matrix. Initial centroids are drawn from a random generator
+    seeded for this (k, restart) only, so results do not depend on the order tasks are run in.
+    """
+    k, restart, seed, cut_off, iterations, init, accelerated = task
+    stats = {}
+    labels, centroids, distances = fitKmeans(_shared_data, k, cut_off, iterations, init, accelerated, stats,
+                                             rng=random.Random(seed))
+    
+    return (k, restart, averageDistance(_shared_data, labels, centroids, distances), labels.astype(np.int32),
+            centroids, distances, stats)
+
+def elbowSearch(data, k_values, restarts=1, cut_off=0, iterations=0, processes=None, seed=None, init='random',
+                accelerated=False, stats=None):
+    """
+    Run k-means "restarts" times for every k in k_values, in parallel over a pool of "processes" processes
+    (default to the number of cores). The matrix is put once in shared memory and mapped by every worker.
+    Returns a dictionnary k -> (average distance, labels, centroids, distances) of the best run (lowest average
+    distance). If stats (dictionnary) is given, stats[k] receives the number of iterations and of distances
+    computed by all the runs of k (see runKmeansMatrix()).
+    """
+    global _shared_data
+    
+    if seed is None:
+        seed = random.randrange(2**32)
+    tasks = [(k, restart, str(seed) + '-' + str(k) + '-' + str(restart), cut_off, iterations, init, accelerated)
+             for k in k_values for restart in range(restarts)]
+    tasks.sort(key=lambda task: -task[0]) ## biggest k first, they take longer
+    
+    best_runs = {}
+    def keepBest(result):
+        k, restart, average_dist, labels, centroids, distances, run_stats = result
+        if stats is not None:
+            k_stats = stats.setdefault(k, {})
+            for name, value in run_stats.items():
+                k_stats[name] = k_stats.get(name, 0) + value
+        if k not in best_runs or average_dist < best_runs[k][0]:
+            best_runs[k] = (average_dist, labels, centroids, distances)
+    
+    if processes == 1: ## no pool, run in this process
+        _shared_data = data
+        try:
+            for task in tasks:
+                keepBest(runKmeansTask(task))
+        finally:
+            _shared_data = None
+        return best_runs
+    
+    block = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        shared_data = np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)
+        shared_data[:] = data
+        del shared_data ## the block can't be closed while a view on it exists
+        with multiprocessing.Pool(processes, initializer=attachSharedMatrix,
+                                  initargs=(block.name, data.shape, data.dtype.str)) as pool:
+            for result in pool.imap_unordered(runKmeansTask, tasks):
+                keepBest(result)
+    finally:
+        block.close()
+        block.unlink()
+    
+    return best_runs
+
+class KmeansRunCache(object):
+    """
+    Cache of k-means runs and of their quality metrics per (k, seed) on the same data, so comparing several
+    values of k (or the same k with another metric) doesn't run k-means or compute distances again. seed is
+    used to pick the initial centroids and the silhouette sample (seed=None picks the initial centroids with
+    the random module, like runKmeansMatrix()).
+    """
     
-    return clusters, average_dist
+    def __init__(self, data, cut_off=0.0001, iterations=100, init='random', accelerated=False,
+                 silhouette_sample=5000):
+        self.data = data
+        self.cut_off = cut_off
+        self.iterations = iterations
+        self.init = init
+        self.accelerated = accelerated
+        self.silhouette_sample = silhouette_sample
+        self.runs = {}
+        self.metrics = {}
+    
+    def getRun(self, k, seed, stats=None):
+        """Return labels, centroids and distances of the run (k, seed), stats is only filled by a new run"""
+        if (k, seed) not in self.runs:
+            rng = random if seed is None else random.Random(seed)
+            self.runs[k, seed] = fitKmeans(self.data, k, self.cut_off, self.iterations, self.init,
+                                           self.accelerated, stats, rng)
+        return self.runs[k, seed]
+    
+    def addRun(self, k, seed, labels, centroids, distances):
+        """Keep a run computed elsewhere (see elbowSearch()) as the run (k, seed)"""
+        self.runs[k, seed] = (labels, centroids, distances)
+        for name in cluster_metrics.METRICS:
+            self.metrics.pop((k, seed, name), None)
+    
+    def getMetrics(self, k, seed, names=None):
+        """Return a dictionnary metric name -> value for the run (k, seed), see cluster_metrics.py"""
+        names = cluster_metrics.METRICS if names is None else names
+        missing = [name for name in names if (k, seed, name) not in self.metrics]
+        if missing:
+            labels, centroids, distances = self.getRun(k, seed)
+            values = cluster_metrics.clusterMetrics(self.data, labels, centroids, distances, missing,
+                                                    self.silhouette_sample, seed)
+            for name in missing:
+                self.metrics[k, seed, name] = values[name]
+        
+        return dict((name, self.metrics[k, seed, name]) for name in names)
+    
+    def compare(self, k_values, seed, names=None):
+        """DataFrame with one row per k and one column per metric"""
+        rows = OrderedDict((k, self.getMetrics(k, seed, names)) for k in k_values)
+        return pd.DataFrame.from_dict(rows, orient='index')
 
+def selectK(average_dist_list, threshold):
+    """
+    Index of the k picked by the stopping rule of runTestKmeans(): the first k whose average distance is less
+    than threshold below the one of the previous k (the last k if the curve never flattens)
+    """
+    for i in range(1, len(average_dist_list)):
+        if average_dist_list[i - 1] - average_dist_list[i] < threshold:
+            return i
+    
+    return len(average_dist_list) - 1
 
-def runTestKmeans(filename, k=0, cut_off=0, iterations=0, threshold=0):
+def runTestKmeans(filename, k=0, cut_off=0, iterations=0, threshold=0, k_max=None, restarts=1, processes=None,
+                  seed=None, init='random', accelerated=False, print_stats=False, dtype=np.float64, metrics=False,
+                  cache=True, cache_dir=None, output_format='xlsx', output_file=None, model_file=None):
     """
     Main function to run the k-means algorithm. Start with k=1 and run k-means algorithm until difference between average distance of point
     to their cluster is below threshold
+    
+    If k_max is set, every k from k + 1 to k_max is evaluated up front with "restarts" random initializations
+    each, in parallel over "processes" processes (see elbowSearch()). The best run of every k is kept and the
+    threshold rule is applied to the finished curve. seed makes the search reproducible.
+    
+    init="k-means++" seeds every run with k-means++ and accelerated=True uses kmeansHamerly() (see
+    runKmeansMatrix()). print_stats prints the number of iterations and of distances computed for every k (all
+    the restarts of k together when k_max is set).
+    
+    Points are stored in a PointSet of dtype (np.float32 halves the memory used by the attributs).
+    
+    metrics prints the quality metrics of every k evaluated (inertia, silhouette, etc., see cluster_metrics.py).
+    Runs and metrics go through a KmeansRunCache, so every k is run and measured once.
+    
+    The normalized attributs are cached by file content (see loadFeatureMatrix()), cache=False always parses
+    filename again.
+    
+    Clusters are written to output_file in output_format (see displayClusters()). If model_file is given, the
+    centroids and normalization values are saved to it to assign new domains later (see predict()).
     """
     
-    domains, features, column_names = openFile(filename)
-    points = buildPoints(domains, features)
+    domains, features, column_names, min_values, max_values = loadFeatureMatrix(filename, cache, cache_dir)
+    point_set = PointSet(domains, features, dtype) ## built once, shared by every run
+    data = point_set.data
     
     average_dist_list = []
-    
-    while len(average_dist_list) <= 1 or average_dist_list[-2] - average_dist_list[-1] >= threshold:
-        k += 1
-        clusters, average_dist = runKmeans(points, k, cut_off, iterations)
-        average_dist_list.append(average_dist)
+    run_cache = KmeansRunCache(data, cut_off, iterations, init, accelerated)
+    
+    if k_max is None:
+        k_values = []
+        while len(average_dist_list) <= 1 or average_dist_list[-2] - average_dist_list[-1] >= threshold:
+            k += 1
+            stats = {}
+            labels, centroids, distances = run_cache.getRun(k, seed, stats)
+            average_dist_list.append(run_cache.getMetrics(k, seed, ['average_distance'])['average_distance'])
+            k_values.append(k)
+            if print_stats:
+                print('k =', k, ':', stats['iterations'], 'iterations,', stats['distance_evaluations'],
+                      'distance evaluations')
+    else:
+        if seed is None: ## same seed for the search and the cache keys
+            seed = random.randrange(2**32)
+        k_values = list(range(k + 1, k_max + 1))
+        search_stats = {}
+        best_runs = elbowSearch(data, k_values, restarts, cut_off, iterations, processes, seed, init, accelerated,
+                                search_stats)
+        if print_stats:
+            for k in k_values:
+                print('k =', k, ':', search_stats[k]['iterations'], 'iterations,',
+                      search_stats[k]['distance_evaluations'], 'distance evaluations')
+        for k in k_values:
+            run_cache.addRun(k, seed, *best_runs[k][1:])
+        average_dist_list = [best_runs[k][0] for k in k_values]
+        labels, centroids, distances = run_cache.getRun(k_values[selectK(average_dist_list, threshold)], seed)
+    
+    if metrics:
+        print(run_cache.compare(k_values, seed))
+    
+    clusters = buildClusters(point_set, labels, centroids)
+    if model_file is not None:
+        saveModel(model_file, centroids, column_names, min_values, max_values)
     
     plt.plot(average_dist_list, '-o')
     plt.xlabel("k")
     plt.ylabel('Average Distance')
     plt.show()
-    return displayClusters(clusters, column_names)
+    return displayClusters(clusters, column_names, output_format, output_file)
     
     
     
-def displayClusters(clusters, column_names):  
+def saveModel(model_file, centroids, column_names, min_values, max_values):
     """
-    Function used to generate the excel files containing the clustered domains
+    Save what is needed to assign new domains to the clusters (see predict()) as JSON: k, the centroids,
+    the attribut names and the min / max values used to normalize them.
     """
+    model = {'k': len(centroids),
+             'column_names': [str(name) for name in column_names],
+             'centroids': np.asarray(centroids, dtype=np.float64).tolist(),
+             'min_values': [float(v) for v in min_values],
+             'max_values': [float(v) for v in max_values]}
+    with open(model_file, 'w') as f:
+        json.dump(model, f)
     
-    final_clusters = []
+    return model
 
-    for i in range(len(clusters)):
-        final_clusters.append([]) 
-        
-    for c in clusters:
-        for p in c.members():
-            final_clusters[clusters.index(c)].append((p.name, p.getAttributs()))
-        
-    for i in range(len(final_clusters)):
-        temp = OrderedDict(final_clusters[i])
-        df = pd.DataFrame.from_dict(temp, orient='index') ## convert dictionnary to a pd dataframe
+def loadModel(model_file):
+    """
+    Load a model saved by saveModel(), centroids and min / max values are numpy arrays
+    """
+    with open(model_file) as f:
+        model = json.load(f)
+    for key in ['centroids', 'min_values', 'max_values']:
+        model[key] = np.array(model[key], dtype=np.float64)
+    
+    return model
 
-        ## Calculate mean value for the cluster and add them at bottom of group
-        mean_values = pd.Series(df.mean())
-        df.loc["MEAN"] = mean_values    
-        df.columns = [column_names]
+def predict(filename, model, chunk_size = 100000, output_file = None):
+    """
+    Assign every domain of filename (same format as clustering_template.csv) to the closest centroid of model
+    (dictionnary returned by loadModel() or path of a model file) without training again. Attributs are
+    normalized with the min / max values of the model, so new domains may fall outside [0, 1]. Distances are
+    computed chunk_size domains at a time.
+    
+    Returns a DataFrame DOMAINS, CLUSTER, DISTANCE, also written to output_file (csv) if given.
+    """
+    if not isinstance(model, dict):
+        model = loadModel(model)
+    
+    df, len_init = aggregateFile(filename)
+    missing = [name for name in model['column_names'] if name not in df.columns.values]
+    if missing:
+        raise ValueError('Attributs of the model missing from ' + filename + ': ' + ', '.join(missing))
+    
+    data = ((df[model['column_names']].values - model['min_values']) /
+            (model['max_values'] - model['min_values']))
+    labels = np.empty(len(data), dtype=np.int32)
+    distances = np.empty(len(data))
+    for start in range(0, len(data), chunk_size):
+        labels[start:start + chunk_size], distances[start:start + chunk_size] = assignPoints(
+            data[start:start + chunk_size], model['centroids'])
+    
+    result = pd.DataFrame({'DOMAINS': df['DOMAINS'].values, 'CLUSTER': labels, 'DISTANCE': distances})
+    if output_file is not None:
+        result.to_csv(output_file, index=False)
+    
+    return result
 
-        df_description = df.describe() ## create dataframe containing a description of the cluster dataframe
-        
-        ## Create a new file and write new sheets
-        writer = pd.ExcelWriter('domains_cluster_' + str(i) + '.xls')
-        df.to_excel(writer, "Domains_Group")
-        df_description.to_excel(writer, "Group_Summary")
-        writer.save()
+EXPORT_FORMATS = ['xlsx', 'parquet', 'csv']
+EXCEL_MAX_ROWS = 1048576
+
+def clusterFrame(clusters, column_names):
+    """
+    One DataFrame of every clustered domain (index DOMAINS) with its CLUSTER number and attributs, the domains
+    of cluster 0 first, then cluster 1, etc. (clusters are views over the same PointSet, see buildClusters())
+    """
+    point_set = clusters[0].point_set
+    indices = np.concatenate([c.indices for c in clusters])
+    labels = np.repeat(np.arange(len(clusters), dtype=np.int32), [len(c) for c in clusters])
     
+    df = pd.DataFrame(point_set.data[indices], index=pd.Index(point_set.names[indices], name='DOMAINS'),
+                      columns=[str(name) for name in column_names])
+    df.insert(loc=0, column='CLUSTER', value=labels)
+    return df
 
+def summarizeClusters(df):
+    """
+    Description of every cluster (same statistics as DataFrame.describe()) computed on the whole frame with
+    one groupby: one row per (CLUSTER, STATISTIC), one column per attribut
+    """
+    grouped = df.groupby('CLUSTER')[list(df.columns[1:])]
+    statistics = OrderedDict([('count', grouped.count()), ('mean', grouped.mean()), ('std', grouped.std()),
+                              ('min', grouped.min()), ('25%', grouped.quantile(0.25)), ('50%', grouped.median()),
+                              ('75%', grouped.quantile(0.75)), ('max', grouped.max())])
+    summary = pd.concat(statistics, names=['STATISTIC']).swaplevel(0, 1)
+    return summary.sort_index(level=0, kind='mergesort', sort_remaining=False)
+
+def displayClusters(clusters, column_names, output_format = 'xlsx', output_file = None):  
+    """
+    Function used to generate the file(s) containing the clustered domains
+    -----
+    
+    output_format --> default to "xlsx", one workbook with a sheet per cluster (Domains_Group_<i>: its domains
+                      and a MEAN row) and a Group_Summary sheet with the description of every cluster. "parquet"
+                      or "csv" write every domain with a CLUSTER column to a single file and the descriptions to
+                      <name>_summary.<format>
+    output_file --> default to domains_clusters.<output_format>
+    """
+    if output_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown output format ' + str(output_format) + ', expected one of ' +
+                         ', '.join(EXPORT_FORMATS))
+    if output_file is None:
+        output_file = 'domains_clusters.' + output_format
+    
+    df = clusterFrame(clusters, column_names)
+    summary = summarizeClusters(df)
+    
+    if output_format == 'xlsx':
+        sizes = [len(c) for c in clusters]
+        if max(sizes) + 2 > EXCEL_MAX_ROWS:
+            raise ValueError('A cluster has more domains than an Excel sheet can hold, use "parquet" or "csv"')
+        
+        with pd.ExcelWriter(output_file) as writer:
+            start = 0
+            for i, size in enumerate(sizes):
+                ## clusters are contiguous in df, add the mean of the cluster at the bottom of its domains
+                cluster_df = df.iloc[start:start + size, 1:]
+                mean_values = summary.loc[(i, 'mean')] if size else pd.Series(np.nan, index=cluster_df.columns)
+                cluster_df = pd.concat([cluster_df, pd.DataFrame([mean_values.values], index=['MEAN'],
+                                                                 columns=cluster_df.columns)])
+                cluster_df.to_excel(writer, sheet_name='Domains_Group_' + str(i))
+                start += size
+            summary.to_excel(writer, sheet_name='Group_Summary')
+    else:
+        base, extension = os.path.splitext(output_file)
+        summary_file = base + '_summary' + extension
+        if output_format == 'parquet':
+            df.reset_index().to_parquet(output_file, index=False)
+            summary.reset_index().to_parquet(summary_file, index=False)
+        else:
+            df.to_csv(output_file)
+            summary.to_csv(summary_file)
+    
     return "Your file(s) ha(s)(ve) been succesfuly generated" 
                     
 
-print(runTestKmeans('clustering_template.csv', k=0, cut_off=0.0001, iterations=100, threshold=0.05))
+if __name__ == '__main__':
+    print(runTestKmeans('clustering_template.csv', k=0, cut_off=0.0001, iterations=100, threshold=0.05))
 
 
 
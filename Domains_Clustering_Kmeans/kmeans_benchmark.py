@@ -0,0 +1,187 @@
+"""
+K-MEANS BENCHMARK
+=================
+
+Author: Teddy Crepineau
+
+Purpose: compare the vectorized k-means (runKmeans() in domains_performance_clustering.py) with the original
+pure Python implementation (kept below as legacyRunKmeans() and LegacyCluster) on synthetic domain data. Both are run from the
+same random state and must return the same clusters and average distance.
+
+With --seeding, random / k-means++ seeding and the plain / accelerated (Hamerly) assignment are compared instead:
+time, number of iterations and number of point to centroid distances computed.
+
+Usage: python kmeans_benchmark.py --points 20000 --dimensions 8 --k 5
+       python kmeans_benchmark.py --points 200000 --k 8 --seeding
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+import domains_performance_clustering as kmeans
+
+
+def generateDomains(num_points, dimensions, centers=5, seed=0):
+    """
+    Return domain names and normalized attributs (values in [0, 1]) drawn around "centers" random centers
+    """
+    rng = np.random.RandomState(seed)
+    center_values = rng.uniform(0.2, 0.8, size=(centers, dimensions))
+    attributs = center_values[rng.randint(centers, size=num_points)] + rng.normal(0, 0.08, (num_points, dimensions))
+    attributs = np.clip(attributs, 0.0, 1.0)
+    names = ['domain' + str(i) + '.com' for i in range(num_points)]
+
+    return names, [list(row) for row in attributs]
+
+
+class LegacyCluster(object):
+    """
+    Original Cluster class (list of Points objects)
+    """
+
+    def __init__(self, points):
+        self.points = points
+        self.centroid = self.computeCentroid()
+
+    def computeCentroid(self):
+        total_value = np.zeros(self.points[0].dimensionality())
+        for p in self.points:
+            total_value += p.getAttributs()
+        return kmeans.Points('mean', total_value / len(self.points))
+
+    def getCentroid(self):
+        return self.centroid
+
+    def update(self, points):
+        old_centroid = self.getCentroid()
+        self.points = points
+        if len(self.points) > 0:
+            self.centroid = self.computeCentroid()
+            return old_centroid.euclidianDistance(self.centroid)
+        else:
+            return 0.0
+
+    def members(self):
+        for p in self.points:
+            yield p
+
+    def __str__(self):
+        return ','.join(sorted(p.getName() for p in self.points))
+
+
+def legacyRunKmeans(points, k, cut_off, iterations):
+    """
+    Original implementation of runKmeans() (Python loop over every point and centroid)
+    """
+    initial_centroid = random.sample(points, k)
+    clusters = [LegacyCluster([p]) for p in initial_centroid]
+
+    num_iterations = 0
+    biggest_change = cut_off
+    while num_iterations <= iterations and biggest_change >= cut_off:
+        new_cluster = [[] for i in range(k)]
+        for p in points:
+            smallest_distance = p.euclidianDistance(clusters[0].getCentroid())
+            index = 0
+            for i in range(k):
+                distance = p.euclidianDistance(clusters[i].getCentroid())
+                if distance < smallest_distance:
+                    smallest_distance = distance
+                    index = i
+            new_cluster[index].append(p)
+
+        biggest_change = 0.0
+        for i in range(len(clusters)):
+            biggest_change = max(biggest_change, clusters[i].update(new_cluster[i]))
+        num_iterations += 1
+
+    cluster_total_value = 0.0
+    for c in clusters:
+        total_value = 0.0
+        for p in c.members():
+            total_value += p.euclidianDistance(c.getCentroid())
+        cluster_total_value += total_value / len(c.points)
+
+    return clusters, cluster_total_value / len(clusters)
+
+
+def sameClusters(clusters_a, clusters_b):
+    return [str(c) for c in clusters_a] == [str(c) for c in clusters_b]
+
+
+def timeRun(function, points, k, cut_off, iterations, seed):
+    random.seed(seed)
+    start = time.time()
+    clusters, average_dist = function(points, k, cut_off, iterations)
+    return time.time() - start, clusters, average_dist
+
+
+def runBenchmark(num_points=20000, dimensions=8, k=5, cut_off=0.0001, iterations=100, seed=0, legacy=True):
+    names, attributs = generateDomains(num_points, dimensions, seed=seed)
+    points = kmeans.buildPoints(names, attributs)
+
+    report = []
+    elapsed, clusters, average_dist = timeRun(kmeans.runKmeans, points, k, cut_off, iterations, seed)
+    report.append(('vectorized', elapsed, average_dist))
+
+    if legacy:
+        legacy_elapsed, legacy_clusters, legacy_average_dist = timeRun(legacyRunKmeans, points, k, cut_off,
+                                                                       iterations, seed)
+        report.append(('legacy', legacy_elapsed, legacy_average_dist))
+
+    for mode, mode_elapsed, mode_average_dist in report:
+        print(mode, ':', round(mode_elapsed, 3), 's, average distance', round(mode_average_dist, 6))
+    if legacy:
+        print('Speedup:', round(legacy_elapsed / elapsed, 1), 'x, same clusters:',
+              sameClusters(clusters, legacy_clusters), ', same average distance:',
+              bool(np.isclose(average_dist, legacy_average_dist)))
+
+    return report
+
+
+def runSeedingBenchmark(num_points=200000, dimensions=8, k=8, cut_off=0.0001, iterations=100, seed=0, centers=8):
+    names, attributs = generateDomains(num_points, dimensions, centers, seed)
+    data = np.array(attributs)
+
+    report = []
+    labels = {}
+    for init in ['random', 'k-means++']:
+        for accelerated in [False, True]:
+            stats = {}
+            random.seed(seed)
+            start = time.time()
+            labels[init, accelerated], centroids, average_dist = kmeans.runKmeansMatrix(data, k, cut_off, iterations,
+                                                                                         init, accelerated, stats)
+            report.append((init, accelerated, time.time() - start, stats['iterations'],
+                           stats['distance_evaluations'], average_dist))
+
+    for init, accelerated, elapsed, num_iterations, evaluations, average_dist in report:
+        print(init, '+ hamerly' if accelerated else '', ':', round(elapsed, 3), 's,', num_iterations, 'iterations,',
+              evaluations, 'distance evaluations, average distance', round(average_dist, 6))
+    for init in ['random', 'k-means++']:
+        print(init, ': same clusters with and without bounds:',
+              bool((labels[init, False] == labels[init, True]).all()))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the vectorized k-means against the original one')
+    parser.add_argument('--points', type=int, default=20000)
+    parser.add_argument('--dimensions', type=int, default=8)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--cut-off', type=float, default=0.0001)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-legacy', action='store_true', help='only time the vectorized version')
+    parser.add_argument('--seeding', action='store_true', help='compare seeding and accelerated assignment')
+    args = parser.parse_args()
+
+    if args.seeding:
+        runSeedingBenchmark(args.points, args.dimensions, args.k, args.cut_off, args.iterations, args.seed)
+    else:
+        runBenchmark(args.points, args.dimensions, args.k, args.cut_off, args.iterations, args.seed,
+                     not args.skip_legacy)
@@ -0,0 +1,224 @@
+"""
+MINI-BATCH K-MEANS OF DOMAINS
+=============================
+
+Author: Teddy Crepineau
+
+Purpose: cluster domain exports that don't fit in memory. Same input file, ratio attributs (BLOCK %, IN-VIEW %,
+etc.) and min/max normalization as domains_performance_clustering.py, but the data is never loaded at once:
+
+   1) the file is read in chunks and its rows are split in "partitions" files by hash of the domain, so all
+      the rows of a domain end up in the same partition (duplicate domains are added together, as openFile()
+      does, even when they are far apart in the file)
+   2) each partition is aggregated by domain, ratio attributs are computed and stored as a .npy matrix, and
+      the min/max of every attribut is updated
+   3) centroids are updated batch after batch (mini-batch k-means, every centroid moves toward the mean of
+      its points in the batch with a learning rate of 1 / number of points it has received)
+   4) a last pass assigns every domain to its closest centroid and writes the result to a csv file
+
+Memory only depends on chunksize, batch_size and the size of a partition (about number of domains / partitions).
+
+Reference: Sculley, "Web-Scale K-Means Clustering" (2010)
+
+Usage: python minibatch_kmeans.py monthly_export.csv --k 8 --batch-size 10000 --epochs 3 --model model.json
+
+The model (see saveModel() in domains_performance_clustering.py) can then assign new domains with predict().
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from domains_performance_clustering import addRatioColumns, assignPoints, computeCentroids, saveModel
+
+
+def partitionFile(filename, work_dir, partitions=64, chunksize=100000):
+    """
+    Split the rows of filename in "partitions" csv files by hash of the domain. Rows are summed by domain inside
+    every chunk first to reduce the size of the partitions. Returns the list of partition files.
+    """
+    partition_files = [os.path.join(work_dir, 'partition_' + str(i) + '.csv') for i in range(partitions)]
+
+    for chunk in pd.read_csv(filename, chunksize=chunksize):
+        chunk = chunk.groupby('DOMAINS', as_index=False).sum()
+        partition = pd.util.hash_pandas_object(chunk['DOMAINS'], index=False).values % partitions
+        for i, rows in chunk.groupby(partition):
+            rows.to_csv(partition_files[i], mode='a', header=not os.path.exists(partition_files[i]), index=False)
+
+    return [f for f in partition_files if os.path.exists(f)]
+
+def buildFeatures(partition_files):
+    """
+    Aggregate every partition by domain and compute the ratio attributs. The attributs of partition i are saved
+    in features_i.npy (one row per domain) and its domains in domains_i.txt, partition files are deleted.
+    Returns the list of (domains file, features file), the attribut names and their min / max values.
+    """
+    feature_files = []
+    column_names = None
+    min_values = None
+    max_values = None
+
+    for partition_file in partition_files:
+        df = pd.read_csv(partition_file).groupby('DOMAINS', as_index=False).sum() ## add duplicate domains together
+        names = addRatioColumns(df)
+        df = df.dropna()
+        column_names = names
+
+        features = np.ascontiguousarray(df[names].values, dtype=np.float64)
+        directory, name = os.path.split(partition_file)
+        partition = name[len('partition_'):-len('.csv')]
+        domains_file = os.path.join(directory, 'domains_' + partition + '.txt')
+        features_file = os.path.join(directory, 'features_' + partition + '.npy')
+        np.save(features_file, features)
+        with open(domains_file, 'w') as f:
+            f.write(''.join(str(d) + '\n' for d in df['DOMAINS']))
+        feature_files.append((domains_file, features_file))
+        os.remove(partition_file)
+
+        if len(features):
+            min_values = features.min(axis=0) if min_values is None else np.minimum(min_values, features.min(axis=0))
+            max_values = features.max(axis=0) if max_values is None else np.maximum(max_values, features.max(axis=0))
+
+    return feature_files, column_names, min_values, max_values
+
+def iterBatches(feature_files, batch_size, min_values, max_values, rng=None):
+    """
+    Yield (index of the feature file, normalized batch) for every batch of batch_size domains. Feature files are
+    memory mapped and visited in a random order if rng (random.Random) is given.
+    """
+    order = list(range(len(feature_files)))
+    if rng is not None:
+        rng.shuffle(order)
+
+    for i in order:
+        features = np.load(feature_files[i][1], mmap_mode='r')
+        for start in range(0, len(features), batch_size):
+            yield i, (features[start:start + batch_size] - min_values) / (max_values - min_values)
+
+def miniBatchUpdate(batch, centroids, counts):
+    """
+    Move every centroid toward the mean of the points of the batch assigned to it. counts (number of points
+    received by every centroid so far) is updated in place. Returns the new centroids.
+    """
+    labels, distances = assignPoints(batch, centroids)
+    batch_counts = np.bincount(labels, minlength=len(centroids))
+    batch_means = computeCentroids(batch, labels, centroids)
+
+    counts += batch_counts
+    not_empty = batch_counts > 0
+    learning_rate = (batch_counts[not_empty] / counts[not_empty])[:, None]
+    new_centroids = centroids.copy()
+    new_centroids[not_empty] += learning_rate * (batch_means[not_empty] - centroids[not_empty])
+
+    return new_centroids
+
+def assignFile(feature_files, centroids, min_values, max_values, column_names, batch_size, output_file):
+    """
+    Assign every domain to its closest centroid and write DOMAINS, CLUSTER and the normalized attributs to
+    output_file. Returns the average distance between the points and their cluster (see averageDistance()).
+    """
+    k = len(centroids)
+    counts = np.zeros(k)
+    totals = np.zeros(k)
+    header = True
+
+    for domains_file, features_file in feature_files:
+        with open(domains_file) as f:
+            domains = f.read().splitlines()
+        start = 0
+        for i, batch in iterBatches([(domains_file, features_file)], batch_size, min_values, max_values):
+            labels, distances = assignPoints(batch, centroids)
+            counts += np.bincount(labels, minlength=k)
+            totals += np.bincount(labels, weights=distances, minlength=k)
+
+            df = pd.DataFrame(batch, columns=column_names)
+            df.insert(loc=0, column='CLUSTER', value=labels)
+            df.insert(loc=0, column='DOMAINS', value=domains[start:start + len(batch)])
+            df.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            start += len(batch)
+
+    return float((totals[counts > 0] / counts[counts > 0]).sum() / k)
+
+def runMiniBatchKmeans(filename, k, batch_size=10000, epochs=3, cut_off=0.0001, partitions=64, chunksize=100000,
+                       output_file='domains_clusters.csv', seed=None, work_dir=None):
+    """
+    Mini-batch k-means on filename (same format as clustering_template.csv). Initial centroids are picked
+    randomly in the first batch. Stops after "epochs" passes over the data or once the biggest change in
+    cluster centroid during a pass is lower than cut_off. Every domain and its cluster are written to
+    output_file.
+    -----
+
+    batch_size --> default to 10,000 domains
+    epochs --> default to 3
+    cut_off --> default to 0.0001
+    partitions --> default to 64 (number of temporary files the input file is split in)
+    chunksize --> default to 100,000 rows read at a time
+    work_dir --> default to None (temporary directory, deleted at the end)
+
+    Returns the centroids, the attribut names, their min / max values and the average distance between the
+    points and their cluster.
+    """
+    rng = random.Random(seed)
+    cleanup = work_dir is None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='minibatch_kmeans_')
+
+    try:
+        partition_files = partitionFile(filename, work_dir, partitions, chunksize)
+        feature_files, column_names, min_values, max_values = buildFeatures(partition_files)
+        if min_values is None:
+            raise ValueError('No domain to cluster in ' + filename)
+
+        centroids = None
+        counts = np.zeros(k)
+        for epoch in range(epochs):
+            epoch_start = None
+            for i, batch in iterBatches(feature_files, batch_size, min_values, max_values, rng):
+                if centroids is None:
+                    if len(batch) < k:
+                        raise ValueError('The first batch has less than k domains, increase batch_size')
+                    centroids = batch[rng.sample(range(len(batch)), k)].copy()
+                if epoch_start is None:
+                    epoch_start = centroids
+                centroids = miniBatchUpdate(batch, centroids, counts)
+
+            biggest_change = np.sqrt(((centroids - epoch_start)**2).sum(axis=1)).max()
+            if biggest_change < cut_off:
+                break
+
+        average_dist = assignFile(feature_files, centroids, min_values, max_values, column_names, batch_size,
+                                  output_file)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return centroids, column_names, min_values, max_values, average_dist
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mini-batch k-means of domains for files that do not fit in memory')
+    parser.add_argument('file', help='csv file in the format of clustering_template.csv')
+    parser.add_argument('--k', type=int, required=True)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--cut-off', type=float, default=0.0001)
+    parser.add_argument('--partitions', type=int, default=64)
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--output', default='domains_clusters.csv')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--model', default=None, help='save the centroids and normalization values to this file')
+    args = parser.parse_args()
+
+    centroids, column_names, min_values, max_values, average_dist = runMiniBatchKmeans(
+        args.file, args.k, args.batch_size, args.epochs, args.cut_off, args.partitions, args.chunksize, args.output,
+        args.seed)
+    if args.model is not None:
+        saveModel(args.model, centroids, column_names, min_values, max_values)
+    print('Average distance:', round(average_dist, 6))
+    print(pd.DataFrame(centroids, columns=column_names))
@@ -0,0 +1,178 @@
+"""
+BID LOG LOADER BENCHMARK
+========================
+
+Author: Teddy Crepineau
+
+Purpose: compare the chunked columnar loader (iterBidChunks() / loadBidColumns() in clearing_win_price_ratio.py)
+with the original readlines() loader (kept below as legacyLoadDataFile()) on a generated bid log, and with the
+raw speed of reading the file. Both loaders must return the same bids.
+
+With --monitor, a log where one exchange switches to first price auctions halfway is replayed through the rolling
+window monitor (auctionMonitor) instead: replay speed and alerts raised.
+
+Usage: python bid_log_benchmark.py --rows 2000000 --exchanges 12
+       python bid_log_benchmark.py --rows 50000000 --skip-legacy
+       python bid_log_benchmark.py --rows 5000000 --monitor
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+import clearing_win_price_ratio as auction
+
+
+def generateBidLog(filename, num_rows, exchanges=12, higher_bound_bid=4.0, seed=0, chunk_size=1000000,
+                   switch_exchange=None, switch_at=0.5):
+    """
+    Write num_rows random bids in the format of loadDataFile() (with a header row). Clearing prices are drawn
+    uniformly below the max bid, like generateRandomTest(). From row switch_at * num_rows, exchange number
+    switch_exchange (if given) clears at 90 to 100% of the max bid, as a first price auction would.
+    """
+    rng = np.random.RandomState(seed)
+    exchange_names = np.array(['exchange_' + str(i) for i in range(exchanges)])
+
+    with open(filename, 'w') as f:
+        f.write(','.join(auction.BID_COLUMNS) + '\n')
+        for start in range(0, num_rows, chunk_size):
+            size = min(chunk_size, num_rows - start)
+            max_bid = np.round(rng.uniform(0.02, higher_bound_bid, size), 2)
+            cost = rng.uniform(0.01, max_bid)
+            exchange_codes = rng.randint(exchanges, size=size)
+            if switch_exchange is not None:
+                switched = ((exchange_codes == switch_exchange) &
+                            (np.arange(start, start + size) >= switch_at * num_rows))
+                cost[switched] = max_bid[switched] * rng.uniform(0.9, 1.0, switched.sum())
+            cost = np.round(cost, 2)
+            pd.DataFrame({'bid_id': np.arange(start, start + size),
+                          'exchange': exchange_names[exchange_codes],
+                          'impressions': rng.geometric(0.3, size),
+                          'cost': cost,
+                          'max_bid_ui': max_bid}).to_csv(f, header=False, index=False)
+
+    return filename
+
+
+def legacyLoadDataFile(filename):
+    """
+    Original implementation of loadDataFile() (whole file read with readlines())
+    """
+    exchange_data_info = defaultdict(list)
+    inputFile = open(filename)
+    for line in inputFile.readlines()[1:]:
+        xid, exchange, impressions, cost, max_bid_ui = line.split(',')
+        exchange_data_info[exchange].append((int(impressions), float(cost), float(max_bid_ui)))
+
+    return exchange_data_info
+
+
+def rawRead(filename, block_size=16 << 20):
+    """Read the file without parsing it, the best any loader can do"""
+    with open(filename, 'rb') as f:
+        while f.read(block_size):
+            pass
+
+
+def streamBids(filename, chunk_size):
+    rows = 0
+    for chunk in auction.iterBidChunks(filename, chunk_size):
+        rows += len(chunk)
+    return rows
+
+
+def timeRun(function, *args):
+    tracemalloc.start()
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def runBenchmark(num_rows=2000000, exchanges=12, chunk_size=auction.CHUNK_SIZE, seed=0, legacy=True,
+                 filename=None):
+    cleanup = filename is None
+    if filename is None:
+        filename = os.path.join(tempfile.mkdtemp(prefix='bid_log_'), 'bids.txt')
+    if not os.path.exists(filename):
+        generateBidLog(filename, num_rows, exchanges, seed=seed)
+    size_mb = os.path.getsize(filename) / 1e6
+
+    try:
+        report = []
+        ## time is measured without tracemalloc for the raw read, tracing would only slow Python allocations
+        start = time.time()
+        rawRead(filename)
+        report.append(('raw read', time.time() - start, None))
+        elapsed, peak, rows = timeRun(streamBids, filename, chunk_size)
+        report.append(('iterBidChunks', elapsed, peak))
+        elapsed, peak, columns = timeRun(auction.loadBidColumns, filename, chunk_size)
+        report.append(('loadBidColumns', elapsed, peak))
+        if legacy:
+            elapsed, peak, legacy_data = timeRun(legacyLoadDataFile, filename)
+            report.append(('legacy readlines', elapsed, peak))
+
+        print(rows, 'bids,', round(size_mb, 1), 'MB')
+        for mode, elapsed, peak in report:
+            print(mode, ':', round(elapsed, 3), 's,', round(size_mb / elapsed, 1), 'MB/s',
+                  '' if peak is None else ', peak traced memory ' + str(round(peak / 1e6, 1)) + ' MB')
+        if legacy:
+            print('Speedup:', round(report[-1][1] / report[2][1], 1), 'x, same bids:',
+                  auction.loadDataFile(filename) == legacy_data)
+    finally:
+        if cleanup:
+            os.remove(filename)
+            os.rmdir(os.path.dirname(filename))
+
+    return report
+
+
+def runMonitorReplay(num_rows=5000000, exchanges=12, bids_per_second=100.0, window=3600.0, seed=0):
+    """
+    Replay a log where exchange_0 switches to first price auctions halfway through the monitor and print the
+    alerts. The switch happens at num_rows / (2 * bids_per_second) seconds.
+    """
+    directory = tempfile.mkdtemp(prefix='bid_log_')
+    filename = os.path.join(directory, 'bids.txt')
+    try:
+        generateBidLog(filename, num_rows, exchanges, seed=seed, switch_exchange=0)
+        monitor = auction.auctionMonitor(window=window, cadence=window / 4, on_alert=lambda alert: None)
+        start = time.time()
+        auction.replayLog(filename, monitor, bids_per_second)
+        elapsed = time.time() - start
+    finally:
+        os.remove(filename)
+        os.rmdir(directory)
+
+    print(num_rows, 'bids replayed in', round(elapsed, 3), 's (', round(num_rows / elapsed), 'bids/s ),',
+          round(num_rows / bids_per_second / 3600, 1), 'hours of bids,', len(monitor.reports), 'reports')
+    print('switch at', num_rows / (2 * bids_per_second), 's')
+    for alert in monitor.getAlerts():
+        print('alert at', alert['time'], 's:', alert['exchange'], 'divergence', round(alert['divergence'], 3))
+
+    return monitor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the chunked bid log loader against the original one')
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--exchanges', type=int, default=12)
+    parser.add_argument('--chunk-size', type=int, default=auction.CHUNK_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--file', default=None, help='bid log to use (generated if it does not exist)')
+    parser.add_argument('--skip-legacy', action='store_true', help='only time the chunked loader')
+    parser.add_argument('--monitor', action='store_true', help='replay a log through the rolling window monitor')
+    args = parser.parse_args()
+
+    if args.monitor:
+        runMonitorReplay(args.rows, args.exchanges, seed=args.seed)
+    else:
+        runBenchmark(args.rows, args.exchanges, args.chunk_size, args.seed, not args.skip_legacy, args.file)
@@ -20,19 +20,133 @@ are 400), and a the minimum possibility of bids (i.e 0.01).
 File format: File is of extension .txt and data are structured in the following way:
    - bid ID (integer), Exchange (String), impressions (integer), clearing price (float), max bid submitted (float) 
 
+Large files are read in chunks of rows into typed columns (see iterBidChunks() and bidColumns), so memory only
+depends on the chunk size.
+
 """
 
 import matplotlib.pyplot as plt
-from collections import defaultdict
-import random as rd
+import argparse
+from collections import defaultdict, deque
+import json
+import multiprocessing
+import time
 import numpy as np
+import pandas as pd
 from scipy.stats import chisquare
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError: ## files are parsed with pandas instead (about 1.5x slower)
+    pa = None
 
 IMPRESSIONS = 0
 COST = 1
 MAX_BID_UI = 2
 RATIO = 3
 
+BID_COLUMNS = ['bid_id', 'exchange', 'impressions', 'cost', 'max_bid_ui']
+CHUNK_SIZE = 1000000 ## rows parsed at a time
+ROW_BYTES = 32 ## approximate size of a row, to convert CHUNK_SIZE in bytes for pyarrow
+
+
+class bidColumns(object):
+    """Bids stored as typed columns: exchange code (int32, index in exchanges), impressions (int32), cost and
+    max_bid_ui (float32 by default). About 16 bytes per bid instead of a tuple of Python objects."""
+    
+    def __init__(self, exchanges, exchange_codes, impressions, cost, max_bid_ui):
+        self.exchanges = exchanges
+        self.exchange_codes = exchange_codes
+        self.impressions = impressions
+        self.cost = cost
+        self.max_bid_ui = max_bid_ui
+    
+    def getExchanges(self):
+        return self.exchanges
+    
+    def __len__(self):
+        return len(self.exchange_codes)
+    
+    ##Convert to the dictionnary returned by loadDataFile(): exchange -> list of (impressions, cost, max_bid_ui)
+    def toDict(self):
+        exchange_data_info = defaultdict(list)
+        rows = zip(self.exchange_codes.tolist(), self.impressions.tolist(), self.cost.tolist(),
+                   self.max_bid_ui.tolist())
+        for code, impressions, cost, max_bid_ui in rows:
+            exchange_data_info[self.exchanges[code]].append((impressions, cost, max_bid_ui))
+        
+        return exchange_data_info
+    
+    ##Split the bids by exchange: dictionnary exchange -> bidColumns of its bids, in the order of loadDataFile()
+    def byExchange(self):
+        order = np.argsort(self.exchange_codes, kind='stable')
+        bounds = np.searchsorted(self.exchange_codes[order], np.arange(len(self.exchanges) + 1))
+        exchange_columns = {}
+        for code, exchange in enumerate(self.exchanges):
+            rows = order[bounds[code]:bounds[code + 1]]
+            if len(rows):
+                exchange_columns[exchange] = bidColumns([exchange], np.zeros(len(rows), dtype=np.int32),
+                                                        self.impressions[rows], self.cost[rows],
+                                                        self.max_bid_ui[rows])
+        
+        return exchange_columns
+
+
+def readChunks(filename, chunk_size, float_dtype):
+    """Yield (exchange names, exchange codes, impressions, cost, max_bid_ui) for every chunk of about chunk_size
+    rows of filename. Codes are indexes in the exchange names of the chunk."""
+    if pa is not None:
+        reader = pa_csv.open_csv(filename,
+                                 read_options=pa_csv.ReadOptions(column_names=BID_COLUMNS, skip_rows=1,
+                                                                 block_size=max(chunk_size * ROW_BYTES, 1 << 20),
+                                                                 use_threads=False),
+                                 convert_options=pa_csv.ConvertOptions(
+                                     include_columns=BID_COLUMNS[1:],
+                                     column_types={'exchange': pa.dictionary(pa.int32(), pa.string()),
+                                                   'impressions': pa.int32(),
+                                                   'cost': pa.from_numpy_dtype(float_dtype),
+                                                   'max_bid_ui': pa.from_numpy_dtype(float_dtype)}))
+        for batch in reader:
+            exchange = batch.column(0)
+            yield (exchange.dictionary.to_pylist(), exchange.indices.to_numpy(),
+                   batch.column(1).to_numpy(), batch.column(2).to_numpy(), batch.column(3).to_numpy())
+    else:
+        reader = pd.read_csv(filename, header=0, names=BID_COLUMNS, usecols=BID_COLUMNS[1:], na_filter=False,
+                             dtype={'exchange': 'category', 'impressions': np.int32, 'cost': float_dtype,
+                                    'max_bid_ui': float_dtype}, chunksize=chunk_size)
+        with reader:
+            for chunk in reader:
+                yield (list(chunk['exchange'].cat.categories), chunk['exchange'].cat.codes.values,
+                       chunk['impressions'].values, chunk['cost'].values, chunk['max_bid_ui'].values)
+
+
+def iterBidChunks(filename, chunk_size = CHUNK_SIZE, float_dtype = np.float32):
+    """Parse filename about chunk_size rows at a time and yield a bidColumns per chunk. Exchange codes are the
+    same in every chunk: the exchanges list is shared by all the chunks and grows as new exchanges are found.
+    """
+    exchanges = []
+    exchange_index = {}
+    for names, codes, impressions, cost, max_bid_ui in readChunks(filename, chunk_size, float_dtype):
+        ##Map the codes of the chunk to the codes of the whole file (few exchanges, so this is cheap)
+        mapping = np.array([exchange_index.setdefault(e, len(exchange_index)) for e in names], dtype=np.int32)
+        exchanges.extend(list(exchange_index)[len(exchanges):]) ## new exchanges, in order of their code
+        
+        yield bidColumns(exchanges, mapping[codes], impressions, cost, max_bid_ui)
+
+
+def loadBidColumns(filename, chunk_size = CHUNK_SIZE, float_dtype = np.float32):
+    """Load the whole file as one bidColumns (see iterBidChunks())"""
+    chunks = list(iterBidChunks(filename, chunk_size, float_dtype))
+    if not chunks:
+        empty_float = np.array([], dtype=float_dtype)
+        return bidColumns([], np.array([], dtype=np.int32), np.array([], dtype=np.int32), empty_float, empty_float)
+    
+    return bidColumns(chunks[-1].exchanges,
+                      np.concatenate([c.exchange_codes for c in chunks]),
+                      np.concatenate([c.impressions for c in chunks]),
+                      np.concatenate([c.cost for c in chunks]),
+                      np.concatenate([c.max_bid_ui for c in chunks]))
+
 
 def loadDataFile(filename):
     """Return a dictionnary mapping every instance of exchange to (impressions, cost, max_bid_ui), where
@@ -40,13 +154,7 @@ def loadDataFile(filename):
     in a tuple. Each line in the file represent a specific instance of an impression occurring occuring in an exchange
     """
     
-    exchange_data_info = defaultdict(list)
-    inputFile = open(filename)
-    for line in inputFile.readlines()[1:]: #[1:] Skips header row
-        xid, exchange, impressions, cost, max_bid_ui = line.split(',')
-        exchange_data_info[exchange].append((int(impressions), float(cost),float(max_bid_ui)))
-    
-    return exchange_data_info
+    return loadBidColumns(filename, float_dtype=np.float64).toDict()
 
 
 class noExchange(Exception):
@@ -78,43 +186,82 @@ class pickExchange(object):
     ##Iterate through data list and add key corresponding to SSP chosen to new dict. {filtered_data_list}
     ##k = keys in dict. (i.e exchanges) & v = values in dict. (i.e a tuple of (impressions,cost,max_bid_uI))
     def filterExchange(self):
-        for k, v in self.data_list.items():
-            if self.exchange == None:
-                return self.data_list
+        if self.exchange == None:
+            return self.data_list
+        if self.exchange in self.data_list:
+            return {self.exchange: self.data_list[self.exchange]}
+        for k, v in self.data_list.items(): ##exchange names are not case sensitive
             if k.lower() == self.exchange.lower():
-                return {k: self.data_list[k]}
-            if self.exchange not in self.data_list:
-                raise noExchange(self.data_list)
+                return {k: v}
+        
+        raise noExchange(self.data_list)
     
     ##Call def filterExchange(self) method to filter data based on SSP chosen
     def getFilteredExchange(self):
         return self.filterExchange()
         
  
+def computeRatios(cost, max_bid_ui, dtype = np.float64):
+    """Ratio of the clearing price over the max bid of every bid in a single vectorized division. Bids with a max
+    bid of 0, a negative or missing max bid or a missing cost get a NaN ratio. np.float32 halves the memory."""
+    cost = np.asarray(cost, dtype=dtype)
+    max_bid_ui = np.asarray(max_bid_ui, dtype=dtype)
+    ratios = np.full(len(cost), np.nan, dtype=dtype)
+    np.divide(cost, max_bid_ui, out=ratios, where=max_bid_ui > 0)
+    
+    return ratios
+
+
 class bidsRatio(object):
-    """This class compute the ratio of win bid over the max bid entered"""
+    """This class compute the ratio of win bid over the max bid entered. The values of data_set are lists of
+    (impressions, cost, max_bid_ui) (see loadDataFile()) or bidColumns, they are not modified. Bids with an
+    invalid max bid get a NaN ratio (see computeRatios())."""
     
     ## Initialize data
-    def __init__(self, data_set):
+    def __init__(self, data_set, dtype = np.float64):
         self.data_set = data_set
+        self.dtype = dtype
+    
+    ##Impressions, cost and max_bid_ui columns of the bids of 1 exchange
+    def getColumns(self, bids):
+        if isinstance(bids, bidColumns):
+            return bids.impressions, bids.cost, bids.max_bid_ui
+        rows = np.array(bids, dtype=np.float64).reshape(len(bids), -1) if len(bids) else np.empty((0, 3))
+        return rows[:, IMPRESSIONS].astype(np.int64), rows[:, COST], rows[:, MAX_BID_UI]
+    
+    ##Compute the ratio of every bid: dictionnary exchange -> (impressions, ratios) numpy arrays
+    def computeRatioColumns(self):
+        ratio_columns = {}
+        for k,v in self.data_set.items():
+            impressions, cost, max_bid_ui = self.getColumns(v)
+            ratio_columns[k] = (impressions, computeRatios(cost, max_bid_ui, self.dtype))
+        
+        return ratio_columns
     
     ##Compute the ratio of max bid over win bid and create a new dictionnary with initial value + ratio
-    ## key = exchange & value = tuple containing impressions, max_bid_ui, cost, ratio_win_max    
+    ## key = exchange & value = tuple containing impressions, cost, max_bid_ui, ratio_win_max    
     def computeRatio(self):
         dict_with_ratio = {}
         for k,v in self.data_set.items():
-            for i in range(len(v)):
-                ratio_win_max = v[i][COST]/v[i][MAX_BID_UI]
-                v[i] = v[i] + (ratio_win_max,)
-            
-            dict_with_ratio[k] = v
-            
+            impressions, cost, max_bid_ui = self.getColumns(v)
+            ratios = computeRatios(cost, max_bid_ui, self.dtype)
+            dict_with_ratio[k] = list(zip(impressions.tolist(), cost.tolist(), max_bid_ui.tolist(), ratios.tolist()))
+        
         return dict_with_ratio
     
     ##Call def computeRatio(self) and return the computed ratio
     def getRatio(self):
         return self.computeRatio()
     
+    ##Ratios and impressions of the bids of every exchange as 2 arrays (see plotRatios())
+    def getRatioArrays(self):
+        ratio_columns = list(self.computeRatioColumns().values())
+        if not ratio_columns:
+            return np.array([], dtype=self.dtype), np.array([], dtype=np.int64)
+        
+        return (np.concatenate([ratios for impressions, ratios in ratio_columns]),
+                np.concatenate([impressions for impressions, ratios in ratio_columns]))
+    
 class observedData(object):
     """Take observed value and expected values and calculate chi square"""
     
@@ -154,32 +301,436 @@ class expectedData(object):
                     
     
     
+RATIO_STATISTICS = ['IMPRESSIONS', 'RATIO_SUM', 'RATIO_SQUARES'] ## impression weighted sums kept after the bins
+
+
+def accumulateRatios(task):
+    """Histogram of the ratios of one chunk of bids for every exchange in one grouped pass. task is (number of
+    exchanges, exchange codes, impressions, cost, max_bid_ui). Returns a (number of exchanges) x (number of bins
+    + 3) array: the impressions in every bin (see ratioBins()) followed by RATIO_STATISTICS. Bids with an invalid max
+    bid (NaN ratio, see computeRatios()) are skipped."""
+    num_exchanges, exchange_codes, impressions, cost, max_bid_ui = task
+    bins = np.array(ratioBins())
+    num_bins = len(bins) - 1
+    
+    ratios = computeRatios(cost, max_bid_ui)
+    valid = ~np.isnan(ratios)
+    codes, weights, ratios = exchange_codes[valid], impressions[valid].astype(np.float64), ratios[valid]
+    
+    ##Same bins as np.histogram(): [bins[i], bins[i + 1]) and the last bin includes its upper edge
+    bin_index = np.searchsorted(bins, ratios, side='right') - 1
+    bin_index[ratios == bins[-1]] = num_bins - 1
+    in_bins = (bin_index >= 0) & (bin_index < num_bins)
+    
+    totals = np.zeros((num_exchanges, num_bins + len(RATIO_STATISTICS)))
+    totals[:, :num_bins] = np.bincount(codes[in_bins] * num_bins + bin_index[in_bins], weights=weights[in_bins],
+                                       minlength=num_exchanges * num_bins).reshape(num_exchanges, num_bins)
+    totals[:, num_bins] = np.bincount(codes, weights=weights, minlength=num_exchanges)
+    totals[:, num_bins + 1] = np.bincount(codes, weights=weights * ratios, minlength=num_exchanges)
+    totals[:, num_bins + 2] = np.bincount(codes, weights=weights * ratios * ratios, minlength=num_exchanges)
+    
+    return totals
+
+
+def addTotals(totals, chunk_totals):
+    """Add the totals of a chunk to totals, the chunk may have more exchanges (rows) than totals"""
+    if totals is None:
+        return chunk_totals
+    if len(chunk_totals) > len(totals):
+        totals, chunk_totals = chunk_totals, totals
+    totals[:len(chunk_totals)] += chunk_totals
+    return totals
+
+
+def exchangeHistograms(filename, chunk_size = CHUNK_SIZE, processes = 1):
+    """Read filename once and return the exchange names and their totals (see accumulateRatios()). Chunks are
+    parsed in this process and binned over a pool of "processes" processes (default to 1, no pool). At most 2
+    chunks per process wait to be binned, so memory stays bounded. Prices are parsed as float64 so ratios on the
+    edge of a bin fall in the same bin as with runAuctionTest()."""
+    totals = None
+    chunks = iterBidChunks(filename, chunk_size, np.float64)
+    exchanges = []
+    
+    if processes == 1:
+        for chunk in chunks:
+            exchanges = chunk.getExchanges()
+            totals = addTotals(totals, accumulateRatios((len(exchanges), chunk.exchange_codes, chunk.impressions,
+                                                         chunk.cost, chunk.max_bid_ui)))
+    else:
+        max_pending = 2 * (processes or multiprocessing.cpu_count())
+        with multiprocessing.Pool(processes) as pool:
+            pending = deque()
+            for chunk in chunks:
+                exchanges = chunk.getExchanges()
+                pending.append(pool.apply_async(accumulateRatios, ((len(exchanges), chunk.exchange_codes,
+                                                                    chunk.impressions, chunk.cost,
+                                                                    chunk.max_bid_ui),)))
+                if len(pending) >= max_pending:
+                    totals = addTotals(totals, pending.popleft().get())
+            while pending:
+                totals = addTotals(totals, pending.popleft().get())
+    
+    if totals is None:
+        totals = np.zeros((0, len(ratioBins()) - 1 + len(RATIO_STATISTICS)))
+    return list(exchanges), totals
+
+
+def exchangeStatistics(exchanges, totals):
+    """Comparison table of the exchanges: impressions, mean and standard deviation of the ratio and chi-square
+    of the distribution (see calculateChiSquare()), one row per exchange"""
+    num_bins = len(ratioBins()) - 1
+    rows = []
+    for exchange, exchange_totals in zip(exchanges, totals):
+        impressions, ratio_sum, ratio_squares = exchange_totals[num_bins:]
+        distribution_ob = exchange_totals[:num_bins]
+        mean_ratio = ratio_sum / impressions if impressions else np.nan
+        st_dev = np.sqrt(max(ratio_squares / impressions - mean_ratio**2, 0.0)) if impressions else np.nan
+        if distribution_ob.sum() > 0:
+            chi_square, p_value = calculateChiSquare(distribution_ob, None)
+        else:
+            chi_square, p_value = np.nan, np.nan
+        rows.append((exchange, int(impressions), mean_ratio, st_dev, chi_square, p_value))
+    
+    return pd.DataFrame(rows, columns=['EXCHANGE', 'IMPRESSIONS', 'MEAN', 'STANDARD_DEVIATION', 'CHI_SQUARE',
+                                       'P_VALUE'])
+
+
+class ratioHistogram(object):
+    """Mergeable summary of the ratio distribution of every exchange: impressions per bin (bins of ratioBins(),
+    as plotGraph()) followed by the impression weighted sums of RATIO_STATISTICS, one row of totals per exchange
+    (see accumulateRatios()). Summaries of shards (hours, machines) are added with merge() and saved to / loaded
+    from JSON, so the daily or weekly chi-square doesn't need the raw bid logs."""
+    
+    def __init__(self, exchanges = None, totals = None, bins = None):
+        self.bins = ratioBins() if bins is None else list(bins)
+        self.exchanges = [] if exchanges is None else list(exchanges)
+        if totals is None:
+            totals = np.zeros((len(self.exchanges), len(self.bins) - 1 + len(RATIO_STATISTICS)))
+        self.totals = np.asarray(totals, dtype=np.float64)
+    
+    ##Summary of a bid log read once (see exchangeHistograms())
+    @classmethod
+    def fromFile(cls, filename, chunk_size = CHUNK_SIZE, processes = 1):
+        exchanges, totals = exchangeHistograms(filename, chunk_size, processes)
+        return cls(exchanges, totals)
+    
+    def getExchanges(self):
+        return self.exchanges
+    
+    ##Totals of 1 exchange, or of all the exchanges together if exchange is None
+    def getTotals(self, exchange = None):
+        if exchange is None:
+            return self.totals.sum(axis=0)
+        if exchange not in self.exchanges:
+            raise noExchange(dict((e, None) for e in self.exchanges))
+        return self.totals[self.exchanges.index(exchange)]
+    
+    ##Impressions in every bin
+    def getDistribution(self, exchange = None):
+        return self.getTotals(exchange)[:len(self.bins) - 1]
+    
+    ##Impression weighted mean and standard deviation of the ratios
+    def getMoments(self, exchange = None):
+        impressions, ratio_sum, ratio_squares = self.getTotals(exchange)[len(self.bins) - 1:]
+        if not impressions:
+            return np.nan, np.nan
+        mean_ratio = ratio_sum / impressions
+        return mean_ratio, np.sqrt(max(ratio_squares / impressions - mean_ratio**2, 0.0))
+    
+    def getChiSquare(self, exchange = None):
+        return calculateChiSquare(self.getDistribution(exchange), None)
+    
+    ##Comparison table of the exchanges (see exchangeStatistics())
+    def getStatistics(self):
+        return exchangeStatistics(self.exchanges, self.totals)
+    
+    ##Return a new summary with the bids of self and other, exchanges are matched by name
+    def merge(self, other):
+        if other.bins != self.bins:
+            raise ValueError('Cannot merge ratio histograms with different bins')
+        exchanges = self.exchanges + [e for e in other.exchanges if e not in self.exchanges]
+        totals = np.zeros((len(exchanges), self.totals.shape[1]))
+        totals[:len(self.exchanges)] = self.totals
+        index = dict((e, i) for i, e in enumerate(exchanges))
+        totals[[index[e] for e in other.exchanges]] += other.totals
+        return ratioHistogram(exchanges, totals, self.bins)
+    
+    def __add__(self, other):
+        return self.merge(other)
+    
+    def toDict(self):
+        num_bins = len(self.bins) - 1
+        return {'bins': self.bins,
+                'exchanges': dict((e, {'distribution': t[:num_bins].tolist(),
+                                       'statistics': dict(zip(RATIO_STATISTICS, t[num_bins:].tolist()))})
+                                  for e, t in zip(self.exchanges, self.totals))}
+    
+    @classmethod
+    def fromDict(cls, summary):
+        exchanges = list(summary['exchanges'])
+        totals = [summary['exchanges'][e]['distribution'] +
+                  [summary['exchanges'][e]['statistics'][name] for name in RATIO_STATISTICS] for e in exchanges]
+        columns = len(summary['bins']) - 1 + len(RATIO_STATISTICS) ## explicit, a summary can have no exchange
+        return cls(exchanges, np.array(totals, dtype=np.float64).reshape(len(exchanges), columns), summary['bins'])
+    
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.toDict(), f)
+    
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.fromDict(json.load(f))
+
+
+def mergeHistogramFiles(filenames):
+    """Merge the summaries saved in filenames (see ratioHistogram.save())"""
+    histogram = ratioHistogram()
+    for filename in filenames:
+        histogram = histogram.merge(ratioHistogram.load(filename))
+    
+    return histogram
+
+
+def uniformDivergence(distribution):
+    """Total variation distance between the share of impressions in every bin and a uniform distribution: 0 when
+    uniform, close to 1 when all the impressions are in 1 bin (for a random auction it is about 0.02)"""
+    total = distribution.sum()
+    if not total:
+        return np.nan
+    return 0.5 * np.abs(distribution / total - 1.0 / len(distribution)).sum()
+
+
+class auctionMonitor(object):
+    """Rolling time window monitor of the ratio distribution of every exchange. Bids are added as they arrive
+    (addBid() / addBids()) with a timestamp in seconds, and are kept only as per exchange totals (see
+    accumulateRatios()) of "buckets" time buckets of window / buckets seconds, so memory does not depend on the
+    number of bids. Every "cadence" seconds the chi-square, mean and standard deviation of the last window are
+    computed (see getReports()) and on_alert (default to print) is called for every exchange whose divergence from
+    the uniform distribution (see uniformDivergence()) goes above threshold with at least min_impressions in the
+    window. Timestamps must not go backward.
+    """
+    
+    def __init__(self, window = 3600.0, buckets = 60, cadence = 300.0, threshold = 0.2, min_impressions = 10000,
+                 on_alert = None, buffer_size = 10000):
+        self.bucket_length = float(window) / buckets
+        self.buckets = buckets
+        self.cadence = cadence
+        self.threshold = threshold
+        self.min_impressions = min_impressions
+        self.on_alert = on_alert
+        self.buffer_size = buffer_size
+        
+        self.exchanges = []
+        self.exchange_index = {}
+        self.window_buckets = deque() ## (bucket number, totals), oldest first
+        self.current_bucket = None
+        self.next_report = None
+        self.alerting = set() ## exchanges above threshold at the last report
+        self.reports = []
+        self.alerts = []
+        self.buffer = []
+    
+    def getExchangeCodes(self, exchanges):
+        codes = [self.exchange_index.setdefault(e, len(self.exchange_index)) for e in exchanges]
+        self.exchanges.extend(list(self.exchange_index)[len(self.exchanges):])
+        return np.array(codes, dtype=np.int32)
+    
+    ##Add 1 bid, bids are buffered and added buffer_size at a time. timestamp default to the current time.
+    def addBid(self, exchange, impressions, cost, max_bid_ui, timestamp = None):
+        self.buffer.append((exchange, impressions, cost, max_bid_ui, time.time() if timestamp is None else timestamp))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+    
+    def flush(self):
+        if self.buffer:
+            exchanges, impressions, cost, max_bid_ui, timestamps = zip(*self.buffer)
+            self.buffer = []
+            names, codes = np.unique(np.array(exchanges, dtype=object).astype(str), return_inverse=True)
+            self.addCodes(self.getExchangeCodes(names)[codes], np.array(impressions),
+                          np.array(cost, dtype=np.float64), np.array(max_bid_ui, dtype=np.float64),
+                          np.array(timestamps, dtype=np.float64))
+    
+    ##Add the bids of a bidColumns (see iterBidChunks()) with their timestamps (array of seconds)
+    def addBids(self, bid_columns, timestamps):
+        self.flush()
+        mapping = self.getExchangeCodes(bid_columns.getExchanges())
+        self.addCodes(mapping[bid_columns.exchange_codes], bid_columns.impressions, bid_columns.cost,
+                      bid_columns.max_bid_ui, np.asarray(timestamps, dtype=np.float64))
+    
+    def addCodes(self, exchange_codes, impressions, cost, max_bid_ui, timestamps):
+        bucket_numbers = np.floor(timestamps / self.bucket_length).astype(np.int64)
+        if len(bucket_numbers) and (np.diff(bucket_numbers) < 0).any():
+            raise ValueError('Bid timestamps must not go backward')
+        
+        ##Bids are sorted by time: add every run of bids of the same bucket at once
+        starts = np.flatnonzero(np.diff(bucket_numbers)) + 1
+        for start, end in zip(np.concatenate([[0], starts]), np.concatenate([starts, [len(bucket_numbers)]])):
+            self.advance(bucket_numbers[start])
+            totals = accumulateRatios((len(self.exchanges), exchange_codes[start:end], impressions[start:end],
+                                       cost[start:end], max_bid_ui[start:end]))
+            self.window_buckets[-1] = (self.current_bucket, addTotals(self.window_buckets[-1][1], totals))
+    
+    ##Move to bucket (number), report for every cadence reached before it and drop the buckets out of the window
+    def advance(self, bucket):
+        if self.current_bucket is not None and bucket < self.current_bucket:
+            raise ValueError('Bid timestamps must not go backward')
+        if self.next_report is None:
+            self.next_report = bucket * self.bucket_length + self.cadence
+        while self.next_report <= bucket * self.bucket_length:
+            self.report(self.next_report)
+            self.next_report += self.cadence
+        
+        if bucket != self.current_bucket:
+            self.current_bucket = bucket
+            self.window_buckets.append((bucket, None))
+        while self.window_buckets[0][0] <= bucket - self.buckets:
+            self.window_buckets.popleft()
+    
+    ##Totals of every exchange over the buckets of the window ending at report_time
+    def getWindowTotals(self, report_time = None):
+        totals = np.zeros((len(self.exchanges), len(ratioBins()) - 1 + len(RATIO_STATISTICS)))
+        window_start = None if report_time is None else report_time - self.buckets * self.bucket_length
+        for bucket, bucket_totals in self.window_buckets:
+            in_window = window_start is None or bucket * self.bucket_length >= window_start
+            if bucket_totals is not None and in_window:
+                totals[:len(bucket_totals)] += bucket_totals
+        return totals
+    
+    ##Statistics of the last window (see exchangeStatistics()) with the divergence and the alerts
+    def report(self, report_time):
+        totals = self.getWindowTotals(report_time)
+        table = exchangeStatistics(self.exchanges, totals)
+        num_bins = len(ratioBins()) - 1
+        table['DIVERGENCE'] = [uniformDivergence(t[:num_bins]) for t in totals]
+        table['ALERT'] = (table['IMPRESSIONS'] >= self.min_impressions) & (table['DIVERGENCE'] >= self.threshold)
+        table.insert(loc=0, column='TIME', value=report_time)
+        self.reports.append(table)
+        
+        for row in table[table['ALERT'] & ~table['EXCHANGE'].isin(self.alerting)].itertuples(index=False):
+            alert = {'time': report_time, 'exchange': row.EXCHANGE, 'divergence': row.DIVERGENCE,
+                     'chi_square': row.CHI_SQUARE, 'mean': row.MEAN, 'impressions': row.IMPRESSIONS}
+            self.alerts.append(alert)
+            if self.on_alert is None:
+                print('ALERT', report_time, ':', row.EXCHANGE, 'diverges from uniform auctions (divergence',
+                      round(row.DIVERGENCE, 3), ', mean ratio', round(row.MEAN, 3), ')')
+            else:
+                self.on_alert(alert)
+        self.alerting = set(table.loc[table['ALERT'], 'EXCHANGE'])
+        
+        return table
+    
+    ##Every report so far in one table (one row per exchange and report time)
+    def getReports(self):
+        if not self.reports:
+            return pd.DataFrame()
+        return pd.concat(self.reports, ignore_index=True)
+    
+    def getAlerts(self):
+        return self.alerts
+
+
+def replayLog(filename, monitor = None, bids_per_second = 100.0, start_time = 0.0, chunk_size = CHUNK_SIZE):
+    """Feed the bids of filename to monitor (default to an auctionMonitor with default settings) as fast as
+    possible, as if bids_per_second bids arrived every second from start_time (the bid logs have no timestamps).
+    Returns the monitor."""
+    if monitor is None:
+        monitor = auctionMonitor()
+    
+    done = 0
+    for chunk in iterBidChunks(filename, chunk_size, np.float64):
+        monitor.addBids(chunk, start_time + (done + np.arange(len(chunk))) / float(bids_per_second))
+        done += len(chunk)
+    monitor.flush()
+    
+    return monitor
+
+
+def runAuctionBatch(filename, processes = 1, chunk_size = CHUNK_SIZE, output_file = None, histogram_file = None):
+    """
+    Run the test for every exchange of filename with a single read of the file. Returns the comparison table
+    of the exchanges (see exchangeStatistics()), also written to output_file (csv) if given. The summary of the
+    file is saved to histogram_file if given, to be merged with other shards later (see ratioHistogram).
+    """
+    histogram = ratioHistogram.fromFile(filename, chunk_size, processes)
+    if histogram_file is not None:
+        histogram.save(histogram_file)
+    table = histogram.getStatistics()
+    if output_file is not None:
+        table.to_csv(output_file, index=False)
+    
+    return table
+
+
 def runAuctionTest(filename, exchange = None):
     """
     Main function use to run test. Enter file name + exchange name (if multiple exchange data input, leave to none otherwise).
     """
-    inputData = loadDataFile(filename)
+    inputData = loadBidColumns(filename, float_dtype=np.float64).byExchange()
     filtered_input_data = pickExchange(inputData, exchange).getFilteredExchange()
-    compute_ratio_list = bidsRatio(filtered_input_data).getRatio()
+    ratios, weights = bidsRatio(filtered_input_data).getRatioArrays()
     
-    return plotGraph(compute_ratio_list, exchange)
+    return plotRatios(ratios, weights, exchange)
     
     
+def ratioBins():
+    """Bin edges of the ratio distribution: 0.0, 0.01, ..., 0.99 (ratios above 0.99 are not counted)"""
+    bins = []
+    for i in np.arange(0.0,1.0,0.01):
+        bins.append(round(i,2))
+    
+    return bins
+
+
+def ratioArrays(final_data_set):
+    """Return the ratio and the impressions of every row of final_data_set (see bidsRatio) as 2 numpy arrays.
+    Every row stands for "impressions" impressions at the same ratio, impressions are used as weights."""
+    ratios = []
+    weights = []
+    for k,v in final_data_set.items():
+        for i in range(len(v)):
+            ratios.append(v[i][RATIO])
+            weights.append(v[i][IMPRESSIONS])
+    
+    return np.array(ratios, dtype=np.float64), np.array(weights, dtype=np.int64)
+
+
+def weightedHistogram(ratios, weights, bins):
+    """Number of impressions per bin, same as the histogram of every ratio repeated "weights" times"""
+    distribution, bin_edges = np.histogram(ratios, bins, weights=weights)
+    return distribution
+
+
+def weightedMoments(ratios, weights):
+    """Impression weighted mean and standard deviation of the ratios (NaN ratios are skipped)"""
+    valid = ~np.isnan(ratios)
+    ratios, weights = ratios[valid].astype(np.float64), weights[valid]
+    total_weight = weights.sum()
+    mean_ratio = np.dot(weights, ratios) / total_weight
+    st_dev = np.sqrt(np.dot(weights, (ratios - mean_ratio)**2) / total_weight)
+    
+    return mean_ratio, st_dev
+
+
 def plotGraph(final_data_set, exchange):
     """
     Plot the distribution of impressions with ration in the x-axis and %tage of impressions in the y-axis
     """
-    ratios = []
-    bins = []
-    for k,v in final_data_set.items():
-        for i in range(len(v)):
-            #ratios.append(v[i][RATIO])
-            ratios += v[i][IMPRESSIONS] * [(v[i][RATIO])]
+    ratios, weights = ratioArrays(final_data_set)
     
-    for i in np.arange(0.0,1.0,0.01):
-        bins.append(round(i,2))
+    return plotRatios(ratios, weights, exchange)
+
+
+def plotRatios(ratios, weights, exchange):
+    """
+    Same as plotGraph() from the ratios and their impressions (weights). Memory depends on the number of rows,
+    not on the number of impressions.
+    """
+    bins = ratioBins()
+    distribution_ob = weightedHistogram(ratios, weights, bins)
     
-    distribution_ob, bins_ob, bars_ob = plt.hist(ratios, bins, histtype='bar', rwidth=0.9, label=exchange)
+    ##Draw the precomputed distribution: one point per bin weighted by its number of impressions
+    plt.hist(bins[:-1], bins, weights=distribution_ob, histtype='bar', rwidth=0.9, label=exchange)
     plt.xlabel('Ratios')
     plt.ylabel('% Impressions')
     plt.title('True 2nd Price Auction')
@@ -187,39 +738,104 @@ def plotGraph(final_data_set, exchange):
     plt.show()
     
     #Compute mean and standard deviation    
-    mean_ratio = sum(ratios) / len(ratios)
-    st_dev = np.std(ratios)
+    mean_ratio, st_dev = weightedMoments(ratios, weights)
     
     print('Mean :', mean_ratio)   
     print('Standard Deviation: ', st_dev)
     
-    observed_data = observedData(distribution_ob, bins_ob)
+    observed_data = observedData(distribution_ob, bins)
     sum_tot_values = sum(observed_data.getObservedDist())
     sum_tot_values = int(sum_tot_values)
     
-    return calculateChiSquare(observed_data.getObservedDist(), generateRandomTest(sum_tot_values, 4.0))
+    return calculateChiSquare(observed_data.getObservedDist(), generateRandomTest(sum_tot_values, 4.0, analytic=True))
 
 
-def generateRandomTest(number_bids, higher_bound_bid, run_random=False):
-    """Generate random ratio to evaluate what is a uniform distribution under total random conditions.
-    higher_bound_bid is a float"""
-    bins = []
-    random_ratios = []
-    
-    for i in np.arange(0.0,1.0,0.01):
-        bins.append(round(i,2)) 
+MIN_BID = 0.01
+BASELINE_BATCH_SIZE = 1000000 ## random bids drawn at a time
+_expected_distributions = {} ## (higher_bound_bid, bins[, number_bids, seed]) -> expected ratio distribution
+
+
+def randomRatios(number_bids, higher_bound_bid, rng):
+    """Ratios of number_bids random second price auctions: max bid uniform in [MIN_BID, higher_bound_bid] and
+    clearing price uniform in [2 * MIN_BID, max bid], drawn with rng (numpy RandomState)"""
+    max_bid_rd = MIN_BID + (higher_bound_bid - MIN_BID) * rng.random_sample(number_bids)
+    clearing_price = MIN_BID + (max_bid_rd - 2 * MIN_BID) * rng.random_sample(number_bids) + MIN_BID
+    return clearing_price / max_bid_rd
 
-    for i in range(number_bids):
-        max_bid_rd = rd.uniform(0.01, higher_bound_bid)
-        clearing_price = rd.uniform(0.01, max_bid_rd - 0.01) + 0.01
-        ratio = clearing_price/max_bid_rd
-        random_ratios.append(ratio)
 
-    distribution_exp, bins_exp, bars_epx = plt.hist(random_ratios, bins, normed=True,histtype='bar', rwidth=0.9,label='Random Data Set')
-    mean_ratio = sum(random_ratios) / len(random_ratios)
-    st_dev = np.std(random_ratios)
+def randomDistribution(number_bids, higher_bound_bid, bins, seed = None, batch_size = BASELINE_BATCH_SIZE):
+    """Histogram of the ratios of number_bids random auctions (see randomRatios()) with their mean and standard
+    deviation. Bids are drawn batch_size at a time and only the bin counts and sums are kept, so memory does not
+    depend on number_bids."""
+    rng = np.random.RandomState(seed)
+    counts = np.zeros(len(bins) - 1)
+    total = 0.0
+    total_squares = 0.0
+    for start in range(0, number_bids, batch_size):
+        ratios = randomRatios(min(batch_size, number_bids - start), higher_bound_bid, rng)
+        counts += np.histogram(ratios, bins)[0]
+        total += ratios.sum()
+        total_squares += np.dot(ratios, ratios)
+    
+    mean_ratio = total / number_bids
+    st_dev = np.sqrt(max(total_squares / number_bids - mean_ratio**2, 0.0))
+    
+    return counts, mean_ratio, st_dev
+
+
+def analyticDistribution(higher_bound_bid, bins):
+    """Exact probability of every bin for the random auctions of randomRatios(). For a max bid m the ratio is
+    uniform in [c / m, 1] with c = 2 * MIN_BID, so P(ratio <= r) is the integral over m in [c / r, b] of
+    (r * m - c) / (m - c) divided by (b - MIN_BID), where b is higher_bound_bid."""
+    c = 2 * MIN_BID
+    cdf = []
+    for r in bins:
+        if r <= 0.0 or c / r >= higher_bound_bid:
+            cdf.append(0.0)
+        elif r >= 1.0:
+            cdf.append((higher_bound_bid - c) / (higher_bound_bid - MIN_BID))
+        else:
+            integral = lambda m: r * m + c * (r - 1) * np.log(m - c)
+            cdf.append((integral(higher_bound_bid) - integral(c / r)) / (higher_bound_bid - MIN_BID))
+    
+    return np.diff(cdf)
+
+
+def expectedDistribution(number_bids, higher_bound_bid, bins, seed = None, analytic = False):
+    """Share of the random auctions in every bin (sums to 1 over the bins), computed exactly if analytic is True
+    and by simulating number_bids auctions otherwise. It does not depend on the observed data, so it is cached
+    per (higher_bound_bid, bins) when analytic, and per (higher_bound_bid, bins, number_bids, seed) when seeded.
+    A new list is returned every time, so callers can modify it without changing the cached distribution."""
+    if analytic:
+        key = (higher_bound_bid, tuple(bins))
+    elif seed is not None:
+        key = (higher_bound_bid, tuple(bins), number_bids, seed)
+    else:
+        key = None
+    
+    if key not in _expected_distributions:
+        if analytic:
+            distribution_exp = analyticDistribution(higher_bound_bid, bins)
+        else:
+            distribution_exp = randomDistribution(number_bids, higher_bound_bid, bins, seed)[0]
+        expected_ratio = expectedData(list(distribution_exp), bins).getRatioDistribution()
+        if key is None:
+            return expected_ratio
+        _expected_distributions[key] = tuple(expected_ratio)
+    
+    return list(_expected_distributions[key])
+
+
+def generateRandomTest(number_bids, higher_bound_bid, run_random=False, seed=None, analytic=False):
+    """Generate random ratio to evaluate what is a uniform distribution under total random conditions.
+    higher_bound_bid is a float. seed makes the random auctions reproducible, analytic computes the expected
+    distribution exactly instead of drawing number_bids auctions (see expectedDistribution())."""
+    bins = ratioBins()
     
     if run_random == True:        
+        distribution_exp, mean_ratio, st_dev = randomDistribution(number_bids, higher_bound_bid, bins, seed)
+        density = distribution_exp / (distribution_exp.sum() * 0.01) ## same values as plt.hist(normed=True)
+        plt.hist(bins[:-1], bins, weights=density, histtype='bar', rwidth=0.9, label='Random Data Set')
         plt.xlabel('Ratios')
         plt.ylabel('% Impressions')
         plt.text(0,0.8,round(mean_ratio,2),
@@ -230,8 +846,8 @@ def generateRandomTest(number_bids, higher_bound_bid, run_random=False):
         plt.legend()
         plt.show()
         
-        expected_data = expectedData(distribution_exp, bins_exp)
-        observed_data = observedData(distribution_exp, bins_exp)
+        expected_data = expectedData(list(density), bins)
+        observed_data = observedData(density, bins)
         
         print('Mean :', mean_ratio)   
         print('Standard Deviation: ', st_dev)
@@ -239,20 +855,45 @@ def generateRandomTest(number_bids, higher_bound_bid, run_random=False):
         return calculateChiSquare(observed_data.getObservedDist(),expected_data.getRatioDistribution())
     
     else:
-        #Compute mean and std for random set        
-        expected_data = expectedData(distribution_exp, bins_exp)
-        return expected_data.getRatioDistribution()
+        return expectedDistribution(number_bids, higher_bound_bid, bins, seed, analytic)
 
 def calculateChiSquare(observed_data, expected_ratio):
     """
     Evaluate significance of the test by computing ChiSquare for the data input
     """
     tot_observed_data = sum(observed_data)
-    tot_observed_data = int(tot_observed_data)
     
+    ##Uniform distribution: the same share of the observations in every bin
     expected_data = []
     for i in range(len(observed_data)):
-        expected_data.append(tot_observed_data*0.01)
+        expected_data.append(tot_observed_data / len(observed_data))
         
     return chisquare(observed_data, f_exp=expected_data)
-    
\ No newline at end of file
+    
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check if exchanges run true second price auctions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summarize = subparsers.add_parser('summarize', help='summarize a bid log (or shard) in one pass')
+    summarize.add_argument('file', help='bid log: bid ID, Exchange, impressions, clearing price, max bid')
+    summarize.add_argument('--histogram', default=None, help='save the mergeable summary to this JSON file')
+    summarize.add_argument('--output', default=None, help='write the comparison table to this csv file')
+    summarize.add_argument('--processes', type=int, default=1)
+    summarize.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    merge = subparsers.add_parser('merge', help='merge the summaries of several shards')
+    merge.add_argument('histograms', nargs='+', help='JSON files saved by summarize --histogram')
+    merge.add_argument('--histogram', default=None, help='save the merged summary to this JSON file')
+    merge.add_argument('--output', default=None, help='write the comparison table to this csv file')
+    args = parser.parse_args()
+
+    if args.command == 'summarize':
+        table = runAuctionBatch(args.file, args.processes, args.chunk_size, args.output, args.histogram)
+    else:
+        histogram = mergeHistogramFiles(args.histograms)
+        if args.histogram is not None:
+            histogram.save(args.histogram)
+        table = histogram.getStatistics()
+        if args.output is not None:
+            table.to_csv(args.output, index=False)
+    print(table.to_string(index=False))
@@ -0,0 +1,82 @@
+"""
+Tests of clearing_win_price_ratio.py
+
+Usage: python -m pytest test_clearing_win_price_ratio.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import clearing_win_price_ratio as auction
+
+
+class expectedDistributionTest(unittest.TestCase):
+
+    def testCachedDistributionIsNotShared(self):
+        bins = auction.ratioBins()
+        first = auction.expectedDistribution(1000, 4.0, bins, analytic=True)
+        expected = list(first)
+        first[0] = 100.0
+        first.append(1.0)
+        self.assertEqual(auction.expectedDistribution(1000, 4.0, bins, analytic=True), expected)
+
+    def testSeededDistributionIsNotShared(self):
+        bins = auction.ratioBins()
+        first = auction.expectedDistribution(10000, 4.0, bins, seed=7)
+        expected = list(first)
+        first[:] = [0.0] * len(first)
+        self.assertEqual(auction.expectedDistribution(10000, 4.0, bins, seed=7), expected)
+
+
+class bidsRatioTest(unittest.TestCase):
+
+    def testEmptyExchange(self):
+        data_set = {'exchange_0': [], 'exchange_1': [(2, 0.5, 1.0), (1, 1.0, 0.0)]}
+        bids_ratio = auction.bidsRatio(data_set)
+        columns = bids_ratio.computeRatioColumns()
+        self.assertEqual(len(columns['exchange_0'][0]), 0)
+        self.assertEqual(columns['exchange_0'][0].dtype, np.int64)
+        self.assertEqual(bids_ratio.getRatio()['exchange_0'], [])
+
+        ratios, weights = bids_ratio.getRatioArrays()
+        np.testing.assert_array_equal(weights, [2, 1])
+        np.testing.assert_array_equal(ratios, [0.5, np.nan])
+
+
+class ratioHistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='ratio_histogram_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testEmptyHistogramFromDict(self):
+        histogram = auction.ratioHistogram.fromDict({'bins': [0, 0.5, 1], 'exchanges': {}})
+        self.assertEqual(histogram.getExchanges(), [])
+        self.assertEqual(histogram.totals.shape, (0, 2 + len(auction.RATIO_STATISTICS)))
+
+    def testEmptyHistogramSaveLoadMerge(self):
+        empty_file = os.path.join(self.directory, 'empty.json')
+        auction.ratioHistogram().save(empty_file)
+        loaded = auction.ratioHistogram.load(empty_file)
+        self.assertEqual(loaded.getExchanges(), [])
+        self.assertEqual(loaded.toDict(), auction.ratioHistogram().toDict())
+
+        totals = np.zeros((1, len(auction.ratioBins()) - 1 + len(auction.RATIO_STATISTICS)))
+        totals[0, 10] = 5
+        totals[0, -3:] = [5, 0.5, 0.05]
+        shard_file = os.path.join(self.directory, 'shard.json')
+        auction.ratioHistogram(['exchange_0'], totals).save(shard_file)
+
+        merged = auction.mergeHistogramFiles([empty_file, shard_file, empty_file])
+        self.assertEqual(merged.getExchanges(), ['exchange_0'])
+        np.testing.assert_array_equal(merged.getTotals('exchange_0'), totals[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,413 @@
+"""
+ADOPS BENCHMARK SUITE
+=====================
+
+Author: Teddy Crepineau
+
+Purpose: time and memory profile the three tools of the repository on seeded synthetic data, at a scale far
+above the templates, and record the results in a JSON file so regressions show up between versions.
+
+   - kmeans -> runKmeans() on a domain export (domains_performance_clustering.py), the file is loaded and
+               normalized first (loadFeatureMatrix(), without the feature cache)
+   - auction -> loadDataFile() + bidsRatio + plotGraph() on a bid log (clearing_win_price_ratio.py), the
+                original per exchange test
+   - auction_batch -> runAuctionBatch() on the same bid log, the single pass test of every exchange
+   - adstxt -> checkHasAdsFile() on a publisher list served by local stub HTTP servers (see crawl_harness.py),
+               sequential crawl with filter_status="complete"
+
+Data is generated with a fixed seed: domain exports by generateDomainMetrics(), bid logs by generateBidLog()
+(bid_log_benchmark.py) and ads.txt files by the stub servers of crawl_harness.py. Every scenario runs in a
+fresh interpreter so its peak memory (maximum resident set size) is not hidden by what previous scenarios
+allocated. The peak is reported with the increase over the memory used once the tools are imported.
+
+Scales (rows of the domain export / domains / rows of the bid log / publishers crawled):
+
+   - small -> 10,000 / 1,000 / 10,000 / 1,000
+   - medium -> 1,000,000 / 10,000 / 1,000,000 / 10,000
+   - large -> 10,000,000 / 100,000 / 10,000,000 / 100,000
+
+The "auction" scenario keeps every bid in Python lists (loadDataFile() format): several GB at the large scale,
+use --skip auction if the machine does not have the memory.
+
+Usage: python adops_benchmark.py --scale small --output results.json
+       python adops_benchmark.py --scale medium --output new.json --compare results.json --tolerance 0.2
+       python adops_benchmark.py --scale large --skip auction --data-dir bench_data
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('MPLBACKEND', 'Agg') ## plots are drawn but never shown (inherited by the scenarios)
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOL_DIRS = [os.path.join(ROOT, 'Domains_Clustering_Kmeans'),
+             os.path.join(ROOT, 'Exchange_Clearing_Bid_Ratio'),
+             os.path.join(ROOT, 'has_ads.txt_scraper')]
+for tool_dir in TOOL_DIRS:
+    if tool_dir not in sys.path:
+        sys.path.insert(0, tool_dir)
+
+RESULTS_VERSION = 1
+NOISE_SECONDS = 0.05 ## changes smaller than this are never reported as regressions
+NOISE_MEMORY_MB = 2.0
+SCENARIOS = ['kmeans', 'auction', 'auction_batch', 'adstxt']
+SCALES = {'small': {'kmeans_rows': 10000, 'kmeans_domains': 1000, 'bid_rows': 10000, 'adstxt_domains': 1000},
+          'medium': {'kmeans_rows': 1000000, 'kmeans_domains': 10000, 'bid_rows': 1000000,
+                     'adstxt_domains': 10000},
+          'large': {'kmeans_rows': 10000000, 'kmeans_domains': 100000, 'bid_rows': 10000000,
+                    'adstxt_domains': 100000}}
+DOMAIN_COLUMNS = ['DOMAINS', 'REQUEST', 'BLOCK', 'IMPRESSION', 'VIEWABLE', 'MEASURED', 'CLICKS', 'INCIDENTS',
+                  'COMPLETES']
+## (low, high) of the BLOCK %, IN-VIEW %, CLICK %, INCIDENT % and 100% COMPLETES % of the domain profiles
+PROFILE_RANGES = [(0.01, 0.3), (0.3, 0.9), (0.0005, 0.01), (0.001, 0.05), (0.3, 0.9)]
+
+
+def generateDomainMetrics(filename, num_rows, domains, centers=5, seed=0, chunk_size=1000000):
+    """
+    Write num_rows rows in the format of clustering_template.csv for "domains" domains (every domain appears at
+    least once if num_rows >= domains, duplicate rows are added together by the tools). Every domain follows
+    one of "centers" random profiles (ratios in PROFILE_RANGES) with some noise, so the clusters are real.
+    """
+    rng = np.random.RandomState(seed)
+    low, high = np.array(PROFILE_RANGES).T
+    profiles = rng.uniform(low, high, size=(centers, len(PROFILE_RANGES)))
+    domain_ratios = profiles[rng.randint(centers, size=domains)] * rng.lognormal(0, 0.1, (domains, len(low)))
+    domain_ratios = np.clip(domain_ratios, 0.0, 1.0)
+    domain_names = np.array(['domain' + str(i) + '.com' for i in range(domains)])
+
+    with open(filename, 'w') as f:
+        f.write(','.join(DOMAIN_COLUMNS) + '\n')
+        for start in range(0, num_rows, chunk_size):
+            size = min(chunk_size, num_rows - start)
+            positions = np.arange(start, start + size)
+            index = np.where(positions < domains, positions, rng.randint(domains, size=size))
+            ratios = domain_ratios[index]
+            request = rng.randint(1000, 100000, size)
+            block = rng.binomial(request, ratios[:, 0])
+            impression = ((request - block) * rng.uniform(0.6, 0.95, size)).astype(np.int64)
+            measured = (impression * rng.uniform(0.5, 1.0, size)).astype(np.int64)
+            pd.DataFrame({'DOMAINS': domain_names[index],
+                          'REQUEST': request,
+                          'BLOCK': block,
+                          'IMPRESSION': impression,
+                          'VIEWABLE': rng.binomial(measured, ratios[:, 1]),
+                          'MEASURED': measured,
+                          'CLICKS': rng.binomial(impression, ratios[:, 2]),
+                          'INCIDENTS': rng.binomial(impression, ratios[:, 3]),
+                          'COMPLETES': rng.binomial(impression, ratios[:, 4])},
+                         columns=DOMAIN_COLUMNS).to_csv(f, header=False, index=False)
+
+    return filename
+
+
+def generateData(scenario, settings, data_dir, seed):
+    """
+    Generate the input file of scenario in data_dir (kept if it already exists, file names depend on the size
+    and the seed). Returns the file name and the generation time (0 if the file already existed).
+    """
+    import bid_log_benchmark
+
+    if scenario == 'kmeans':
+        filename = os.path.join(data_dir, 'domains_' + str(settings['kmeans_rows']) + '_' +
+                                str(settings['kmeans_domains']) + '_seed' + str(seed) + '.csv')
+        generate = lambda: generateDomainMetrics(filename, settings['kmeans_rows'], settings['kmeans_domains'],
+                                                 seed=seed)
+    elif scenario in ('auction', 'auction_batch'):
+        filename = os.path.join(data_dir, 'bids_' + str(settings['bid_rows']) + '_seed' + str(seed) + '.txt')
+        generate = lambda: bid_log_benchmark.generateBidLog(filename, settings['bid_rows'], seed=seed)
+    else: ## the ads.txt files are served by the stub servers, the publisher list depends on their ports
+        return None, 0.0
+
+    if os.path.exists(filename):
+        return filename, 0.0
+    start = time.time()
+    generate()
+    return filename, time.time() - start
+
+
+## Scenarios
+## ---------
+## Every scenario runs in its own interpreter (see runChild()) and returns (phases, info): the time of its steps
+## in seconds and a few figures to check the runs did the same work.
+
+def importTools():
+    """Import the three tools, so the memory they use is part of the baseline of every scenario"""
+    import crawl_harness
+    import clearing_win_price_ratio
+    import domains_performance_clustering
+
+    return domains_performance_clustering, clearing_win_price_ratio, crawl_harness.loadScraper()
+
+
+def runKmeansScenario(tools, params):
+    kmeans = tools[0]
+    phases = {}
+    start = time.time()
+    names, data, column_names, min_values, max_values = kmeans.loadFeatureMatrix(params['file'], cache=False)
+    point_set = kmeans.PointSet(names, data)
+    phases['load'] = time.time() - start
+
+    random.seed(params['seed'])
+    stats = {}
+    start = time.time()
+    clusters, average_dist = kmeans.runKmeans(point_set, params['k'], params['cut_off'], params['iterations'],
+                                              stats=stats)
+    phases['runKmeans'] = time.time() - start
+
+    return phases, {'domains': len(point_set), 'iterations': stats.get('iterations'),
+                    'average_distance': average_dist}
+
+
+def runAuctionScenario(tools, params):
+    auction = tools[1]
+    phases = {}
+    start = time.time()
+    data = auction.loadDataFile(params['file'])
+    phases['loadDataFile'] = time.time() - start
+
+    start = time.time()
+    final_data_set = auction.bidsRatio(data).getRatio()
+    chi_square, p_value = auction.plotGraph(final_data_set, None)
+    auction.plt.close('all')
+    phases['plotGraph'] = time.time() - start
+
+    return phases, {'exchanges': len(data), 'chi_square': float(chi_square)}
+
+
+def runAuctionBatchScenario(tools, params):
+    auction = tools[1]
+    start = time.time()
+    table = auction.runAuctionBatch(params['file'])
+    phases = {'runAuctionBatch': time.time() - start}
+
+    return phases, {'exchanges': len(table), 'impressions': int(table['IMPRESSIONS'].sum())}
+
+
+def runAdsTxtScenario(tools, params):
+    """Sequential crawl of the publisher list, output files are written in the working directory"""
+    scraper = tools[2]
+    session = scraper.buildSession(retries=0) ## no backoff sleeps on the 500s of the stub servers
+    domains = scraper.createURLObjects(scraper.openFile(params['file']), 'ads.txt', session, params['timeout'])
+    results = scraper.CrawlResults('complete', plot=False)
+    start = time.time()
+    scraper.checkHasAdsFile(domains, 'complete', False, results=results)
+    phases = {'checkHasAdsFile': time.time() - start}
+
+    return phases, {'domains': len(domains), 'has_ads_txt': sum(1 for v in results.has_ads_txt.values() if v)}
+
+
+SCENARIO_FUNCTIONS = {'kmeans': runKmeansScenario,
+                      'auction': runAuctionScenario,
+                      'auction_batch': runAuctionBatchScenario,
+                      'adstxt': runAdsTxtScenario}
+
+
+def peakMemory():
+    """
+    Maximum resident set size of the process so far, in bytes. On Linux it is read from /proc: ru_maxrss keeps
+    the peak of the parent process after fork() + exec() (the benchmark itself while it generated the data).
+    """
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 ## kilobytes on Linux
+
+
+def runChild(scenario, params, result_file):
+    """Entry point of the scenario interpreters: run scenario and write its measures to result_file"""
+    tools = importTools()
+    baseline = peakMemory()
+    start = time.time()
+    phases, info = SCENARIO_FUNCTIONS[scenario](tools, params)
+    elapsed = time.time() - start
+    peak = peakMemory()
+
+    with open(result_file, 'w') as f:
+        json.dump({'seconds': elapsed, 'peak_memory_mb': peak / 1e6, 'memory_increase_mb': (peak - baseline) / 1e6,
+                   'phases': phases, 'info': info}, f)
+
+
+def runScenario(scenario, params, work_dir, repeat=1):
+    """
+    Run scenario repeat times, each in a fresh interpreter started in a scratch directory, and return the
+    measures of the fastest run. The output of the scenario is only printed if it fails.
+    """
+    best = None
+    for i in range(repeat):
+        scratch = tempfile.mkdtemp(prefix=scenario + '_', dir=work_dir)
+        result_file = os.path.join(scratch, 'result.json')
+        try:
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario, '--params',
+                                      json.dumps(params), '--result-file', result_file],
+                                     cwd=scratch, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if process.returncode != 0:
+                print(process.stdout.decode(errors='replace'))
+                raise RuntimeError('Scenario ' + scenario + ' failed with exit code ' + str(process.returncode))
+            with open(result_file) as f:
+                result = json.load(f)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+
+    return best
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runSuite(scale='small', scenarios=None, seed=0, repeat=1, data_dir=None, k=8, cut_off=0.0001, iterations=100,
+             hosts=8, lines=50, timeout=10):
+    """
+    Run the scenarios (default to every scenario in SCENARIOS) at scale (see SCALES) and return the results
+    (dictionnary, see saveResults()). Generated files are kept in data_dir if given and reused by the next
+    runs, otherwise they are written to a temporary directory deleted at the end.
+    """
+    import crawl_harness
+
+    settings = SCALES[scale]
+    work_dir = tempfile.mkdtemp(prefix='adops_benchmark_')
+    if data_dir is None:
+        data_dir = work_dir
+    elif not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    results = {'version': RESULTS_VERSION, 'scale': scale, 'seed': seed, 'repeat': repeat, 'commit': gitCommit(),
+               'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'numpy': np.__version__, 'pandas': pd.__version__,
+               'scenarios': {}}
+    servers = []
+    try:
+        for scenario in (SCENARIOS if scenarios is None else scenarios):
+            filename, generate_seconds = generateData(scenario, settings, data_dir, seed)
+            if scenario == 'kmeans':
+                params = {'file': filename, 'rows': settings['kmeans_rows'], 'domains': settings['kmeans_domains'],
+                          'k': k, 'cut_off': cut_off, 'iterations': iterations, 'seed': seed}
+            elif scenario in ('auction', 'auction_batch'):
+                params = {'file': filename, 'rows': settings['bid_rows']}
+            elif scenario == 'adstxt':
+                servers = crawl_harness.startServers(hosts, 0.0, lines)
+                filename = os.path.join(work_dir, 'publisher_list.csv')
+                crawl_harness.writePublisherList(filename, servers, settings['adstxt_domains'])
+                params = {'file': filename, 'domains': settings['adstxt_domains'], 'hosts': hosts, 'lines': lines,
+                          'timeout': timeout}
+            else:
+                raise ValueError('Unknown scenario ' + str(scenario) + ', expected one of ' + ', '.join(SCENARIOS))
+
+            result = runScenario(scenario, params, work_dir, repeat)
+            result['generate_seconds'] = generate_seconds
+            result['params'] = dict((key, value) for key, value in params.items() if key != 'file')
+            results['scenarios'][scenario] = result
+            print(scenario, ':', round(result['seconds'], 3), 's, peak memory', round(result['peak_memory_mb'], 1),
+                  'MB (+' + str(round(result['memory_increase_mb'], 1)) + ' MB),',
+                  ', '.join(name + ' ' + str(round(seconds, 3)) + ' s' for name, seconds in result['phases'].items()))
+
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            servers = []
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def saveResults(results, filename):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def loadResults(filename):
+    with open(filename) as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError(filename + ' was written by another version of the benchmark suite')
+    return results
+
+
+def compareResults(previous, current, tolerance=0.2, memory_tolerance=None):
+    """
+    Compare the scenarios found in both results. A scenario regresses if its time (or its memory increase)
+    is more than 1 + tolerance (or 1 + memory_tolerance, default to tolerance) times the previous one, plus
+    NOISE_SECONDS (or NOISE_MEMORY_MB) so very short scenarios do not fail on noise. Scenarios run with other
+    parameters are not compared. Returns the list of (scenario, measure, previous, current) regressions.
+    """
+    memory_tolerance = tolerance if memory_tolerance is None else memory_tolerance
+    regressions = []
+    for scenario, result in current['scenarios'].items():
+        old = previous['scenarios'].get(scenario)
+        if old is None:
+            continue
+        if old['params'] != result['params']:
+            print(scenario, ': not compared, parameters differ from the previous results')
+            continue
+        for measure, limit, noise in [('seconds', tolerance, NOISE_SECONDS),
+                                      ('memory_increase_mb', memory_tolerance, NOISE_MEMORY_MB)]:
+            change = result[measure] / old[measure] if old[measure] > 0 else 1.0
+            print(scenario, measure, ':', round(old[measure], 3), '->', round(result[measure], 3),
+                  '(' + str(round((change - 1) * 100, 1)) + '%)')
+            if result[measure] > old[measure] * (1 + limit) + noise:
+                regressions.append((scenario, measure, old[measure], result[measure]))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory benchmarks of the three AdOps tools')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=None, help='default to every scenario')
+    parser.add_argument('--skip', nargs='+', choices=SCENARIOS, default=[], help='scenarios not to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest one is kept')
+    parser.add_argument('--data-dir', default=None, help='keep the generated files in this directory and reuse them')
+    parser.add_argument('--k', type=int, default=8)
+    parser.add_argument('--hosts', type=int, default=8, help='stub HTTP servers serving the ads.txt files')
+    parser.add_argument('--lines', type=int, default=50, help='records per ads.txt file')
+    parser.add_argument('--output', default=None, help='save the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous version to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown allowed before a regression (0.2 = 20%%)')
+    parser.add_argument('--memory-tolerance', type=float, default=None, help='default to --tolerance')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--params', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        runChild(args.child, json.loads(args.params), args.result_file)
+        sys.exit(0)
+
+    scenarios = [s for s in (SCENARIOS if args.scenarios is None else args.scenarios) if s not in args.skip]
+    previous = loadResults(args.compare) if args.compare is not None else None
+    results = runSuite(args.scale, scenarios, args.seed, args.repeat, args.data_dir, args.k, hosts=args.hosts,
+                       lines=args.lines)
+    if args.output is not None:
+        saveResults(results, args.output)
+
+    if previous is not None:
+        regressions = compareResults(previous, results, args.tolerance, args.memory_tolerance)
+        for scenario, measure, old, new in regressions:
+            print('REGRESSION', scenario, measure, ':', round(old, 3), '->', round(new, 3))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Teddy Crepineau
+
+Purpose: persistent cache of ads.txt files used by has_ads.txt_scraper to re-crawl the same publisher list
+incrementally. For every domain the cache stores the ETag / Last-Modified validators returned by the
+server, a hash of the ads.txt content and the parsed records (any JSON serializable value). On the next
+crawl, requests are sent with If-None-Match / If-Modified-Since and the records are taken from the cache
+when the server answers 304 or when the content did not change.
+
+The cache is a SQLite file. Entries that were not validated for "ttl" seconds are evicted, and the least
+recently validated entries are evicted once the cache holds more than "max_entries" domains.
+"""
+
+import codecs
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def hashContent(text_page):
+    return hashlib.sha1(text_page.encode('utf-8')).hexdigest()
+
+
+class ContentHasher(object):
+    """
+    hashContent() of a page received in bytes chunks: chunks are decoded with the encoding of the response
+    (as requests does for response.text) so the hash is the same as the one of the complete page.
+    """
+
+    def __init__(self, encoding=None):
+        self.decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+        self.hash = hashlib.sha1()
+
+    def update(self, chunk):
+        self.hash.update(self.decoder.decode(chunk).encode('utf-8'))
+
+    def hexdigest(self):
+        self.hash.update(self.decoder.decode(b'', final=True).encode('utf-8'))
+        return self.hash.hexdigest()
+
+
+class AdsTxtCache(object):
+    """
+    Cache of ads.txt files keyed by domain. Hits and misses of the current run are counted in self.stats:
+       - not_modified -> server answered 304, cached records are reused
+       - unchanged -> server sent the file again but its hash did not change, cached records are reused
+       - misses -> new or changed file, the file has to be parsed
+    """
+
+    def __init__(self, filename, ttl=30*24*3600, max_entries=1000000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {'not_modified': 0, 'unchanged': 0, 'misses': 0}
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS ads_txt ('
+                                'domain TEXT PRIMARY KEY, '
+                                'etag TEXT, '
+                                'last_modified TEXT, '
+                                'content_hash TEXT, '
+                                'records TEXT, '
+                                'validated_at REAL)')
+
+    def getEntry(self, domain):
+        row = self.connection.execute('SELECT etag, last_modified, content_hash, records FROM ads_txt '
+                                      'WHERE domain = ?', (domain,)).fetchone()
+        if row is None:
+            return None
+
+        etag, last_modified, content_hash, records = row
+        return {'etag': etag, 'last_modified': last_modified, 'content_hash': content_hash,
+                'records': None if records is None else json.loads(records)}
+
+    def conditionalHeaders(self, domain, need_records=True):
+        """
+        Return the If-None-Match / If-Modified-Since headers to send for domain. No header is returned if
+        records are needed but were not cached (i.e. the domain was crawled in "limited" mode), since a 304
+        would not give us anything to parse.
+        """
+        entry = self.getEntry(domain)
+        if entry is None or (need_records and entry['records'] is None):
+            return {}
+
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def lookup(self, domain, web_page, need_records=True):
+        """
+        Return the cached records for domain if web_page (304, or 200 with the same content hash) shows the
+        ads.txt file did not change, None otherwise. Hits and misses are counted in self.stats. If records are
+        not needed, an empty list is returned on hits.
+        """
+        entry = self.getEntry(domain)
+        if entry is not None and (entry['records'] is not None or not need_records):
+            if web_page.status_code == 304:
+                self.stats['not_modified'] += 1
+                self.touch(domain, web_page)
+                return entry['records'] if need_records else []
+            if web_page.getContentHash() is not None and entry['content_hash'] == web_page.getContentHash():
+                self.stats['unchanged'] += 1
+                self.touch(domain, web_page)
+                return entry['records'] if need_records else []
+
+        self.stats['misses'] += 1
+        return None
+
+    def store(self, domain, web_page, records=None):
+        self.connection.execute('INSERT OR REPLACE INTO ads_txt VALUES (?, ?, ?, ?, ?, ?)',
+                                (domain, web_page.headers.get('ETag'), web_page.headers.get('Last-Modified'),
+                                 web_page.getContentHash(), None if records is None else json.dumps(records),
+                                 time.time()))
+
+    def touch(self, domain, web_page):
+        """Refresh validators and validation time of an entry that did not change"""
+        self.connection.execute('UPDATE ads_txt SET etag = COALESCE(?, etag), '
+                                'last_modified = COALESCE(?, last_modified), validated_at = ? WHERE domain = ?',
+                                (web_page.headers.get('ETag'), web_page.headers.get('Last-Modified'), time.time(),
+                                 domain))
+
+    def remove(self, domain):
+        self.connection.execute('DELETE FROM ads_txt WHERE domain = ?', (domain,))
+
+    def evict(self):
+        """Evict entries older than ttl, then the least recently validated entries above max_entries"""
+        self.connection.execute('DELETE FROM ads_txt WHERE validated_at < ?', (time.time() - self.ttl,))
+        self.connection.execute('DELETE FROM ads_txt WHERE domain IN (SELECT domain FROM ads_txt '
+                                'ORDER BY validated_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def getHits(self):
+        return self.stats['not_modified'] + self.stats['unchanged']
+
+    def getMisses(self):
+        return self.stats['misses']
+
+    def close(self):
+        self.evict()
+        self.connection.commit()
+        self.connection.close()
+
+    def __str__(self):
+        return ('ads.txt cache: ' + str(self.getHits()) + ' hits (' + str(self.stats['not_modified']) +
+                ' not modified, ' + str(self.stats['unchanged']) + ' unchanged), ' + str(self.getMisses()) +
+                ' misses')
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Teddy Crepineau
+
+Purpose: streaming parser for ads.txt files (IAB Tech Lab ads.txt specification v1.0.2).
+
+Each line of an ads.txt file is either:
+   - a record -> <SSP domain>, <publisher account ID>, <DIRECT|RESELLER>[, <certification authority ID>]
+   - a variable -> <NAME>=<value> (CONTACT, SUBDOMAIN, INVENTORYPARTNERDOMAIN, OWNERDOMAIN, MANAGERDOMAIN)
+   - a comment (everything after "#") or an empty line
+
+Extension fields (after ";") are ignored. SSP domains and certification authority IDs are lower cased,
+relationships and variable names are upper cased and whitespace around fields is removed. Lines that are
+neither a valid record nor a variable are counted as malformed and skipped.
+
+The parser consumes the page content in chunks (str or bytes) so a response body can be parsed while it
+is being downloaded, and yields AdsTxtRecord / AdsTxtVariable tuples.
+"""
+
+import codecs
+from collections import namedtuple
+
+AdsTxtRecord = namedtuple('AdsTxtRecord', ['domain', 'ssp', 'pub_id', 'sales_channel', 'cert_auth_id'])
+AdsTxtVariable = namedtuple('AdsTxtVariable', ['domain', 'name', 'value'])
+
+SALES_CHANNELS = frozenset(['DIRECT', 'RESELLER'])
+
+
+class AdsTxtParser(object):
+    """
+    Parse the ads.txt file of publisher "domain". Feed the content with feed() (as many times as needed),
+    then call close(). Both return the list of records and variables found in the complete lines received.
+    Counters of records, variables and malformed lines are kept on the object.
+    """
+
+    def __init__(self, domain, encoding='utf-8'):
+        self.domain = domain
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.remainder = ''
+        self.first_line = True
+        self.records = 0
+        self.variables = 0
+        self.malformed = 0
+
+    def feed(self, chunk):
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk)
+        if not chunk:
+            return []
+
+        lines = (self.remainder + chunk).split('\n')
+        self.remainder = lines.pop() ## last line may be incomplete, keep it for the next chunk
+        return self.parseLines(lines)
+
+    def close(self):
+        lines = [self.remainder + self.decoder.decode(b'', final=True)]
+        self.remainder = ''
+        return self.parseLines(lines)
+
+    def parseLines(self, lines):
+        if self.first_line and lines:
+            lines[0] = lines[0].lstrip('\ufeff') ## byte order mark
+            self.first_line = False
+
+        parsed = []
+        records = 0
+        append = parsed.append
+        new_record = AdsTxtRecord._make
+        domain = self.domain
+        for line in lines:
+            if '#' in line:
+                line = line[:line.index('#')]
+            if ';' in line:
+                line = line[:line.index(';')]
+            fields = line.split(',')
+            if 3 <= len(fields) <= 4: ## record, checked first as it is by far the most common line
+                ssp = fields[0].strip().lower()
+                pub_id = fields[1].strip()
+                sales_channel = fields[2].strip().upper()
+                cert_auth_id = fields[3].strip().lower() if len(fields) == 4 else ''
+                if ssp and pub_id and sales_channel in SALES_CHANNELS and ' ' not in ssp:
+                    append(new_record((domain, ssp, pub_id, sales_channel, cert_auth_id)))
+                    records += 1
+                    continue
+            else:
+                item = self.parseOtherLine(line.strip())
+                if item is not None:
+                    append(item)
+                continue
+            self.malformed += 1
+
+        self.records += records
+        return parsed
+
+    def parseOtherLine(self, line):
+        """Parse a line that is not a record: empty line, variable or malformed line"""
+        if not line:
+            return None
+
+        name, equal, value = line.partition('=')
+        name = name.strip()
+        if equal and name and ' ' not in name and ',' not in line:
+            self.variables += 1
+            return AdsTxtVariable(self.domain, name.upper(), value.strip())
+
+        self.malformed += 1
+        return None
+
+    def parse(self, chunks):
+        """Generator yielding every record and variable found in an iterable of chunks"""
+        for chunk in chunks:
+            for item in self.feed(chunk):
+                yield item
+        for item in self.close():
+            yield item
+
+
+def parseAdsTxtContent(domain, content):
+    """
+    Parse a complete ads.txt page (str or bytes) or an iterable of chunks (e.g. response.iter_content()).
+    Returns (records, variables, number of malformed lines).
+    """
+    parser = AdsTxtParser(domain)
+    if isinstance(content, (str, bytes)):
+        content = [content]
+
+    records = []
+    variables = []
+    for item in parser.parse(content):
+        if isinstance(item, AdsTxtRecord):
+            records.append(item)
+        else:
+            variables.append(item)
+
+    return records, variables, parser.malformed
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Teddy Crepineau
+
+Purpose: write the output of has_ads.txt_scraper to disk while the crawl is running instead of keeping every
+record in memory until the end.
+
+   - CSVRecordSink -> append-only CSV file (same format as the ads.txt_data.csv written with pandas)
+   - ParquetRecordSink -> directory of Parquet files, one file per batch (requires pyarrow)
+   - CrawlJournal -> list of the domains already crawled, used to resume an interrupted crawl
+
+Rows are buffered and written in batches. Once a batch is on disk, the domains it contains are added to the
+journal together with the position of every sink (byte offset for CSV files, number of files for Parquet).
+When a crawl is resumed, the sinks are truncated back to the last position recorded in the journal so rows
+of domains that were not journaled are not written twice.
+"""
+
+import csv
+import os
+
+
+class CSVRecordSink(object):
+    """
+    Append rows to a CSV file. flush() writes buffered rows and returns the size of the file, which can be
+    given back to truncate() to drop everything written after that point.
+    """
+
+    def __init__(self, filename, columns, resume=False):
+        self.filename = filename
+        self.columns = columns
+        self.buffer = []
+        self.file = open(filename, 'a+' if resume else 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        if self.file.tell() == 0:
+            self.writer.writerow(columns)
+            self.file.flush()
+        self.header_size = len((','.join(columns) + '\n').encode('utf-8'))
+
+    def write(self, rows):
+        self.buffer += rows
+
+    def flush(self):
+        if self.buffer:
+            self.writer.writerows(self.buffer)
+            self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def truncate(self, position):
+        self.buffer = []
+        self.file.flush()
+        self.file.truncate(max(position, self.header_size))
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class ParquetRecordSink(object):
+    """
+    Write rows to a directory of Parquet files (dataset readable with pandas.read_parquet(directory)). Every
+    flush() writes one part file and returns the number of part files.
+    """
+
+    def __init__(self, directory, columns, resume=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('pyarrow is required to write Parquet files (pip install pyarrow)')
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+        self.directory = directory
+        self.columns = columns
+        self.buffer = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not resume:
+            self.truncate(0)
+        self.parts = len(self.listParts())
+
+    def listParts(self):
+        return sorted(f for f in os.listdir(self.directory) if f.startswith('part-') and f.endswith('.parquet'))
+
+    def write(self, rows):
+        self.buffer += rows
+
+    def flush(self):
+        if self.buffer:
+            columns = list(zip(*self.buffer))
+            table = self.pa.Table.from_arrays([self.pa.array(c, type=self.pa.string()) for c in columns],
+                                              names=self.columns)
+            filename = os.path.join(self.directory, 'part-' + str(self.parts).zfill(6) + '.parquet')
+            self.pq.write_table(table, filename + '.tmp')
+            os.replace(filename + '.tmp', filename) ## a part file is either complete or absent
+            self.parts += 1
+            self.buffer = []
+        return self.parts
+
+    def truncate(self, position):
+        self.buffer = []
+        for f in os.listdir(self.directory):
+            if f.endswith('.tmp') or (f.startswith('part-') and int(f[5:11]) >= position):
+                os.remove(os.path.join(self.directory, f))
+        self.parts = position
+
+    def close(self):
+        self.flush()
+
+
+class CrawlJournal(object):
+    """
+    CSV file listing every domain crawled so far: domain, has ads.txt (True, False or empty if the request
+    failed) and the position of each sink once the domain's rows were written.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.finished = {}
+        self.positions = []
+        if resume and os.path.exists(filename):
+            with open(filename, 'r+b') as f:
+                content = f.read()
+                complete = content.rfind(b'\n') + 1
+                f.truncate(complete) ## drop the last line if it was partially written
+            for row in csv.reader(content[:complete].decode('utf-8').splitlines()):
+                self.finished[row[0]] = row[1]
+                self.positions = [int(p) for p in row[2:]]
+        self.file = open(filename, 'a' if resume else 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+
+    def getFinished(self):
+        """Return a dictionnary mapping every crawled domain to True, False or None"""
+        return {k: {'True': True, 'False': False}.get(v) for k, v in self.finished.items()}
+
+    def getPositions(self):
+        return self.positions
+
+    def append(self, domains, positions):
+        """domains is a list of (domain, has ads.txt) for which rows are on disk up to "positions" """
+        for domain, has_ads_txt in domains:
+            self.writer.writerow([domain, '' if has_ads_txt is None else has_ads_txt] + list(positions))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.filename)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Teddy Crepineau
+
+Purpose: offline harness for the ads.txt scraper. Starts local stub HTTP servers serving synthetic ads.txt
+files, runs runHasAdstxt() against them (sequential and/or concurrent) and reports throughput, number of
+requests sent per domain and whether both modes produced the same output files.
+
+It also measures the time needed to import has_ads.txt_scraper.py (the scraper is started once per batch
+by our jobs) and checks it against a budget.
+
+Usage: python crawl_harness.py --domains 2000 --concurrency 64 --latency 0.05
+       python crawl_harness.py --import-budget 400
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import os
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def loadScraper():
+    """
+    Import has_ads.txt_scraper.py as a module (the file name is not a valid module name).
+    """
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE) ## sibling modules (ads_txt_parser, etc.)
+    spec = importlib.util.spec_from_file_location('has_ads_txt_scraper', os.path.join(HERE, 'has_ads.txt_scraper.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def buildAdsTxt(pub_index, lines):
+    """
+    Return a synthetic ads.txt file with "lines" records, comments, inline comments and a contact variable.
+    """
+    content = ['# ads.txt file for pub' + str(pub_index), 'contact=adops@pub' + str(pub_index) + '.com']
+    for i in range(lines):
+        relationship = 'DIRECT' if i % 3 == 0 else 'RESELLER'
+        record = 'ssp' + str(i % 40) + '.com, ' + str(pub_index * 1000 + i) + ', ' + relationship
+        if i % 2 == 0:
+            record += ', f08c47fec0942fa0'
+        if i % 7 == 0:
+            record += ' # inline comment'
+        content.append(record)
+
+    return '\r\n'.join(content) + '\r\n'
+
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server answering /pub<N>/ads.txt. Every 10th publisher returns 404, every 25th publisher
+    returns 500, every other publisher returns a synthetic ads.txt file after "latency" seconds. ads.txt files
+    are sent with an ETag and a 304 is returned when If-None-Match matches it.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.0, lines=50):
+        self.latency = latency
+        self.lines = lines
+        self.request_count = 0
+        self.count_lock = threading.Lock()
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+
+    def getAddress(self):
+        return '127.0.0.1:' + str(self.server_address[1])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.count_lock:
+            server.request_count += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        parts = [p for p in self.path.split('/') if p]
+        try:
+            pub_index = int(parts[0][3:])
+        except (IndexError, ValueError):
+            pub_index = 0
+
+        if pub_index % 10 == 0:
+            status, body = 404, b'Not Found'
+        elif pub_index % 25 == 1:
+            status, body = 500, b'Internal Server Error'
+        else:
+            status, body = 200, buildAdsTxt(pub_index, server.lines).encode('utf-8')
+
+        etag = None
+        if status == 200:
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startServers(hosts, latency, lines):
+    servers = []
+    for i in range(hosts):
+        server = StubServer(latency, lines)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+
+    return servers
+
+
+def writePublisherList(filename, servers, domains):
+    """
+    Write a publisher list in the same format as publisher_list.csv. Domains are spread over the stub servers
+    so every server acts as a separate host.
+    """
+    with open(filename, 'w') as f:
+        f.write('DOMAINS\n')
+        for i in range(domains):
+            f.write(servers[i % len(servers)].getAddress() + '/pub' + str(i) + '\n')
+
+
+def timeRun(scraper, servers, work_dir, **kwargs):
+    for server in servers:
+        server.request_count = 0
+    os.makedirs(work_dir)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        start = time.time()
+        scraper.runHasAdstxt(os.path.join('..', 'publisher_list.csv'), 'ads.txt', filter_status='complete',
+                             print_status=False, plot=False, **kwargs)
+        elapsed = time.time() - start
+    finally:
+        os.chdir(cwd)
+
+    return elapsed, sum(server.request_count for server in servers)
+
+
+def sameOutput(dir_a, dir_b):
+    """Compare output files of two runs (row order is ignored)"""
+    for name in ['has_ads_txt.csv', 'ads.txt_data.csv']:
+        with open(os.path.join(dir_a, name)) as a, open(os.path.join(dir_b, name)) as b:
+            if sorted(a.readlines()) != sorted(b.readlines()):
+                return False
+    return True
+
+
+IMPORT_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, %r)
+import importlib.util
+spec = importlib.util.spec_from_file_location('has_ads_txt_scraper', %r)
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(time.perf_counter() - start, 'pandas' in sys.modules, 'matplotlib' in sys.modules)
+"""
+
+
+def measureImportTime(runs=5):
+    """
+    Import the scraper in fresh interpreters and return the fastest import time in seconds, and whether
+    pandas or matplotlib were imported along with it.
+    """
+    snippet = IMPORT_SNIPPET % (HERE, os.path.join(HERE, 'has_ads.txt_scraper.py'))
+    timings = []
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', snippet], cwd=HERE).decode().split()
+        timings.append(float(output[0]))
+
+    return min(timings), output[1] == 'True', output[2] == 'True'
+
+
+def checkImportTime(budget_ms, runs=5):
+    elapsed, pandas_loaded, matplotlib_loaded = measureImportTime(runs)
+    print('Import time:', round(elapsed * 1000, 1), 'ms (budget', budget_ms, 'ms), pandas loaded:', pandas_loaded,
+          ', matplotlib loaded:', matplotlib_loaded)
+
+    return elapsed * 1000 <= budget_ms and not pandas_loaded and not matplotlib_loaded
+
+
+def runHarness(domains=1000, hosts=8, concurrency=32, per_host=8, latency=0.02, lines=50, timeout=10,
+               sequential=True, retries=0, cache=False):
+    scraper = loadScraper()
+    servers = startServers(hosts, latency, lines)
+    work_dir = tempfile.mkdtemp(prefix='adstxt_harness_')
+
+    try:
+        writePublisherList(os.path.join(work_dir, 'publisher_list.csv'), servers, domains)
+
+        report = []
+        if sequential:
+            elapsed, requests_sent = timeRun(scraper, servers, os.path.join(work_dir, 'sequential'), retries=retries)
+            report.append(('sequential', elapsed, requests_sent))
+
+        elapsed, requests_sent = timeRun(scraper, servers, os.path.join(work_dir, 'concurrent'),
+                                         concurrency=concurrency, per_host=per_host, timeout=timeout,
+                                         retries=retries)
+        report.append(('concurrency=' + str(concurrency), elapsed, requests_sent))
+
+        if cache: ## cold then warm crawl sharing the same ads.txt cache
+            cache_file = os.path.join(work_dir, 'ads_txt_cache.sqlite')
+            for run in ['cold', 'warm']:
+                elapsed, requests_sent = timeRun(scraper, servers, os.path.join(work_dir, 'cache_' + run),
+                                                 concurrency=concurrency, per_host=per_host, timeout=timeout,
+                                                 retries=retries, cache_file=cache_file)
+                report.append(('cache ' + run, elapsed, requests_sent))
+
+        for mode, elapsed, requests_sent in report:
+            print(mode, ':', round(elapsed, 2), 's ->', round(domains / elapsed, 1), 'domains/s,',
+                  round(requests_sent / domains, 2), 'requests/domain')
+
+        if sequential:
+            print('Same output files:', sameOutput(os.path.join(work_dir, 'sequential'),
+                                                   os.path.join(work_dir, 'concurrent')))
+        if cache:
+            print('Same output files with warm cache:', sameOutput(os.path.join(work_dir, 'concurrent'),
+                                                                   os.path.join(work_dir, 'cache_warm')))
+        return report
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline throughput harness for the ads.txt scraper')
+    parser.add_argument('--domains', type=int, default=1000)
+    parser.add_argument('--hosts', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--per-host', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the stub waits before answering')
+    parser.add_argument('--lines', type=int, default=50, help='records per ads.txt file')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--retries', type=int, default=0, help='retries on 5XX (stub servers answer 500 for 4%% of pubs)')
+    parser.add_argument('--skip-sequential', action='store_true')
+    parser.add_argument('--cache', action='store_true', help='also run a cold and a warm crawl with the ads.txt cache')
+    parser.add_argument('--import-budget', type=float, default=None,
+                        help='only check that importing the scraper takes less than this many ms')
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        sys.exit(0 if checkImportTime(args.import_budget) else 1)
+
+    runHarness(args.domains, args.hosts, args.concurrency, args.per_host, args.latency, args.lines, args.timeout,
+               not args.skip_sequential, args.retries, args.cache)
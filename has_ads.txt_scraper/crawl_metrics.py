@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Teddy Crepineau
+
+Purpose: telemetry of an ads.txt crawl. For every domain we keep the DNS, connect, time to first byte (TTFB)
+and total latency of the request, the number of redirects, the number of bytes received, the HTTP status
+class and the time spent parsing the ads.txt file.
+
+   - TimedHTTPAdapter -> requests adapter whose connections record DNS / connect / TTFB timings of the
+                         request sent by the current thread (see startRequestTimings())
+   - CrawlMetrics -> collects the per-domain metrics, writes them to a CSV file, prints a live progress line
+                     and exports histograms and percentiles as JSON at the end of the run
+
+Timings are in milliseconds. dns and connect are 0 when a kept-alive connection is reused, connect includes
+the TLS handshake for https URLs and every value includes retries and redirects. DNS time is measured through
+private members of the urllib3 connections (_new_conn(), _dns_host): if a urllib3 version doesn't have them,
+it is reported as 0 and the name resolution is counted in the connect time.
+"""
+
+import bisect
+import json
+import socket
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from ads_txt_sink import CSVRecordSink
+
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000] ## ms, upper bounds
+BYTES_BUCKETS = [0, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+PERCENTILES = [50, 90, 95, 99]
+TIMINGS = ['dns', 'connect', 'ttfb', 'total', 'parse']
+METRICS_LABELS = ['DOMAINS', 'HOST', 'STATUS', 'STATUS_CLASS', 'REDIRECTS', 'BYTES'] + \
+                 [t.upper() + '_MS' for t in TIMINGS] + ['ERROR']
+
+_request_timings = threading.local()
+
+
+def startRequestTimings():
+    """Start recording the timings of the requests sent by the current thread, returns the timings dict"""
+    _request_timings.current = {'dns': 0.0, 'connect': 0.0, 'ttfb': 0.0, 'connections': 0}
+    return _request_timings.current
+
+
+def stopRequestTimings():
+    timings = getattr(_request_timings, 'current', None)
+    _request_timings.current = None
+    return timings
+
+
+class TimedConnectionMixin(object):
+    """
+    Add the DNS and connect time of every new connection, and the TTFB of the last response, to the timings
+    of the current thread. Connections behave exactly as usual when no timings are being recorded, or when
+    the urllib3 connection has no _dns_host to resolve (DNS time is then left at 0).
+    """
+
+    def _new_conn(self):
+        timings = getattr(_request_timings, 'current', None)
+        if timings is None or not isinstance(getattr(self, '_dns_host', None), str):
+            return super(TimedConnectionMixin, self)._new_conn()
+
+        start = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror:
+            timings['dns'] += time.perf_counter() - start
+            return super(TimedConnectionMixin, self)._new_conn() ## raises the usual NameResolutionError
+        timings['dns'] += time.perf_counter() - start
+
+        ## connect to the address we just resolved so the name is not resolved twice, and fall back on the
+        ## usual connection (which tries every address) if the host has several addresses
+        dns_host = self._dns_host
+        try:
+            self._dns_host = addresses[0][4][0]
+        except AttributeError: ## read-only in this urllib3 version, let it resolve the name again
+            return super(TimedConnectionMixin, self)._new_conn()
+        try:
+            return super(TimedConnectionMixin, self)._new_conn()
+        except Exception:
+            if len(set(a[4][0] for a in addresses)) == 1:
+                raise
+        finally:
+            self._dns_host = dns_host
+        return super(TimedConnectionMixin, self)._new_conn()
+
+    def connect(self):
+        timings = getattr(_request_timings, 'current', None)
+        if timings is None:
+            return super(TimedConnectionMixin, self).connect()
+
+        start = time.perf_counter()
+        dns = timings['dns']
+        try:
+            return super(TimedConnectionMixin, self).connect()
+        finally:
+            timings['connect'] += time.perf_counter() - start - (timings['dns'] - dns)
+            timings['connections'] += 1
+
+    def request(self, *args, **kwargs):
+        self.request_start = time.perf_counter()
+        return super(TimedConnectionMixin, self).request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        response = super(TimedConnectionMixin, self).getresponse(*args, **kwargs)
+        timings = getattr(_request_timings, 'current', None)
+        if timings is not None and getattr(self, 'request_start', None) is not None:
+            timings['ttfb'] = time.perf_counter() - self.request_start
+        return response
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter using TimedHTTPConnection / TimedHTTPSConnection (same arguments as HTTPAdapter)"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+
+def getStatusClass(status_code):
+    return 'error' if status_code is None else str(status_code // 100) + 'xx'
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted sequence"""
+    if not sorted_values:
+        return None
+    rank = max(int(-(-p * len(sorted_values) // 100)), 1) ## ceil(p * n / 100)
+    return sorted_values[rank - 1]
+
+
+def histogram(values, buckets):
+    """Number of values <= every bucket upper bound (not cumulative), values above the last bound go to "inf" """
+    counts = [0] * (len(buckets) + 1)
+    for value in values:
+        counts[bisect.bisect_left(buckets, value)] += 1
+    return [{'le': bound, 'count': count} for bound, count in zip(buckets + ['inf'], counts)]
+
+
+def summarize(values, buckets):
+    sorted_values = sorted(values)
+    summary = {'count': len(sorted_values),
+               'mean': round(sum(sorted_values) / len(sorted_values), 3) if sorted_values else None,
+               'max': sorted_values[-1] if sorted_values else None}
+    for p in PERCENTILES:
+        summary['p' + str(p)] = percentile(sorted_values, p)
+    summary['histogram'] = histogram(sorted_values, buckets)
+    return summary
+
+
+class CrawlMetrics(object):
+    """
+    Per-domain metrics of a crawl. record() is called once per domain with the WebPage returned by
+    URLOperations.openWebPage() (see WebPage.timings) and the time spent parsing it. Rows are written to
+    domain_file (CSV, appended to when resume is True), the aggregates of the run are written to json_file
+    by close(). A progress line (domains done, throughput, p95 latency, errors) is printed to stderr at most
+    every progress_interval seconds if progress is True.
+    """
+
+    def __init__(self, json_file=None, domain_file=None, total=0, progress=False, progress_interval=1.0,
+                 resume=False, slow_hosts=10):
+        self.json_file = json_file
+        self.sink = None if domain_file is None else CSVRecordSink(domain_file, METRICS_LABELS, resume)
+        self.total = total
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.slow_hosts = slow_hosts
+
+        self.values = dict((t, array('d')) for t in TIMINGS)
+        self.bytes = array('q')
+        self.hosts = []
+        self.status_classes = Counter()
+        self.statuses = Counter()
+        self.redirects = Counter()
+        self.errors = Counter()
+        self.start = time.time()
+        self.last_progress = 0.0
+
+    def record(self, domain_name, web_page, parse_time=0.0):
+        timings = web_page.timings or {}
+        host = timings.get('host', '')
+        values = dict((t, round(timings.get(t, 0.0) * 1000, 3)) for t in TIMINGS[:-1])
+        values['parse'] = round(parse_time * 1000, 3)
+        for t in TIMINGS:
+            self.values[t].append(values[t])
+        size = timings.get('bytes', 0)
+        self.bytes.append(size)
+        self.hosts.append(host)
+
+        status_class = getStatusClass(web_page.status_code)
+        self.status_classes[status_class] += 1
+        self.statuses[str(web_page.status_code)] += 1
+        self.redirects[timings.get('redirects', 0)] += 1
+        error = '' if web_page.error is None else type(web_page.error).__name__
+        if error:
+            self.errors[error] += 1
+
+        if self.sink is not None:
+            self.sink.write([[domain_name, host, web_page.status_code, status_class, timings.get('redirects', 0),
+                              size] + [values[t] for t in TIMINGS] + [error]])
+            if len(self.sink.buffer) >= 1000:
+                self.sink.flush()
+
+        if self.progress and time.time() - self.last_progress >= self.progress_interval:
+            self.printProgress()
+
+    def getDone(self):
+        return len(self.hosts)
+
+    def printProgress(self, end=''):
+        self.last_progress = time.time()
+        elapsed = max(self.last_progress - self.start, 1e-9)
+        recent = sorted(self.values['total'][-1000:])
+        line = (str(self.getDone()) + '/' + str(self.total) + ' domains, ' +
+                str(round(self.getDone() / elapsed, 1)) + ' domains/s, p95 latency ' +
+                str(round(percentile(recent, 95) or 0)) + ' ms, ' +
+                str(sum(self.errors.values())) + ' errors')
+        sys.stderr.write('\r' + line.ljust(79) + end)
+        sys.stderr.flush()
+
+    def getSlowHosts(self):
+        """
+        Hosts ranked by total time spent fetching their domains, with the number of their domains slower than
+        the p95 latency of the crawl (hosts dominating the tail of the crawl).
+        """
+        p95 = percentile(sorted(self.values['total']), 95)
+        hosts = defaultdict(lambda: {'domains': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'above_p95': 0})
+        for host, total in zip(self.hosts, self.values['total']):
+            stats = hosts[host]
+            stats['domains'] += 1
+            stats['total_ms'] += total
+            stats['max_ms'] = max(stats['max_ms'], total)
+            if p95 is not None and total > p95:
+                stats['above_p95'] += 1
+
+        ranking = sorted(hosts.items(), key=lambda item: item[1]['total_ms'], reverse=True)[:self.slow_hosts]
+        return [dict(host=host, mean_ms=round(stats['total_ms'] / stats['domains'], 3),
+                     total_ms=round(stats['total_ms'], 3), max_ms=stats['max_ms'], domains=stats['domains'],
+                     above_p95=stats['above_p95']) for host, stats in ranking]
+
+    def getSummary(self):
+        elapsed = time.time() - self.start
+        summary = {'domains': self.getDone(),
+                   'elapsed_s': round(elapsed, 3),
+                   'domains_per_s': round(self.getDone() / elapsed, 3) if elapsed else None,
+                   'status_classes': dict(self.status_classes),
+                   'statuses': dict(self.statuses),
+                   'errors': dict(self.errors),
+                   'redirects': dict((str(k), v) for k, v in sorted(self.redirects.items())),
+                   'bytes': summarize(self.bytes, BYTES_BUCKETS)}
+        summary['bytes']['sum'] = sum(self.bytes)
+        for t in TIMINGS:
+            summary[t + '_ms'] = summarize(self.values[t], LATENCY_BUCKETS)
+        summary['slow_hosts'] = self.getSlowHosts()
+        return summary
+
+    def close(self):
+        """Flush the per-domain rows, write the JSON summary and return it"""
+        if self.progress:
+            self.printProgress(end='\n')
+        if self.sink is not None:
+            self.sink.close()
+
+        summary = self.getSummary()
+        if self.json_file is not None:
+            with open(self.json_file, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
+
+    def __str__(self):
+        total = sorted(self.values['total'])
+        return ('Crawl metrics: ' + str(self.getDone()) + ' domains, latency p50 ' +
+                str(percentile(total, 50)) + ' ms, p95 ' + str(percentile(total, 95)) + ' ms, p99 ' +
+                str(percentile(total, 99)) + ' ms, ' + str(sum(self.errors.values())) + ' errors')
@@ -3,23 +3,109 @@
 @author: Teddy Crepineau
 
 Purpose: scrape a list of publisher ads.txt file and returns list of authorized digital sellers        
+
+Usage: the module can be imported (runHasAdstxt() is the main entry point) or run from the command line:
+    python has_ads.txt_scraper.py publisher_list.csv --mode complete --concurrency 32 --no-plot
+Run with --help for the list of options. pandas and matplotlib are only imported when they are needed.
 """
 
-import pandas as pd
+import argparse
+import csv
+import os
+import sys
+import time
 import requests
-import re
-import matplotlib.pyplot as plt
+from urllib3.util.retry import Retry
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from ads_txt_cache import AdsTxtCache, ContentHasher, hashContent
+from ads_txt_parser import AdsTxtParser, AdsTxtRecord, AdsTxtVariable, parseAdsTxtContent
+from ads_txt_sink import CSVRecordSink, ParquetRecordSink, CrawlJournal
+from crawl_metrics import CrawlMetrics, TimedHTTPAdapter, startRequestTimings, stopRequestTimings
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64'
+
+DATA_LABELS = ["DOMAINS","SSP","PUB_ID","SALES_CHANNEL","CERT_AUTH_ID"]
+VARIABLE_LABELS = ["DOMAINS","VARIABLE","VALUE"]
+JOURNAL_FILE = "ads.txt_crawl_journal.csv"
+METRICS_FILE = "ads.txt_crawl_metrics.json"
+DOMAIN_METRICS_FILE = "ads.txt_crawl_metrics.csv"
+STREAM_CHUNK_SIZE = 16384 ## bytes of the response body parsed at a time (see URLOperations.streamWebPage())
+
+
+def buildSession(pool_size=10, retries=2, backoff_factor=0.5):
+    """
+    Build a requests Session shared by every URLOperations object so connections (and TCP/TLS handshakes)
+    are reused across domains. pool_size is the number of connections kept alive per host, retries and
+    backoff_factor define the retry policy applied to connection errors and 5XX responses (sleep between
+    retries is backoff_factor * 2^(retry number - 1) seconds). Connections record the DNS / connect / TTFB
+    timings of the requests (see crawl_metrics.py).
+    """
+    retry_policy = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504),
+                         raise_on_status=False)
+    adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_policy)
+    
+    session = requests.Session()
+    session.headers.update({'user-agent': USER_AGENT})
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    
+    return session
+
+
+class WebPage(object):
+    """
+    Result of a single request: HTTP status, final URL (after redirects), headers and content of the page.
+    status_code is None if the request failed (timeout, DNS error, etc.), the exception is kept in error.
+    timings holds the telemetry of the request (host, dns, connect, ttfb and total in seconds, redirects and
+    bytes received).
+    
+    Pages parsed while they were downloaded (see URLOperations.streamWebPage()) have no text: parsed holds
+    (records, variables, number of malformed lines), parse_time the time spent parsing and content_hash the
+    hash of the content (see ads_txt_cache.py).
+    """
+    
+    def __init__(self, status_code, url, headers, text, error=None, timings=None, parsed=None, parse_time=0.0,
+                 content_hash=None):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.text = text
+        self.error = error
+        self.timings = timings
+        self.parsed = parsed
+        self.parse_time = parse_time
+        self.content_hash = content_hash
+    
+    def getContentHash(self):
+        if self.content_hash is None and self.text is not None:
+            self.content_hash = hashContent(self.text)
+        return self.content_hash
+    
+    def releaseContent(self):
+        """Drop the page content once it has been parsed, status, url and headers are kept"""
+        self.text = None
+        self.parsed = None
+
 
 class URLOperations(object):
     """
     Given a list of domain, the class will 1) build the full URL, 2) send a request to the defaukt browser 
     to open the webpage, and 3) parse the page and return its content. This class assumes that the webpage is
-    encoded in utf-8.
+    encoded in utf-8. The page is only requested once, the response is kept in a WebPage object and reused
+    by checkHTTPCode() and parsedWebPage(). With parse=True, ads.txt files are parsed while they are downloaded
+    instead (see streamWebPage()).
     """
     
-    def __init__(self, domain, path):
+    def __init__(self, domain, path, session=None, timeout=None, parse=False):
         self.domain = domain
         self.path = path
+        self.session = session
+        self.timeout = timeout
+        self.parse = parse
+        self.request_headers = {'user-agent': USER_AGENT}
+        self.web_page = None
         
     def getDomain(self):
         return self.domain
@@ -30,6 +116,12 @@ class URLOperations(object):
     def getFullURL(self):
         return self.buildURL()
     
+    def getHost(self):
+        return urlsplit(self.buildURL()).netloc.lower()
+    
+    def addRequestHeaders(self, headers):
+        self.request_headers.update(headers)
+    
     def doesExist(self):
         return self.checkPageExist()
     
@@ -37,9 +129,58 @@ class URLOperations(object):
         return 'http://' + self.domain + self.getPath()  #assumes browser will redirect to https://...  
                                                     #if https://... exists
     def openWebPage(self):
-        headers = {'user-agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64'}
-        req = requests.get(self.getFullURL(), headers=headers)
-        return req
+        if self.web_page is None:
+            session = self.session if self.session is not None else requests
+            timings = startRequestTimings()
+            start = time.perf_counter()
+            try:
+                if self.parse:
+                    self.web_page = self.streamWebPage(session, timings)
+                else:
+                    req = session.get(self.getFullURL(), headers=self.request_headers, timeout=self.timeout)
+                    timings.update(redirects=len(req.history), bytes=len(req.content))
+                    self.web_page = WebPage(req.status_code, req.url, req.headers, req.text)
+            except requests.RequestException as e:
+                timings.update(redirects=0, bytes=0)
+                self.web_page = WebPage(None, self.getFullURL(), {}, None, error=e)
+            finally:
+                stopRequestTimings()
+            timings.update(host=self.getHost(), total=time.perf_counter() - start)
+            self.web_page.timings = timings
+        return self.web_page
+    
+    def streamWebPage(self, session, timings):
+        """
+        Send the request with stream=True and feed the body of a 200 response to an AdsTxtParser in chunks of
+        STREAM_CHUNK_SIZE bytes as it is received, so the page is never held in memory as a whole. The content
+        hash is computed on the same chunks. Other responses are read as usual.
+        """
+        with session.get(self.getFullURL(), headers=self.request_headers, timeout=self.timeout,
+                         stream=True) as req:
+            if req.status_code != 200:
+                timings.update(redirects=len(req.history), bytes=len(req.content))
+                return WebPage(req.status_code, req.url, req.headers, req.text)
+            
+            parser = AdsTxtParser(self.domain)
+            hasher = ContentHasher(req.encoding)
+            items = []
+            size = 0
+            parse_time = 0.0
+            for chunk in req.iter_content(STREAM_CHUNK_SIZE):
+                size += len(chunk)
+                hasher.update(chunk)
+                start = time.perf_counter()
+                items += parser.feed(chunk)
+                parse_time += time.perf_counter() - start
+            start = time.perf_counter()
+            items += parser.close()
+            records = [item for item in items if isinstance(item, AdsTxtRecord)]
+            variables = [item for item in items if not isinstance(item, AdsTxtRecord)]
+            parse_time += time.perf_counter() - start
+            
+            timings.update(redirects=len(req.history), bytes=size)
+            return WebPage(req.status_code, req.url, req.headers, None, parsed=(records, variables, parser.malformed),
+                           parse_time=parse_time, content_hash=hasher.hexdigest())
     
     def checkHTTPCode(self):
         return self.openWebPage().status_code
@@ -48,7 +189,7 @@ class URLOperations(object):
         return self.openWebPage().text # assumes webpage is encoded in utf-8
     
     def __str__(self):
-        return str(self.buildURL)
+        return str(self.buildURL())
 
 
 
@@ -65,86 +206,319 @@ def openFile(file):
     
     return list_of_domains
 
-def createURLObjects(domains, path):
+def createURLObjects(domains, path, session=None, timeout=None, parse=False):
     """
     Build full URL to scrape. "domains" correspond to a list of url returned by the openFile function. "path"
     is a simple string indicating the path of the URL. DO NOT INCLUDE "/" in your path (i.e. for test.com/test),
     simply include "test" as the path. The decision to create a separate function is intented to create 
     flexibility for the user to scrape different webpage - even though this program is specifically intended 
-    to scrape ads.txt pages
+    to scrape ads.txt pages. All objects share the same "session" (see buildSession()). parse=True parses the
+    ads.txt files while they are downloaded (see URLOperations.streamWebPage()).
     """
     full_url = []
     
     for domain in domains:
-        full_url.append(URLOperations(domain, path)) #create URLOperations object and append them to full_url list
+        full_url.append(URLOperations(domain, path, session, timeout, parse)) #create URLOperations object and append them to full_url list
         
     return full_url
 
-def checkHasAdsFile(list_domain_objects, filter_status, print_status):
+class CrawlResults(object):
+    """
+    Results of a crawl: has_ads_txt maps every domain to True/False, ads_txt_data and ads_txt_variables buffer
+    the records and variables of the ads.txt files (filter_status == "complete" only).
+    
+    Buffered rows are written to ads.txt_data / ads.txt_variables (.csv or .parquet directory, depending on
+    output_format) in batches of batch_size rows as soon as domains finish, and finished domains are listed
+    in a journal (see ads_txt_sink.py). With resume=True, the journal of an interrupted crawl is reloaded:
+    domains already crawled are skipped and their rows are kept. plot and plot_file are passed to
+    structureData() at the end of the crawl. metrics is the CrawlMetrics object fed with every domain (or
+    None).
+    
+    If index_file is set, the seller index saved in that file (see seller_index.py) is updated with the
+    records of every crawled domain and saved back when the crawl ends.
+    """
+    
+    def __init__(self, filter_status="limited", output_format="csv", batch_size=10000, resume=False, plot=True,
+                 plot_file=None, index_file=None, metrics=None):
+        self.has_ads_txt = {}
+        self.ads_txt_data = []
+        self.ads_txt_variables = []
+        self.malformed_lines = 0
+        self.batch_size = batch_size
+        self.pending_domains = []
+        self.plot = plot
+        self.plot_file = plot_file
+        self.metrics = metrics
+        self.closed = False
+        self.index_file = index_file
+        self.index = None
+        if index_file is not None:
+            from seller_index import SellerIndex ## numpy is only needed when the index is used
+            self.index = SellerIndex.load(index_file) if os.path.exists(index_file) else SellerIndex()
+        
+        self.journal = CrawlJournal(JOURNAL_FILE, resume)
+        for domain_name, has_ads_txt in self.journal.getFinished().items():
+            if has_ads_txt is not None:
+                self.has_ads_txt[domain_name] = has_ads_txt
+        
+        self.sinks = []
+        if filter_status == "complete":
+            if output_format == "parquet":
+                self.sinks = [ParquetRecordSink("ads.txt_data.parquet", DATA_LABELS, resume),
+                              ParquetRecordSink("ads.txt_variables.parquet", VARIABLE_LABELS, resume)]
+            else:
+                self.sinks = [CSVRecordSink("ads.txt_data.csv", DATA_LABELS, resume),
+                              CSVRecordSink("ads.txt_variables.csv", VARIABLE_LABELS, resume)]
+            positions = self.journal.getPositions()
+            for i in range(len(self.sinks)):
+                self.sinks[i].truncate(positions[i] if i < len(positions) else 0)
+    
+    def getFinished(self):
+        return self.journal.getFinished()
+    
+    def finishDomain(self, domain_name):
+        self.pending_domains.append((domain_name, self.has_ads_txt.get(domain_name)))
+        if (len(self.ads_txt_data) + len(self.ads_txt_variables) >= self.batch_size
+                or len(self.pending_domains) >= self.batch_size):
+            self.flush()
+    
+    def flush(self):
+        if self.sinks:
+            self.sinks[0].write(self.ads_txt_data)
+            self.sinks[1].write(self.ads_txt_variables)
+        positions = [sink.flush() for sink in self.sinks]
+        self.journal.append(self.pending_domains, positions)
+        
+        self.ads_txt_data = []
+        self.ads_txt_variables = []
+        self.pending_domains = []
+    
+    def close(self, completed=True):
+        """
+        Write what is left in the buffers. The journal is removed if the crawl went through every domain. Only
+        the first call does something, so an error handler can always call it.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+        self.journal.close(remove=completed)
+        if self.index is not None:
+            self.index.save(self.index_file)
+
+
+def parseAdsTxt(domain_name, text_page):
+    """
+    Parse the content of an ads.txt page (see ads_txt_parser.py). Returns the list of AdsTxtRecord
+    (domain, SSP, PUB_ID, SALES_CHANNEL, CERT_AUTH_ID), the list of AdsTxtVariable (domain, name, value)
+    and the number of malformed lines that were skipped.
+    """
+    return parseAdsTxtContent(domain_name, text_page)
+
+def recordWebPage(domain_name, web_page, filter_status, results, cache=None):
+    """
+    Add the result of the request sent to domain_name to results.has_ads_txt and, if filter_status ==
+    "complete", add its parsed ads.txt records and variables to results. When a cache is used, records of
+    unchanged ads.txt files (304 or same content hash) are taken from the cache instead of being parsed again.
+    The request telemetry and the parse time are added to results.metrics.
+    """
+    parse_time = 0.0
+    if web_page.status_code == 404:
+        results.has_ads_txt[domain_name] = False
+        if cache is not None:
+            cache.remove(domain_name)
+        if results.index is not None:
+            results.index.removeDomain(domain_name)
+    elif web_page.status_code not in (200, 304):
+        pass
+    else:
+        results.has_ads_txt[domain_name] = True
+        need_records = filter_status == "complete"
+        cached = None if cache is None else cache.lookup(domain_name, web_page, need_records)
+        records = None
+        if cached is not None:
+            if need_records:
+                records = [AdsTxtRecord(*r) for r in cached['records']]
+                results.ads_txt_data += records
+                results.ads_txt_variables += [AdsTxtVariable(*v) for v in cached['variables']]
+        elif web_page.status_code == 200:
+            parsed = None
+            if need_records:
+                if web_page.parsed is not None: ## parsed while it was downloaded
+                    records, variables, malformed = web_page.parsed
+                    parse_time = web_page.parse_time
+                else:
+                    start = time.perf_counter()
+                    records, variables, malformed = parseAdsTxt(domain_name, web_page.text)
+                    parse_time = time.perf_counter() - start
+                results.ads_txt_data += records
+                results.ads_txt_variables += variables
+                results.malformed_lines += malformed
+                parsed = {'records': records, 'variables': variables}
+            if cache is not None:
+                cache.store(domain_name, web_page, parsed)
+        if records is not None and results.index is not None:
+            results.index.updateDomain(domain_name, records)
     
-    has_ads_txt = {}
-    ads_txt_data = []
+    if results.metrics is not None:
+        results.metrics.record(domain_name, web_page, parse_time)
+    results.finishDomain(domain_name)
+
+def checkHasAdsFile(list_domain_objects, filter_status, print_status, cache=None, results=None):
     
-    line_start_comment = re.compile(r'^#') #Search for lines with only comments
-    comment_in_line = re.compile(r'#.*') #search for lines with comments at the end
-    return_char = re.compile(r'\r') #search for \r 
+    if results is None:
+        results = CrawlResults(filter_status)
                                  
     for domain in list_domain_objects:
+        web_page = domain.openWebPage()
         if print_status:
-            print(domain.getDomain(), ': HTTP status -> ', domain.checkHTTPCode())
-        if domain.checkHTTPCode() == 404:
-            has_ads_txt[domain.getDomain()] = False                        
-        elif domain.checkHTTPCode() != 200:
-            pass
-        else:
-            has_ads_txt[domain.getDomain()] = True
-            if filter_status == "complete": ## parse webpage and put data in tuple if 
-                                            ## filter_status == "complete" (ref runHasAdstxt())
-                text_page = domain.parsedWebPage().split('\n')
-                for line in text_page:
-                    if re.search(line_start_comment, line) or line == "" or line == " ":
-                        pass
-                    elif re.search(comment_in_line, line):
-                        line = comment_in_line.sub("", line)
-                        line = return_char.sub("", line)
-                        temp_tuple = tuple(line.split(','))
-                        ads_txt_data.append((domain.getDomain(),) + temp_tuple)
-                    else:
-                        line = return_char.sub("", line)
-                        temp_tuple = tuple(line.split(','))
-                        ads_txt_data.append((domain.getDomain(),) + temp_tuple)
-    
-    return structureData(has_ads_txt, ads_txt_data, filter_status)
-
-def structureData(has_ads_txt, ads_txt_data, filter_status):
-    """
-    This function will format the data to make it readible to the user (dataframe + chart)
+            print(domain.getDomain(), ': HTTP status -> ', web_page.status_code)
+        recordWebPage(domain.getDomain(), web_page, filter_status, results, cache)
+        web_page.releaseContent() ## page content is not needed anymore
+    
+    return structureResults(results, filter_status)
+
+async def fetchDomains(list_domain_objects, concurrency, per_host, print_status, callback):
     """
+    Send exactly one request per domain. At most "concurrency" requests are in flight at any time and at
+    most "per_host" of them target the same host. Requests run in a thread pool so the blocking requests
+    library can be driven by the event loop. callback(domain object, WebPage) is called in the event loop
+    as soon as a domain is fetched (status_code is None if the request failed: timeout, DNS, etc.)
+    """
+    import asyncio
     
-    ## Create csv with data from ads.txt of filter_status == "complete" (ref runHasAdstxt())
-    if filter_status == "complete":    
-        labels = ["DOMAINS","SSP","PUB_ID","SALES_CHANNEL","CERT_AUTH_ID"]         
-        ads_txt_data_df = pd.DataFrame.from_records(ads_txt_data, columns=labels, index=labels[0])
-        ads_txt_data_df.to_csv("ads.txt_data.csv") 
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    global_limit = asyncio.Semaphore(concurrency)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
     
-    has_ads_txt_df = pd.DataFrame.from_dict(has_ads_txt, orient='index')
-    has_ads_txt_df.columns = ["has_ads.txt"]
+    async def fetch(domain):
+        async with host_limits[domain.getHost()]: ## wait for the host first so we don't hold a global slot
+            async with global_limit:
+                web_page = await loop.run_in_executor(executor, domain.openWebPage)
+        if print_status:
+            print(domain.getDomain(), ': HTTP status -> ', web_page.status_code)
+        callback(domain, web_page)
     
-    has_ads_txt_df.to_csv("has_ads_txt.csv")
+    try:
+        await asyncio.gather(*[fetch(domain) for domain in list_domain_objects])
+    finally:
+        executor.shutdown(wait=False)
 
+def crawlHasAdsFile(list_domain_objects, filter_status, print_status, concurrency, per_host=2, cache=None,
+                    results=None):
+    """
+    Concurrent version of checkHasAdsFile. Produces the same output files but fetches domains with
+    bounded concurrency (see fetchDomains()) instead of one after the other. Domains are written to the
+    output files in the order they finish.
+    """
+    import asyncio ## only imported in concurrent mode, keeps the module fast to import
+    
+    if results is None:
+        results = CrawlResults(filter_status)
+    
+    def record(domain, web_page):
+        recordWebPage(domain.getDomain(), web_page, filter_status, results, cache)
+        web_page.releaseContent()
     
-    temp_series = pd.Series(has_ads_txt_df['has_ads.txt'].value_counts())
-    temp_dict = pd.Series.to_dict(temp_series)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(fetchDomains(list_domain_objects, concurrency, per_host, print_status, record))
+    finally:
+        ## cancel the requests still waiting if the crawl was interrupted
+        all_tasks = asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks
+        pending = [task for task in all_tasks(loop) if not task.done()]
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
     
-    ## Plot pie chart of has_ads_txt df
-    plt.figure(1, figsize=(4,4))
-    plt.pie([v for v in temp_dict.values()], None, [k for k in temp_dict], autopct='%.2f%%',colors=['silver', 'yellow'])  ##'%.2f%% is used to format data label'
-    plt.title("Has ads.txt (%tage of publishers)")
-    plt.show()
+    return structureResults(results, filter_status)
+
+def structureResults(results, filter_status):
+    """
+    Write the output files of the crawl (see structureData()). The journal is only removed once they are
+    written: if structureData() fails, it is kept and the crawl can be resumed.
+    """
+    results.flush()
+    if results.malformed_lines:
+        print(results.malformed_lines, 'malformed ads.txt lines skipped')
+    
+    try:
+        message = structureData(results.has_ads_txt, None, filter_status, plot=results.plot,
+                                plot_file=results.plot_file)
+    except BaseException:
+        results.close(completed=False)
+        raise
+    results.close()
+    
+    return message
+
+def structureData(has_ads_txt, ads_txt_data, filter_status, ads_txt_variables=None, plot=True, plot_file=None):
+    """
+    This function will format the data to make it readible to the user (csv + chart). ads_txt_data is
+    None when records were already written by the crawl (see CrawlResults). The chart is shown if plot is
+    True, or only saved to plot_file if plot_file is set (no window is opened).
+    """
+    
+    ## Create csv with data from ads.txt of filter_status == "complete" (ref runHasAdstxt())
+    if filter_status == "complete" and ads_txt_data is not None:    
+        import pandas as pd
+        
+        ads_txt_data_df = pd.DataFrame.from_records(ads_txt_data, columns=DATA_LABELS, index=DATA_LABELS[0])
+        ads_txt_data_df.to_csv("ads.txt_data.csv") 
+        
+        ## Variables (contact=, subdomain=, etc.) are written to a separate file
+        if ads_txt_variables:
+            ads_txt_variables_df = pd.DataFrame.from_records(ads_txt_variables, columns=VARIABLE_LABELS,
+                                                             index=VARIABLE_LABELS[0])
+            ads_txt_variables_df.to_csv("ads.txt_variables.csv")
+    
+    with open("has_ads_txt.csv", 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(["", "has_ads.txt"])
+        writer.writerows(has_ads_txt.items())
+    
+    if plot or plot_file:
+        plotHasAdsTxt(has_ads_txt, plot_file)
     
     return "File succesfully generated."
 
-def runHasAdstxt(file, path, filter_status="limited", print_status=True):
+def plotHasAdsTxt(has_ads_txt, plot_file=None):
+    """
+    Plot pie chart of the share of publishers using ads.txt. If plot_file is set the chart is written to
+    the file without going through pyplot, so it works without a display.
+    """
+    counts = Counter(has_ads_txt.values()).most_common()
+    values = [v for k, v in counts]
+    labels = [k for k, v in counts]
+    
+    if plot_file:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        
+        figure = Figure(figsize=(4,4))
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        axes.pie(values, labels=labels, autopct='%.2f%%', colors=['silver', 'yellow'])
+        axes.set_title("Has ads.txt (%tage of publishers)")
+        figure.savefig(plot_file)
+    else:
+        import matplotlib.pyplot as plt
+        
+        plt.figure(1, figsize=(4,4))
+        plt.pie(values, labels=labels, autopct='%.2f%%',colors=['silver', 'yellow'])  ##'%.2f%% is used to format data label'
+        plt.title("Has ads.txt (%tage of publishers)")
+        plt.show()
+
+def runHasAdstxt(file, path, filter_status="limited", print_status=True, concurrency=None, per_host=2, timeout=10,
+                 pool_size=10, retries=2, backoff_factor=0.5, cache_file=None, cache_ttl=30*24*3600,
+                 cache_max_entries=1000000, output_format="csv", batch_size=10000, resume=False, plot=True,
+                 plot_file=None, index_file=None, metrics_file=None, progress=None):
     """
     The program can be run with 2 different value for the parameter 1) filter_status and 
     2) print_status. filter_status accepts either "limited" (will only return if a pub has
@@ -155,10 +529,137 @@ def runHasAdstxt(file, path, filter_status="limited", print_status=True):
    
     filter_status --> default to "limited"
     print_status --> default to "True"
+    
+    concurrency can be set to an integer N to crawl N domains at the same time (one request per domain).
+    per_host limits the number of simultaneous requests sent to the same host and timeout (in seconds)
+    is applied to every request.
+    
+    Every domain is requested once through a shared connection pool of pool_size connections. Connection
+    errors and 5XX responses are retried up to "retries" times with an exponential backoff (backoff_factor).
+    
+    If cache_file is set, ads.txt files are cached on disk (see ads_txt_cache.py). Requests are sent with
+    If-None-Match / If-Modified-Since and unchanged files are not parsed again. Entries not validated for
+    cache_ttl seconds are evicted, as well as the oldest entries above cache_max_entries domains.
+    
+    Records are written to disk in batches of batch_size rows while the crawl runs, as CSV files or as
+    directories of Parquet files (output_format="parquet", requires pyarrow). If a crawl is interrupted,
+    running it again with resume=True skips the domains already crawled.
+    
+    The pie chart is shown at the end of the crawl unless plot is False. If plot_file is set, the chart is
+    only saved to that file (headless mode, no window is opened).
+    
+    If index_file is set (filter_status == "complete" only), the seller index stored in this file is updated
+    with the records of every crawled domain (see seller_index.py to query it).
+    
+    If metrics_file is set, the telemetry of every domain (latency, redirects, bytes, status, parse time) is
+    written to ads.txt_crawl_metrics.csv and histograms / percentiles of the run are written to metrics_file
+    (JSON), see crawl_metrics.py. The command line writes them to METRICS_FILE unless --no-metrics is given. progress prints a live progress line to stderr
+    (defaults to True when stderr is a terminal and print_status is False).
+    -----
+    
+    concurrency --> default to None (domains are crawled one after the other)
+    per_host --> default to 2
+    timeout --> default to 10
+    pool_size --> default to 10 (raised to concurrency if concurrency is higher)
+    retries --> default to 2
+    backoff_factor --> default to 0.5
+    cache_file --> default to None (no cache)
+    cache_ttl --> default to 30 days
+    cache_max_entries --> default to 1,000,000
+    output_format --> default to "csv"
+    batch_size --> default to 10,000
+    resume --> default to False
+    plot --> default to True
+    plot_file --> default to None
+    index_file --> default to None
+    metrics_file --> default to None (no telemetry)
+    progress --> default to None (automatic)
     """
     list_domains = openFile(file)
-    build_URL = createURLObjects(list_domains,path)
+    session = buildSession(max(pool_size, concurrency or 0), retries, backoff_factor)
+    build_URL = createURLObjects(list_domains, path, session, timeout, parse=filter_status == "complete")
+    
+    cache = None
+    if cache_file is not None:
+        cache = AdsTxtCache(cache_file, cache_ttl, cache_max_entries)
+        for domain in build_URL:
+            domain.addRequestHeaders(cache.conditionalHeaders(domain.getDomain(), filter_status == "complete"))
+    
+    if progress is None:
+        progress = sys.stderr.isatty() and not print_status
+    metrics = None
+    if metrics_file is not None:
+        metrics = CrawlMetrics(metrics_file, DOMAIN_METRICS_FILE, progress=progress, resume=resume)
+    
+    results = CrawlResults(filter_status, output_format, batch_size, resume, plot, plot_file,
+                           index_file if filter_status == "complete" else None, metrics)
+    finished = results.getFinished()
+    if finished:
+        print(len(finished), 'domains already crawled, resuming')
+        build_URL = [domain for domain in build_URL if domain.getDomain() not in finished]
+    if metrics is not None:
+        metrics.total = len(build_URL)
+    
+    try:
+        if concurrency:
+            result = crawlHasAdsFile(build_URL, filter_status, print_status, concurrency, per_host, cache, results)
+        else:
+            result = checkHasAdsFile(build_URL, filter_status, print_status, cache, results)
+    except BaseException:
+        results.close(completed=False) ## keep what was crawled so far, the crawl can be resumed
+        raise
+    finally:
+        if cache is not None:
+            cache.close()
+        if metrics is not None:
+            metrics.close() ## also written when the crawl is interrupted
+    
+    if cache is not None:
+        print(cache)
+    if metrics is not None:
+        print(metrics)
+    
+    return result
+
+def main(argv=None):
+    """
+    Command line entry point, see python has_ads.txt_scraper.py --help
+    """
+    parser = argparse.ArgumentParser(description='Check if publishers use ads.txt and collect their authorized sellers')
+    parser.add_argument('file', nargs='?', default='publisher_list.csv', help='csv file with a DOMAINS header')
+    parser.add_argument('--path', default='ads.txt', help='path of the page to scrape (without "/")')
+    parser.add_argument('--mode', choices=['limited', 'complete'], default='complete', help='filter_status')
+    parser.add_argument('--print-status', action='store_true', help='print the HTTP status of every domain')
+    parser.add_argument('--concurrency', type=int, default=None)
+    parser.add_argument('--per-host', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--backoff-factor', type=float, default=0.5)
+    parser.add_argument('--cache', dest='cache_file', default=None, help='ads.txt cache file (SQLite)')
+    parser.add_argument('--cache-ttl', type=float, default=30, help='days before a cache entry is evicted')
+    parser.add_argument('--cache-max-entries', type=int, default=1000000)
+    parser.add_argument('--format', dest='output_format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--resume', action='store_true', help='resume an interrupted crawl')
+    parser.add_argument('--no-plot', action='store_true', help='headless mode, do not show the chart')
+    parser.add_argument('--plot-file', default=None, help='save the chart to this file instead of showing it')
+    parser.add_argument('--index', dest='index_file', default=None, help='seller index file to update')
+    parser.add_argument('--metrics', dest='metrics_file', default=METRICS_FILE,
+                        help='JSON file receiving the crawl telemetry')
+    parser.add_argument('--no-metrics', action='store_true', help='do not collect crawl telemetry')
+    parser.add_argument('--progress', action='store_true', default=None, help='print a live progress line')
+    parser.add_argument('--no-progress', dest='progress', action='store_false')
+    args = parser.parse_args(argv)
     
-    return checkHasAdsFile(build_URL, filter_status, print_status)
+    return runHasAdstxt(args.file, args.path, filter_status=args.mode, print_status=args.print_status,
+                        concurrency=args.concurrency, per_host=args.per_host, timeout=args.timeout,
+                        pool_size=args.pool_size, retries=args.retries, backoff_factor=args.backoff_factor,
+                        cache_file=args.cache_file, cache_ttl=args.cache_ttl*24*3600,
+                        cache_max_entries=args.cache_max_entries, output_format=args.output_format,
+                        batch_size=args.batch_size, resume=args.resume, plot=not args.no_plot,
+                        plot_file=args.plot_file, index_file=args.index_file,
+                        metrics_file=None if args.no_metrics else args.metrics_file, progress=args.progress)
 
-print(runHasAdstxt('publisher_list.csv', '/ads.txt', filter_status="complete", print_status=False))
\ No newline at end of file
+if __name__ == '__main__':
+    print(main())
\ No newline at end of file
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Teddy Crepineau
+
+Purpose: micro-benchmark of the ads.txt parser (ads_txt_parser.py) against the regex loop previously used in
+checkHasAdsFile, on large synthetic ads.txt files (SSP-heavy publishers serve files with 10k+ lines).
+
+Usage: python parser_benchmark.py --lines 10000 100000
+"""
+
+import argparse
+import random
+import re
+import time
+
+from ads_txt_parser import AdsTxtParser, parseAdsTxtContent
+
+
+def generateAdsTxt(lines, seed=0):
+    """
+    Return a synthetic ads.txt file with "lines" lines: records with and without certification authority ID,
+    comments, inline comments, variables, blank lines, extension fields and a few malformed lines.
+    """
+    rd = random.Random(seed)
+    content = ['# ads.txt generated for benchmark', 'contact=adops@example.com', 'subdomain=news.example.com']
+    for i in range(lines):
+        draw = rd.random()
+        ssp = 'ssp' + str(rd.randint(0, 500)) + '.com'
+        pub_id = str(rd.randint(1, 10**9))
+        relationship = 'DIRECT' if rd.random() < 0.3 else 'RESELLER'
+        if draw < 0.02:
+            content.append('# ' + ssp + ' accounts')
+        elif draw < 0.03:
+            content.append('')
+        elif draw < 0.035:
+            content.append(ssp + ' ' + pub_id) ## malformed
+        elif draw < 0.1:
+            content.append(ssp + ', ' + pub_id + ', ' + relationship + ' # added by sales')
+        elif draw < 0.12:
+            content.append(ssp + ', ' + pub_id + ', ' + relationship + ', f08c47fec0942fa0;extension=1')
+        elif draw < 0.6:
+            content.append(ssp.upper() + ',' + pub_id + ',' + relationship.lower() + ',f08c47fec0942fa0')
+        else:
+            content.append(ssp + ', ' + pub_id + ', ' + relationship)
+
+    return '\r\n'.join(content) + '\r\n'
+
+
+def regexParse(domain_name, text_page):
+    """Parse loop used by checkHasAdsFile before ads_txt_parser.py (kept here as the baseline)"""
+    ads_txt_data = []
+
+    line_start_comment = re.compile(r'^#')
+    comment_in_line = re.compile(r'#.*')
+    return_char = re.compile(r'\r')
+
+    for line in text_page.split('\n'):
+        if re.search(line_start_comment, line) or line == "" or line == " ":
+            pass
+        elif re.search(comment_in_line, line):
+            line = comment_in_line.sub("", line)
+            line = return_char.sub("", line)
+            ads_txt_data.append((domain_name,) + tuple(line.split(',')))
+        else:
+            line = return_char.sub("", line)
+            ads_txt_data.append((domain_name,) + tuple(line.split(',')))
+
+    return ads_txt_data
+
+
+def chunkedParse(domain_name, text_page, chunk_size=16384):
+    """Feed the page to the parser in chunks of bytes, as it would be with a streamed response"""
+    content = text_page.encode('utf-8')
+    chunks = (content[i:i + chunk_size] for i in range(0, len(content), chunk_size))
+    return list(AdsTxtParser(domain_name).parse(chunks))
+
+
+def timeIt(function, repeat, *args):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def runBenchmark(sizes=(10000, 100000), repeat=5):
+    for lines in sizes:
+        text_page = generateAdsTxt(lines)
+        records, variables, malformed = parseAdsTxtContent('example.com', text_page)
+        print(lines, 'lines ->', len(records), 'records,', len(variables), 'variables,', malformed, 'malformed')
+        for name, function in [('regex loop', regexParse), ('ads_txt_parser', parseAdsTxtContent),
+                               ('ads_txt_parser (16KB chunks)', chunkedParse)]:
+            elapsed = timeIt(function, repeat, 'example.com', text_page)
+            print('   ', name, ':', round(elapsed * 1000, 2), 'ms,', int(lines / elapsed), 'lines/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the ads.txt parser')
+    parser.add_argument('--lines', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    runBenchmark(args.lines, args.repeat)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Teddy Crepineau
+
+Purpose: answer "which publishers authorize seller X with pub ID Y (as DIRECT or RESELLER)?" without scanning
+ads.txt_data.csv. The index maps every seller (SSP domain, PUB_ID, SALES_CHANNEL, CERT_AUTH_ID) to the
+publishers listing it in their ads.txt file, and every publisher to its sellers.
+
+Sellers are kept sorted, so all the sellers of an SSP (or of an SSP account) have consecutive ids and are
+found with a binary search. Publisher <-> seller links are stored as two compressed sparse row arrays
+(numpy), so a lookup is a slice of an array and intersections across sellers are done with numpy, which
+keeps queries in the millisecond range with millions of records.
+
+Domains re-crawled after the index was built are kept in a small "delta" (publisher -> sellers) that takes
+precedence over the arrays, and merged into them by compact() (called by save()).
+
+Usage: python seller_index.py seller_index.npz --build ads.txt_data.csv
+       python seller_index.py seller_index.npz --ssp google.com --pub-id pub-123 --channel DIRECT
+       python seller_index.py seller_index.npz --publisher example.com
+"""
+
+import argparse
+import bisect
+import csv
+
+import numpy as np
+
+SALES_CHANNEL_CODES = {'DIRECT': 0, 'RESELLER': 1}
+
+
+def sellerKey(ssp, pub_id, sales_channel, cert_auth_id):
+    return ssp + '\t' + pub_id + '\t' + sales_channel + '\t' + (cert_auth_id or '')
+
+
+def buildCSR(rows, columns, num_rows):
+    """Return (pointers, values) so values[pointers[i]:pointers[i + 1]] are the columns of row i"""
+    order = np.argsort(rows, kind='stable')
+    pointers = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=pointers[1:])
+    return pointers, columns[order].astype(np.int32)
+
+
+class SellerIndex(object):
+    """
+    Inverted index over ads.txt records. A seller is (SSP, PUB_ID, SALES_CHANNEL, CERT_AUTH_ID) as normalized
+    by ads_txt_parser.py (SSP and CERT_AUTH_ID lower case, SALES_CHANNEL upper case).
+    """
+
+    def __init__(self):
+        self.publishers = [] ## publisher id -> publisher domain
+        self.publisher_ids = {}
+        self.keys = [] ## seller id -> seller key (sorted)
+        self.channels = np.zeros(0, dtype=np.int8) ## seller id -> SALES_CHANNEL_CODES
+        self.seller_pointers = np.zeros(1, dtype=np.int64) ## seller id -> publisher ids
+        self.seller_publishers = np.zeros(0, dtype=np.int32)
+        self.publisher_pointers = np.zeros(1, dtype=np.int64) ## publisher id -> seller ids
+        self.publisher_sellers = np.zeros(0, dtype=np.int32)
+        self.delta = {} ## publisher id -> seller keys, for publishers updated since the last compact()
+
+    def getPublisherId(self, publisher):
+        publisher_id = self.publisher_ids.get(publisher)
+        if publisher_id is None:
+            publisher_id = len(self.publishers)
+            self.publishers.append(publisher)
+            self.publisher_ids[publisher] = publisher_id
+        return publisher_id
+
+    def getBaseSellerKeys(self, publisher_id):
+        if publisher_id + 1 >= len(self.publisher_pointers):
+            return []
+        seller_ids = self.publisher_sellers[self.publisher_pointers[publisher_id]:self.publisher_pointers[publisher_id + 1]]
+        return [self.keys[s] for s in seller_ids]
+
+    def addRecords(self, records):
+        """records is an iterable of (publisher, SSP, PUB_ID, SALES_CHANNEL, CERT_AUTH_ID)"""
+        for record in records:
+            publisher_id = self.getPublisherId(record[0])
+            seller_keys = self.delta.get(publisher_id)
+            if seller_keys is None:
+                seller_keys = self.delta[publisher_id] = self.getBaseSellerKeys(publisher_id)
+            seller_keys.append(sellerKey(*record[1:5]))
+
+    def updateDomain(self, publisher, records):
+        """Replace the sellers of publisher by the ones in records (after the domain was re-crawled)"""
+        self.delta[self.getPublisherId(publisher)] = [sellerKey(*record[1:5]) for record in records]
+
+    def removeDomain(self, publisher):
+        publisher_id = self.publisher_ids.get(publisher)
+        if publisher_id is not None:
+            self.delta[publisher_id] = []
+
+    def compact(self):
+        """Merge the publishers updated since the last call into the arrays"""
+        if not self.delta:
+            return
+
+        ## links of the publishers that were not updated
+        num_base_publishers = len(self.publisher_pointers) - 1
+        edge_publishers = np.repeat(np.arange(num_base_publishers, dtype=np.int32), np.diff(self.publisher_pointers))
+        keep = ~np.isin(edge_publishers, np.fromiter(self.delta.keys(), dtype=np.int64))
+        edge_keys = np.array(self.keys, dtype=object)[self.publisher_sellers[keep]]
+        edge_publishers = edge_publishers[keep]
+
+        ## links of the updated publishers
+        delta_keys = [k for publisher_id in self.delta for k in self.delta[publisher_id]]
+        delta_publishers = np.repeat(np.fromiter(self.delta.keys(), dtype=np.int32),
+                                     [len(k) for k in self.delta.values()])
+        edge_keys = np.concatenate([edge_keys, np.array(delta_keys, dtype=object)])
+        edge_publishers = np.concatenate([edge_publishers, delta_publishers]).astype(np.int64)
+
+        keys, edge_sellers = np.unique(edge_keys, return_inverse=True)
+        edges = np.unique(edge_publishers * len(keys) + edge_sellers.ravel()) ## drop duplicated links
+        edge_publishers, edge_sellers = edges // max(len(keys), 1), edges % max(len(keys), 1)
+
+        self.keys = list(keys)
+        self.channels = np.array([SALES_CHANNEL_CODES.get(k.split('\t')[2], -1) for k in self.keys], dtype=np.int8)
+        self.seller_pointers, self.seller_publishers = buildCSR(edge_sellers, edge_publishers, len(self.keys))
+        self.publisher_pointers, self.publisher_sellers = buildCSR(edge_publishers, edge_sellers,
+                                                                   len(self.publishers))
+        self.delta = {}
+
+    def sellerRange(self, prefix):
+        """Ids [first, last) of the sellers whose key starts with prefix (prefix ends with a tab)"""
+        first = bisect.bisect_left(self.keys, prefix)
+        last = bisect.bisect_left(self.keys, prefix[:-1] + '\n', first) ## '\n' sorts right after '\t'
+        return first, last
+
+    def findPublisherIds(self, ssp, pub_id=None, sales_channel=None, cert_auth_id=None):
+        """Return the sorted array of ids of the publishers authorizing the seller(s) matching the criteria"""
+        fields = [ssp.strip().lower(), None if pub_id is None else pub_id.strip(),
+                  None if sales_channel is None else sales_channel.strip().upper(),
+                  None if cert_auth_id is None else cert_auth_id.strip().lower()]
+        prefix = ''
+        for field in fields: ## longest prefix of the key given by the criteria
+            if field is None:
+                break
+            prefix += field + '\t'
+
+        def match(key):
+            key_fields = key.split('\t')
+            return all(f is None or f == k for f, k in zip(fields, key_fields))
+
+        first, last = self.sellerRange(prefix)
+        publisher_ids = self.seller_publishers[self.seller_pointers[first]:self.seller_pointers[last]]
+        if prefix.count('\t') < sum(f is not None for f in fields): ## criteria not covered by the prefix
+            counts = np.diff(self.seller_pointers[first:last + 1])
+            seller_ids = np.repeat(np.arange(first, last), counts)
+            mask = np.ones(len(seller_ids), dtype=bool)
+            if fields[2] is not None:
+                mask &= self.channels[seller_ids] == SALES_CHANNEL_CODES.get(fields[2], -1)
+            if fields[3] is not None:
+                matching = np.array([match(self.keys[s]) for s in range(first, last)], dtype=bool)
+                mask &= np.repeat(matching, counts)
+            publisher_ids = publisher_ids[mask]
+
+        if self.delta:
+            updated = np.fromiter(self.delta.keys(), dtype=np.int64)
+            publisher_ids = publisher_ids[~np.isin(publisher_ids, updated)]
+            delta_ids = [p for p, seller_keys in self.delta.items() if any(match(k) for k in seller_keys)]
+            publisher_ids = np.concatenate([publisher_ids, np.array(delta_ids, dtype=np.int32)])
+
+        return np.unique(publisher_ids)
+
+    def findPublishers(self, ssp, pub_id=None, sales_channel=None, cert_auth_id=None):
+        """Return the set of publishers authorizing the seller(s) matching the criteria (None matches all)"""
+        return set(self.publishers[p] for p in self.findPublisherIds(ssp, pub_id, sales_channel, cert_auth_id))
+
+    def findCommonPublishers(self, *queries):
+        """
+        Return the publishers authorizing every seller in queries. Each query is a tuple of arguments of
+        findPublishers(), i.e. ('google.com', 'pub-123') or ('appnexus.com', '1234', 'RESELLER').
+        """
+        if not queries:
+            return set()
+
+        publisher_sets = sorted((self.findPublisherIds(*query) for query in queries), key=len)
+        common = publisher_sets[0]
+        for publisher_ids in publisher_sets[1:]:
+            common = np.intersect1d(common, publisher_ids, assume_unique=True)
+        return set(self.publishers[p] for p in common)
+
+    def findSellers(self, publisher):
+        """Return the set of sellers (SSP, PUB_ID, SALES_CHANNEL, CERT_AUTH_ID) listed by publisher"""
+        publisher_id = self.publisher_ids.get(publisher)
+        if publisher_id is None:
+            return set()
+        seller_keys = self.delta.get(publisher_id)
+        if seller_keys is None:
+            seller_keys = self.getBaseSellerKeys(publisher_id)
+        return set(tuple(k.split('\t')) for k in seller_keys)
+
+    def save(self, filename):
+        self.compact()
+        with open(filename, 'wb') as f: ## file object so numpy does not add a .npz extension
+            np.savez(f,
+                     publishers=np.frombuffer('\n'.join(self.publishers).encode('utf-8'), dtype=np.uint8),
+                     keys=np.frombuffer('\n'.join(self.keys).encode('utf-8'), dtype=np.uint8),
+                     channels=self.channels,
+                     seller_pointers=self.seller_pointers, seller_publishers=self.seller_publishers,
+                     publisher_pointers=self.publisher_pointers, publisher_sellers=self.publisher_sellers)
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with np.load(filename) as data:
+            publishers = data['publishers'].tobytes().decode('utf-8')
+            keys = data['keys'].tobytes().decode('utf-8')
+            index.publishers = publishers.split('\n') if publishers else []
+            index.keys = keys.split('\n') if keys else []
+            index.channels = data['channels']
+            index.seller_pointers = data['seller_pointers']
+            index.seller_publishers = data['seller_publishers']
+            index.publisher_pointers = data['publisher_pointers']
+            index.publisher_sellers = data['publisher_sellers']
+        index.publisher_ids = dict((p, i) for i, p in enumerate(index.publishers))
+        return index
+
+    @classmethod
+    def fromCSV(cls, filename):
+        """Build the index from an ads.txt_data.csv file written by has_ads.txt_scraper"""
+        index = cls()
+        with open(filename, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader) ## header
+            index.addRecords(reader)
+        index.compact()
+        return index
+
+    def __str__(self):
+        result = ('Seller index: ' + str(int(np.count_nonzero(np.diff(self.publisher_pointers)))) + ' publishers, ' +
+                  str(int(np.count_nonzero(np.diff(self.seller_pointers)))) + ' sellers, ' +
+                  str(len(self.seller_publishers)) + ' records')
+        if self.delta:
+            result += ' (+ ' + str(len(self.delta)) + ' publishers updated, not compacted)'
+        return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the seller index built from crawled ads.txt files')
+    parser.add_argument('index_file')
+    parser.add_argument('--build', metavar='CSV', help='build the index from ads.txt_data.csv and save it')
+    parser.add_argument('--ssp')
+    parser.add_argument('--pub-id')
+    parser.add_argument('--channel', help='DIRECT or RESELLER')
+    parser.add_argument('--cert-auth-id')
+    parser.add_argument('--publisher', help='list the sellers of this publisher')
+    args = parser.parse_args()
+
+    if args.build:
+        index = SellerIndex.fromCSV(args.build)
+        index.save(args.index_file)
+    else:
+        index = SellerIndex.load(args.index_file)
+    print(index)
+
+    if args.ssp:
+        for publisher in sorted(index.findPublishers(args.ssp, args.pub_id, args.channel, args.cert_auth_id)):
+            print(publisher)
+    if args.publisher:
+        for seller in sorted(index.findSellers(args.publisher)):
+            print(', '.join(seller))